@@ -9,200 +9,4102 @@ Single-file version - all code in one file for easy deployment.
 
 import streamlit as st
 import os
+import io
 import json
+import mmap
+import time
+import wave
+import struct
 import asyncio
+import uuid
+import hashlib
+import hmac
+import socket
+import sqlite3
+import re
+import random
+import difflib
+import functools
+import threading
+import contextlib
+import contextvars
+import gc
+import shutil
+import tempfile
+import weakref
 import httpx
+import numpy as np
+from collections import Counter, OrderedDict, deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 # dotenv import removed - using hardcoded API keys for demo
 from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from anthropic import DEFAULT_CONNECTION_LIMITS, Anthropic, APIStatusError, DefaultHttpxClient
+from anthropic import Timeout as AnthropicTimeout
 from pydantic import BaseModel, Field
 
+# ============================================================
+# CONFIGURATION
+# ============================================================
+
+DEEPGRAM_URL = os.environ.get("DEEPGRAM_API_URL", "https://api.deepgram.com/v1/listen")
+
+# Connection pool sizing for the shared Deepgram client. One pool is shared by
+# every session on a server process, so size it for concurrent clinicians.
+DEEPGRAM_MAX_CONNECTIONS = int(os.environ.get("DEEPGRAM_MAX_CONNECTIONS", "32"))
+DEEPGRAM_MAX_KEEPALIVE = int(os.environ.get("DEEPGRAM_MAX_KEEPALIVE", "16"))
+DEEPGRAM_KEEPALIVE_EXPIRY = float(os.environ.get("DEEPGRAM_KEEPALIVE_EXPIRY", "120"))
+
+# Shared Anthropic client. The SDK's default keep-alive expiry (5 s) drops
+# idle connections between notes, so keep them around longer.
+ANTHROPIC_MAX_CONNECTIONS = int(os.environ.get("ANTHROPIC_MAX_CONNECTIONS", "32"))
+ANTHROPIC_MAX_KEEPALIVE = int(os.environ.get("ANTHROPIC_MAX_KEEPALIVE", "16"))
+ANTHROPIC_KEEPALIVE_EXPIRY = float(os.environ.get("ANTHROPIC_KEEPALIVE_EXPIRY", "120"))
+ANTHROPIC_TIMEOUT = float(os.environ.get("ANTHROPIC_TIMEOUT", "300"))
+ANTHROPIC_CONNECT_TIMEOUT = 10.0
+
+# Prometheus text-format metrics on http://METRICS_HOST:METRICS_PORT/metrics
+# (off unless METRICS_PORT is set). Only stage names and counts are exported,
+# never transcript or note content.
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+METRICS_PREFIX = "moonlight_"
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+# Result caches. The in-memory tier is always on; the encrypted disk tier is
+# only enabled when both a directory and a CACHE_ENCRYPTION_KEY are configured.
+CACHE_DIR = os.environ.get("MOONLIGHT_CACHE_DIR", "")
+CACHE_TTL_SECONDS = float(os.environ.get("MOONLIGHT_CACHE_TTL_SECONDS", str(24 * 3600)))
+# Each cache's disk tier is kept under this many bytes, least recently used out first
+CACHE_DISK_MAX_BYTES = int(os.environ.get("MOONLIGHT_CACHE_DISK_MAX_BYTES", str(1024 * 1024 * 1024)))
+TRANSCRIPT_CACHE_MAX_BYTES = int(os.environ.get("TRANSCRIPT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+NOTE_CACHE_MAX_BYTES = int(os.environ.get("NOTE_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+
+# Per-session artifacts (uploaded audio, transcription results, transcripts,
+# notes, exports) live in one process-wide store and session state holds
+# only their handles. The most recently used ARTIFACT_MEMORY_MAX_BYTES stay
+# in memory; the rest is spilled, encrypted, under MOONLIGHT_ARTIFACT_DIR
+# (default: the system temp dir). A session idle for longer than
+# MOONLIGHT_ARTIFACT_IDLE_SECONDS loses its artifacts. Artifacts of at least
+# ARTIFACT_STREAM_MIN_BYTES (recordings) skip memory and are encrypted
+# straight to disk a chunk at a time.
+ARTIFACT_DIR = os.environ.get("MOONLIGHT_ARTIFACT_DIR", "")
+ARTIFACT_MEMORY_MAX_BYTES = int(os.environ.get("ARTIFACT_MEMORY_MAX_BYTES", str(32 * 1024 * 1024)))
+ARTIFACT_STREAM_MIN_BYTES = int(os.environ.get("ARTIFACT_STREAM_MIN_BYTES", str(4 * 1024 * 1024)))
+ARTIFACT_IDLE_SECONDS = float(os.environ.get("MOONLIGHT_ARTIFACT_IDLE_SECONDS", str(4 * 3600)))
+
+# Streamlit runs a full garbage collection after every script and fragment
+# run. The long-lived heap is frozen so those collections skip it, and the
+# freeze is redone every GC_REFREEZE_SECONDS so that objects alive at one
+# freeze (a session that has since closed) are not kept for good.
+GC_REFREEZE_SECONDS = float(os.environ.get("MOONLIGHT_GC_REFREEZE_SECONDS", "600"))
+
+# Outgoing rate limits. These are starting points: whenever a provider
+# reports its actual limits in response headers, those take over. Work over
+# the limit waits in a queue for up to RATE_LIMIT_MAX_WAIT_SECONDS.
+DEEPGRAM_RPM = float(os.environ.get("DEEPGRAM_RPM", "600"))
+DEEPGRAM_CONCURRENCY_LIMIT = int(os.environ.get("DEEPGRAM_CONCURRENCY_LIMIT", "32"))
+ANTHROPIC_RPM = float(os.environ.get("ANTHROPIC_RPM", "50"))
+ANTHROPIC_ITPM = float(os.environ.get("ANTHROPIC_ITPM", "30000"))
+ANTHROPIC_CONCURRENCY_LIMIT = int(os.environ.get("ANTHROPIC_CONCURRENCY_LIMIT", "32"))
+RATE_LIMIT_MAX_WAIT_SECONDS = float(os.environ.get("RATE_LIMIT_MAX_WAIT_SECONDS", "600"))
+
+# Transient Deepgram failures (connect errors, dropped connections, 5xx) are
+# retried with decorrelated-jitter backoff between RETRY_BASE_SECONDS and
+# RETRY_MAX_SECONDS. With DEEPGRAM_HEDGE set, a clip of up to HEDGE_MAX_BYTES
+# still unanswered after the p95 of recent short-clip latencies (or
+# HEDGE_AFTER_SECONDS until enough have been seen) gets a second request.
+DEEPGRAM_MAX_RETRIES = int(os.environ.get("DEEPGRAM_MAX_RETRIES", "3"))
+RETRY_BASE_SECONDS = float(os.environ.get("RETRY_BASE_SECONDS", "0.5"))
+RETRY_MAX_SECONDS = float(os.environ.get("RETRY_MAX_SECONDS", "20"))
+DEEPGRAM_HEDGE = os.environ.get("DEEPGRAM_HEDGE", "").lower() in ("1", "true", "yes")
+HEDGE_MAX_BYTES = int(os.environ.get("HEDGE_MAX_BYTES", str(4 * 1024 * 1024)))
+HEDGE_AFTER_SECONDS = float(os.environ.get("HEDGE_AFTER_SECONDS", "10"))
+HEDGE_MIN_SAMPLES = 20
+
+_MISSING = object()
+
+
+def get_secret(name: str, default=_MISSING) -> str:
+    """Read an API key from the environment, falling back to Streamlit secrets.
+    The environment lookup lets headless tools (benchmarks, batch jobs) run
+    without a ``.streamlit/secrets.toml``. Returns ``default`` when given and
+    the secret is not configured anywhere.
+    """
+    value = os.environ.get(name)
+    if value:
+        return value
+    try:
+        return st.secrets[name]
+    except (KeyError, FileNotFoundError):
+        if default is _MISSING:
+            raise
+        return default
+
+
+# ============================================================
+# METRICS
+# ============================================================
+
+@st.cache_resource
+def metrics_registry() -> tuple:
+    """The process-wide ``(lock, counters, histograms)``.
+    Streamlit re-executes this module on every rerun, so plain module-level
+    dicts would start empty each time; the cached registry is shared by
+    every rerun, session and background thread.
+    """
+    return threading.Lock(), {}, {}
+
+
+_metrics_lock, _counters, _histograms = metrics_registry()
+
+
+def increment(name: str, amount: float = 1) -> None:
+    """Add ``amount`` to a process-wide counter."""
+    with _metrics_lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def metrics_snapshot() -> dict:
+    """Return a copy of all counters."""
+    with _metrics_lock:
+        return dict(_counters)
+
+
+def observe(stage: str, seconds: float) -> None:
+    """Record one duration of a pipeline stage in its latency histogram."""
+    with _metrics_lock:
+        histogram = _histograms.setdefault(stage, {"buckets": [0] * len(LATENCY_BUCKETS), "sum": 0.0, "count": 0})
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                histogram["buckets"][i] += 1
+        histogram["sum"] += seconds
+        histogram["count"] += 1
+
+
+def histogram_snapshot() -> dict:
+    """Return ``{stage: {"buckets", "sum", "count"}}`` with cumulative bucket counts."""
+    with _metrics_lock:
+        return {stage: dict(h, buckets=list(h["buckets"])) for stage, h in _histograms.items()}
+
+
+@contextlib.contextmanager
+def span(stage: str):
+    """Time a block (or, as a decorator, a function) into the ``stage``
+    histogram. A block that raises is counted in ``{stage}_errors_total``
+    and not timed.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        increment(f"{stage}_errors_total")
+        raise
+    observe(stage, time.perf_counter() - start)
+
+
+def render_metrics() -> str:
+    """All counters and stage histograms in the Prometheus text format."""
+    lines = []
+    for name, value in sorted(metrics_snapshot().items()):
+        lines += [f"# TYPE {METRICS_PREFIX}{name} counter", f"{METRICS_PREFIX}{name} {value:g}"]
+    histograms = histogram_snapshot()
+    if histograms:
+        name = f"{METRICS_PREFIX}stage_duration_seconds"
+        lines.append(f"# TYPE {name} histogram")
+        for stage, h in sorted(histograms.items()):
+            for bound, count in zip(LATENCY_BUCKETS, h["buckets"]):
+                lines.append(f'{name}_bucket{{stage="{stage}",le="{bound:g}"}} {count}')
+            lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {h["count"]}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {h["sum"]:.6f}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {h["count"]}')
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render_metrics().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@st.cache_resource
+def start_metrics_server(port: int = METRICS_PORT, host: str = METRICS_HOST) -> ThreadingHTTPServer | None:
+    """Serve ``/metrics`` from a background thread, once per process."""
+    try:
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+    except OSError as e:
+        print(f"Metrics endpoint not started on {host}:{port}: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+
+# ============================================================
+# RESULT CACHE
+# ============================================================
+
+def content_key(source, params: dict, chunk_size: int = 1024 * 1024) -> str:
+    """Hash audio (bytes or a seekable file-like) together with request params.
+    The audio is fed to the hash in fixed-size pieces so large files are never
+    copied; file-like sources are rewound afterwards.
+    """
+    digest = hashlib.sha256()
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        view = memoryview(source)
+        for i in range(0, len(view), chunk_size):
+            digest.update(view[i:i + chunk_size])
+    else:
+        position = source.tell()
+        while piece := source.read(chunk_size):
+            digest.update(piece)
+        source.seek(position)
+    digest.update(json.dumps(params, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+class MemoryCache:
+    """Thread-safe LRU cache of ``bytes`` values bounded by total size.
+    With ``ttl_seconds``, entries older than that are treated as misses.
+    """
+
+    def __init__(self, max_bytes: int, ttl_seconds: float | None = None):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.size = 0
+        self._items: OrderedDict[str, tuple] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            value, stored = item
+            if self.ttl_seconds is not None and time.time() - stored > self.ttl_seconds:
+                del self._items[key]
+                self.size -= len(value)
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: bytes) -> None:
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.size -= len(old[0])
+            self._items[key] = (value, time.time())
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, (evicted, _) = self._items.popitem(last=False)
+                self.size -= len(evicted)
+
+
+class EncryptedDiskCache:
+    """Fernet-encrypted file-per-key cache with TTL and size eviction.
+    Entries older than ``ttl_seconds`` are treated as misses and removed;
+    expired files are also swept periodically on write. When the files
+    exceed ``max_bytes`` the least recently used (oldest mtime; hits touch
+    it) are removed down to ``SWEEP_TARGET`` of the budget, so the next
+    writes do not each sweep again.
+    """
+
+    SWEEP_INTERVAL_SECONDS = 300.0
+    SWEEP_TARGET = 0.9
+
+    def __init__(self, directory: str, key: str, ttl_seconds: float, max_bytes: int | None = None):
+        from cryptography.fernet import Fernet
+
+        self.directory = directory
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._fernet = Fernet(key)
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        # Estimated between sweeps; other processes may share the directory
+        self.size = 0
+        self.sweep()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.bin")
+
+    def get(self, key: str):
+        from cryptography.fernet import InvalidToken
+
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                token = f.read()
+        except FileNotFoundError:
+            return None
+        try:
+            value = self._fernet.decrypt(token, ttl=int(self.ttl_seconds))
+        except InvalidToken:
+            # Expired, corrupted or written with another key
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+            return None
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(path)
+        return value
+
+    def set(self, key: str, value: bytes) -> None:
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        token = self._fernet.encrypt(value)
+        with open(tmp_path, "wb") as f:
+            f.write(token)
+        os.replace(tmp_path, path)
+        self.size += len(token)
+        over_budget = self.max_bytes is not None and self.size > self.max_bytes
+        if over_budget or time.time() - self._last_sweep > self.SWEEP_INTERVAL_SECONDS:
+            self.sweep()
+
+    def sweep(self) -> None:
+        """Delete entries whose age exceeds the TTL, then the least recently
+        used while the rest is over ``max_bytes``.
+        """
+        self._last_sweep = time.time()
+        cutoff = self._last_sweep - self.ttl_seconds
+        entries = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".bin"):
+                continue
+            with contextlib.suppress(FileNotFoundError):
+                stat = entry.stat()
+                if stat.st_mtime < cutoff:
+                    os.remove(entry.path)
+                else:
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        self.size = sum(size for _, size, _ in entries)
+        if self.max_bytes is None or self.size <= self.max_bytes:
+            return
+        entries.sort()
+        for _, size, path in entries:
+            if self.size <= self.max_bytes * self.SWEEP_TARGET:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+            self.size -= size
+
+
+# Large payloads (recordings) are encrypted in records of this much plaintext,
+# so encrypting or decrypting one never needs more than a record of scratch.
+ENCRYPTED_CHUNK_BYTES = 1024 * 1024
+
+
+def fixed_chunks(data, size: int):
+    """Yield ``data`` in pieces of exactly ``size`` bytes (the last may be
+    shorter). ``data`` is a buffer, which is sliced without copying, a
+    file-like object or an iterable of byte pieces.
+    """
+    if isinstance(data, (bytes, bytearray, memoryview, mmap.mmap)):
+        view = memoryview(data).cast("B")
+        for i in range(0, len(view), size):
+            yield view[i:i + size]
+        return
+    pending = bytearray()
+    for piece in iter_file_chunks(data, size) if hasattr(data, "read") else data:
+        pending += piece
+        while len(pending) >= size:
+            yield bytes(pending[:size])
+            del pending[:size]
+    if pending:
+        yield bytes(pending)
+
+
+class ChunkedCipher:
+    """AES-GCM file encryption in records of ``chunk_bytes`` plaintext, for
+    payloads too large to encrypt in one piece. Each record is a random nonce,
+    the ciphertext and its tag, with the record's index and a last-record flag
+    authenticated alongside, so records cannot be reordered or cut off
+    unnoticed (``InvalidTag``).
+    """
+
+    NONCE_BYTES = 12
+    TAG_BYTES = 16
+
+    def __init__(self, key: bytes, chunk_bytes: int = ENCRYPTED_CHUNK_BYTES):
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+        self._aead = AESGCM(key)
+        self.chunk_bytes = chunk_bytes
+        self.record_bytes = chunk_bytes + self.NONCE_BYTES + self.TAG_BYTES
+
+    @staticmethod
+    def _associated(index: int, last: bool) -> bytes:
+        return struct.pack("<Q?", index, last)
+
+    def write(self, path: str, data) -> tuple[str, int]:
+        """Encrypt ``data`` (anything ``fixed_chunks`` takes) to ``path``.
+        Returns the SHA-256 hex digest and size of the plaintext.
+        """
+        digest = hashlib.sha256()
+        size = index = 0
+        pending = None
+        with open(path, "wb") as f:
+            # One piece behind, so the last record is known when it is sealed
+            for piece in fixed_chunks(data, self.chunk_bytes):
+                if pending is not None:
+                    f.write(self._seal(index, pending, last=False))
+                    index += 1
+                digest.update(piece)
+                size += len(piece)
+                pending = piece
+            f.write(self._seal(index, b"" if pending is None else pending, last=True))
+        return digest.hexdigest(), size
+
+    def _seal(self, index: int, plaintext, last: bool) -> bytes:
+        nonce = os.urandom(self.NONCE_BYTES)
+        return nonce + self._aead.encrypt(nonce, plaintext, self._associated(index, last))
+
+    def records(self, size: int) -> int:
+        """Number of records in a file of ``size`` bytes."""
+        return max(1, -(-size // self.record_bytes))
+
+    def chunks(self, f):
+        """Decrypt the open file ``f`` a record at a time, closing it when done."""
+        from cryptography.exceptions import InvalidTag
+
+        with f:
+            count = self.records(os.fstat(f.fileno()).st_size)
+            for index in range(count):
+                record = f.read(self.record_bytes)
+                if len(record) < self.NONCE_BYTES + self.TAG_BYTES:
+                    raise InvalidTag()
+                nonce = record[:self.NONCE_BYTES]
+                yield self._aead.decrypt(nonce, record[self.NONCE_BYTES:], self._associated(index, index == count - 1))
+
+    def read(self, path: str) -> bytearray:
+        """The whole plaintext of ``path``, decrypted into one preallocated buffer."""
+        f = open(path, "rb")
+        size = os.fstat(f.fileno()).st_size
+        out = bytearray(max(0, size - self.records(size) * (self.NONCE_BYTES + self.TAG_BYTES)))
+        position = 0
+        for piece in self.chunks(f):
+            out[position:position + len(piece)] = piece
+            position += len(piece)
+        return out
+
+
+class ResultCache:
+    """JSON result cache over one or more byte backends, fastest first.
+    Hits in a slower tier are promoted into the faster ones. Hits and misses
+    are counted as ``<name>_cache_hits_total`` / ``<name>_cache_misses_total``.
+    """
+
+    def __init__(self, name: str, backends: list):
+        self.name = name
+        self.backends = backends
+
+    def get(self, key: str):
+        for i, backend in enumerate(self.backends):
+            value = backend.get(key)
+            if value is not None:
+                for faster in self.backends[:i]:
+                    faster.set(key, value)
+                increment(f"{self.name}_cache_hits_total")
+                return json.loads(value)
+        increment(f"{self.name}_cache_misses_total")
+        return None
+
+    def set(self, key: str, result) -> None:
+        value = json.dumps(result).encode()
+        for backend in self.backends:
+            backend.set(key, value)
+
+
+def build_cache(name: str, max_bytes: int) -> ResultCache:
+    """Memory tier plus, when configured, an encrypted disk tier under ``CACHE_DIR``
+    of at most ``CACHE_DISK_MAX_BYTES``. Both tiers expire entries after
+    ``CACHE_TTL_SECONDS``.
+    """
+    backends = [MemoryCache(max_bytes, CACHE_TTL_SECONDS)]
+    encryption_key = get_secret("CACHE_ENCRYPTION_KEY", default=None)
+    if CACHE_DIR and encryption_key:
+        backends.append(EncryptedDiskCache(
+            os.path.join(CACHE_DIR, name), encryption_key, CACHE_TTL_SECONDS, CACHE_DISK_MAX_BYTES,
+        ))
+    return ResultCache(name, backends)
+
+
+@st.cache_resource
+def get_transcription_cache() -> ResultCache:
+    """Process-wide transcription cache shared by every session."""
+    return build_cache("transcription", TRANSCRIPT_CACHE_MAX_BYTES)
+
+
+@st.cache_resource
+def get_note_cache() -> ResultCache:
+    """Process-wide SOAP note cache shared by every session."""
+    return build_cache("soap_note", NOTE_CACHE_MAX_BYTES)
+
+
+# ============================================================
+# ARTIFACT STORE
+# ============================================================
+
+class ArtifactStore:
+    """Reference-counted store for large session artifacts, addressed by the
+    SHA-256 of their content, so identical artifacts are kept once.
+    Each owner (a browser session) holds counted references; an artifact is
+    deleted with its last reference. The most recently used ``memory_bytes``
+    stay in memory and the rest is spilled to disk, Fernet-encrypted with a
+    key that only this process knows. Artifacts of ``stream_bytes`` or more,
+    and file-like ones, never enter memory: they are encrypted straight to
+    disk with a ``ChunkedCipher`` and read back a chunk at a time.
+    Owners not seen for ``idle_seconds``
+    have all their references released, swept periodically on use.
+    The lock only guards the bookkeeping: encryption and file I/O run
+    outside it, so one session's spill never stalls another's read.
+    """
+
+    SWEEP_INTERVAL_SECONDS = 60.0
+
+    def __init__(self, memory_bytes: int, directory: str, idle_seconds: float,
+                 stream_bytes: int = ARTIFACT_STREAM_MIN_BYTES):
+        from cryptography.fernet import Fernet
+
+        self.memory_bytes = memory_bytes
+        self.stream_bytes = stream_bytes
+        self.idle_seconds = idle_seconds
+        if directory:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+        # One directory per process: spilled files are unreadable to any other
+        self.directory = tempfile.mkdtemp(prefix="moonlight-artifacts-", dir=directory or None)
+        weakref.finalize(self, shutil.rmtree, self.directory, ignore_errors=True)
+        self._fernet = Fernet(Fernet.generate_key())
+        self._cipher = ChunkedCipher(os.urandom(32))
+        self._memory: OrderedDict[str, bytes] = OrderedDict()
+        self._memory_size = 0
+        self._spilling: dict[str, bytes] = {}  # handle -> data being written out
+        self._spilled: dict[str, tuple[str, int]] = {}  # handle -> (file, size)
+        self._streamed: dict[str, tuple[str, int]] = {}  # handle -> (file, size)
+        self._files = 0
+        self._refs: dict[str, int] = {}
+        self._owners: dict[str, dict[str, int]] = {}
+        self._seen: dict[str, float] = {}
+        self._last_sweep = time.time()
+        self._lock = threading.Lock()
+
+    def put(self, owner: str, data) -> str:
+        """Add a reference from ``owner`` to ``data`` (a string, a buffer or a
+        file-like object) and return its handle.
+        """
+        if isinstance(data, str):
+            data = data.encode()
+        if hasattr(data, "read") or memoryview(data).nbytes >= self.stream_bytes:
+            return self._put_streamed(owner, data)
+        data = bytes(data)
+        handle = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            spills = self._remember(handle, data) if self._add_ref(owner, handle) == 1 else []
+        self._spill(spills)
+        self._maybe_sweep()
+        return handle
+
+    def _put_streamed(self, owner: str, data) -> str:
+        """``put`` for large artifacts: encrypted to a file of their own as they
+        are hashed, which is dropped again if the content is already stored.
+        """
+        with self._lock:
+            self._files += 1
+            path = os.path.join(self.directory, f"{self._files}.bin")
+        handle, size = self._cipher.write(path, data)
+        with self._lock:
+            stored = self._add_ref(owner, handle) == 1
+            if stored:
+                self._streamed[handle] = (path, size)
+        if stored:
+            increment("artifact_streamed_bytes_total", size)
+        else:
+            self._remove([path])
+        self._maybe_sweep()
+        return handle
+
+    def _add_ref(self, owner: str, handle: str) -> int:
+        """Count a reference from ``owner``; returns the artifact's total. Call with the lock held."""
+        self._seen[owner] = time.time()
+        refs = self._owners.setdefault(owner, {})
+        refs[handle] = refs.get(handle, 0) + 1
+        self._refs[handle] = self._refs.get(handle, 0) + 1
+        return self._refs[handle]
+
+    def get(self, handle: str) -> bytes:
+        """An artifact's content (for a streamed artifact, a fresh ``bytearray``
+        each call). Raises ``KeyError`` once it has been released.
+        """
+        with self._lock:
+            data = self._memory.get(handle)
+            if data is not None:
+                self._memory.move_to_end(handle)
+                return data
+            data = self._spilling.get(handle)
+            if data is not None:
+                return data
+            streamed = handle in self._streamed
+            if not streamed and handle not in self._spilled:
+                raise KeyError(handle)
+            path = (self._streamed if streamed else self._spilled)[handle][0]
+        if streamed:
+            return self._open(handle, path, self._cipher.read)
+        try:
+            with open(path, "rb") as f:
+                data = self._fernet.decrypt(f.read())
+        except FileNotFoundError:
+            # Released while we were reading
+            raise KeyError(handle) from None
+        with self._lock:
+            spills = self._remember(handle, data) if handle in self._refs and handle not in self._memory else []
+        self._spill(spills)
+        return data
+
+    def chunks(self, handle: str):
+        """An artifact's content as an iterable of pieces, so a streamed
+        artifact is passed on a chunk at a time instead of whole. Raises
+        ``KeyError`` once it has been released.
+        """
+        with self._lock:
+            streamed = self._streamed.get(handle)
+        if streamed is None:
+            return [self.get(handle)]
+        return self._open(handle, streamed[0], lambda path: self._cipher.chunks(open(path, "rb")))
+
+    @staticmethod
+    def _open(handle: str, path: str, read):
+        try:
+            return read(path)
+        except FileNotFoundError:
+            # Released while we were opening it
+            raise KeyError(handle) from None
+
+    def release(self, owner: str, handle: str) -> None:
+        """Drop one of ``owner``'s references to ``handle``."""
+        with self._lock:
+            path = self._release(owner, handle, 1)
+        self._remove([path])
+
+    def release_owner(self, owner: str) -> None:
+        """Drop all of ``owner``'s references."""
+        with self._lock:
+            paths = [self._release(owner, handle, count) for handle, count in list(self._owners.get(owner, {}).items())]
+            self._seen.pop(owner, None)
+        self._remove(paths)
+
+    def holds(self, owner: str) -> bool:
+        """Whether ``owner`` still references any artifact."""
+        with self._lock:
+            return owner in self._owners
+
+    def touch(self, owner: str) -> None:
+        """Mark ``owner`` as active, postponing its idle eviction."""
+        with self._lock:
+            self._seen[owner] = time.time()
+        self._maybe_sweep()
+
+    def evict_idle(self) -> int:
+        """Release everything held by owners idle for longer than ``idle_seconds``."""
+        self._last_sweep = time.time()
+        cutoff = self._last_sweep - self.idle_seconds
+        with self._lock:
+            idle = [owner for owner, seen in self._seen.items() if seen < cutoff]
+        for owner in idle:
+            self.release_owner(owner)
+        if idle:
+            increment("artifact_owners_evicted_total", len(idle))
+        return len(idle)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "artifacts": len(self._refs),
+                "owners": len(self._owners),
+                "memory_bytes": self._memory_size,
+                "disk_bytes": sum(size for _, size in (*self._spilled.values(), *self._streamed.values())),
+            }
+
+    def _remember(self, handle: str, data: bytes) -> list:
+        """Cache ``data`` in memory and return the least recently used artifacts
+        that are over budget and must be written out with ``_spill``. Call with
+        the lock held.
+        """
+        self._memory[handle] = data
+        self._memory_size += len(data)
+        spills = []
+        while self._memory_size > self.memory_bytes:
+            evicted, evicted_data = self._memory.popitem(last=False)
+            self._memory_size -= len(evicted_data)
+            if evicted not in self._spilled and evicted not in self._spilling:
+                self._spilling[evicted] = evicted_data
+                self._files += 1
+                spills.append((evicted, evicted_data, os.path.join(self.directory, f"{self._files}.bin")))
+        return spills
+
+    def _spill(self, spills: list) -> None:
+        """Encrypt and write out artifacts evicted from memory. Until written
+        they are served from ``_spilling``.
+        """
+        for handle, data, path in spills:
+            with open(path, "wb") as f:
+                f.write(self._fernet.encrypt(data))
+            with self._lock:
+                # Unless it was released (and perhaps stored again) meanwhile
+                kept = self._spilling.get(handle) is data
+                if kept:
+                    del self._spilling[handle]
+                    self._spilled[handle] = (path, len(data))
+            if kept:
+                increment("artifact_spilled_bytes_total", len(data))
+            else:
+                self._remove([path])
+
+    def _release(self, owner: str, handle: str, count: int):
+        """Drop ``count`` references; returns the file to remove, if any. Call with the lock held."""
+        refs = self._owners.get(owner)
+        if not refs or handle not in refs:
+            return None
+        count = min(count, refs[handle])
+        refs[handle] -= count
+        if not refs[handle]:
+            del refs[handle]
+        if not refs:
+            del self._owners[owner]
+        self._refs[handle] -= count
+        if self._refs[handle]:
+            return None
+        del self._refs[handle]
+        data = self._memory.pop(handle, None)
+        if data is not None:
+            self._memory_size -= len(data)
+        self._spilling.pop(handle, None)
+        stored = self._spilled.pop(handle, None) or self._streamed.pop(handle, None)
+        return stored and stored[0]
+
+    @staticmethod
+    def _remove(paths: list) -> None:
+        for path in paths:
+            if path:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+
+    def _maybe_sweep(self) -> None:
+        if time.time() - self._last_sweep > self.SWEEP_INTERVAL_SECONDS:
+            self.evict_idle()
+
+
+@st.cache_resource
+def get_artifact_store() -> ArtifactStore:
+    """Process-wide artifact store shared by every session."""
+    return ArtifactStore(ARTIFACT_MEMORY_MAX_BYTES, ARTIFACT_DIR, ARTIFACT_IDLE_SECONDS, ARTIFACT_STREAM_MIN_BYTES)
+
+
+# ============================================================
+# RATE LIMITING
+# ============================================================
+
+@st.cache_resource
+def rate_limited_error() -> type:
+    """The ``RateLimited`` class, defined once per process. Cached limiters
+    catch it while code from later reruns raises it, so a class defined anew
+    on every rerun would slip past their ``except``.
+    """
+
+    class RateLimited(Exception):
+        """The provider throttled a request (429/529); it should be queued again."""
+
+        def __init__(self, retry_after: float | None = None):
+            super().__init__("rate limited")
+            self.retry_after = retry_after
+
+    return RateLimited
+
+
+RateLimited = rate_limited_error()
+
+
+def retry_after_seconds(headers) -> float | None:
+    """Seconds from a ``Retry-After`` header (delta-seconds form), or None."""
+    try:
+        return max(0.0, float(headers.get("retry-after")))
+    except (TypeError, ValueError):
+        return None
+
+
+def reset_seconds(value: str | None) -> float | None:
+    """Seconds until a rate-limit reset given as RFC 3339 time, or as seconds."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value.rstrip("s")))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp() - time.time())
+    except ValueError:
+        return None
+
+
+class TokenBucket:
+    """Continuously refilling bucket holding up to ``per_minute`` units."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.level = per_minute
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Seconds until ``amount`` units are available (0 if they are now)."""
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60.0)
+        self.updated = now
+        if now < self.paused_until:
+            return self.paused_until - now
+        # A request bigger than the whole bucket waits for a full bucket
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) * 60.0 / self.capacity
+
+
+class RateLimiter:
+    """Shared request-rate, token-rate and concurrency limiter for one API.
+    ``call`` waits (queues) until a request fits both buckets and the current
+    concurrency limit. The limit adapts AIMD-style: it grows by one per
+    ``limit`` successful calls and halves when the provider throttles, which
+    also pauses new requests for the provider's Retry-After. ``observe``
+    feeds response headers in, so the buckets track the provider's actual
+    quota and remaining allowance (shared with other processes on the key).
+    """
+
+    # Response header prefixes carrying limit / remaining / reset per bucket
+    HEADER_PREFIXES = {
+        "requests": ("anthropic-ratelimit-requests-", "x-ratelimit-{}-requests"),
+        "tokens": ("anthropic-ratelimit-input-tokens-", "x-ratelimit-{}-tokens"),
+    }
+
+    def __init__(self, name: str, rpm: float, tpm: float | None = None, max_concurrency: int = 16,
+                 max_wait: float = RATE_LIMIT_MAX_WAIT_SECONDS):
+        self.name = name
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.max_concurrency = max_concurrency
+        self.concurrency = max(1.0, max_concurrency / 2)
+        self.in_flight = 0
+        self.max_wait = max_wait
+        self._cond = threading.Condition()
+
+    def acquire(self, tokens: float = 0, deadline: float | None = None) -> None:
+        """Block until a request of ``tokens`` input tokens may be sent.
+        Raises once ``max_wait`` seconds (or the monotonic ``deadline``) have passed.
+        """
+        start = time.monotonic()
+        if deadline is None:
+            deadline = start + self.max_wait
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                wait = self.requests.wait_time(1, now)
+                if self.tokens is not None and tokens:
+                    wait = max(wait, self.tokens.wait_time(tokens, now))
+                if wait == 0 and self.in_flight < int(self.concurrency):
+                    break
+                if now > deadline:
+                    raise self.timed_out()
+                self._cond.wait(timeout=min(wait, 1.0) if wait else 1.0)
+            self.requests.level -= 1
+            if self.tokens is not None:
+                self.tokens.level -= tokens
+            self.in_flight += 1
+        waited = time.monotonic() - start
+        if waited > 0.001:
+            increment(f"{self.name}_rate_limit_wait_seconds_total", waited)
+
+    def timed_out(self) -> RuntimeError:
+        return RuntimeError(f"{self.name} is still rate limited after {self.max_wait:.0f} s; please retry later")
+
+    def release(self, success: bool = True) -> None:
+        """Return a slot taken by ``acquire``; success grows the concurrency limit."""
+        with self._cond:
+            self.in_flight -= 1
+            if success:
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+            self._cond.notify_all()
+
+    def settle(self, estimated: float, actual: float) -> None:
+        """Correct the token bucket once a call's real input token count is known."""
+        if self.tokens is not None:
+            with self._cond:
+                self.tokens.level += estimated - actual
+
+    def call(self, fn, tokens: float = 0, hold: bool = False):
+        """Run ``fn()`` within the limits, queueing it again whenever it raises ``RateLimited``.
+        ``max_wait`` bounds the whole call, however many times it is queued.
+        With ``hold``, the slot is kept after ``fn`` returns (for a response
+        that is still streaming) and the caller must ``release`` it.
+        """
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            self.acquire(tokens, deadline)
+            try:
+                result = fn()
+            except RateLimited as e:
+                increment(f"{self.name}_requeued_total")
+                self.release(success=False)
+                if time.monotonic() > deadline:
+                    raise self.timed_out() from e
+                continue
+            except BaseException:
+                self.release(success=False)
+                raise
+            if not hold:
+                self.release()
+            return result
+
+    def observe(self, headers, status_code: int = 200) -> None:
+        """Update the buckets from a response; throttle on 429 or 529 (overloaded)."""
+        with self._cond:
+            for bucket_name, (prefix, generic) in self.HEADER_PREFIXES.items():
+                bucket = getattr(self, bucket_name)
+                if bucket is None:
+                    continue
+                limit = headers.get(f"{prefix}limit") or headers.get(generic.format("limit"))
+                remaining = headers.get(f"{prefix}remaining") or headers.get(generic.format("remaining"))
+                with contextlib.suppress(TypeError, ValueError):
+                    # A new limit keeps the amount already used this minute
+                    bucket.level += float(limit) - bucket.capacity
+                    bucket.capacity = float(limit)
+                with contextlib.suppress(TypeError, ValueError):
+                    bucket.wait_time(0, time.monotonic())
+                    # Responses arrive out of order, so a header can only lower the level
+                    bucket.level = min(bucket.level, float(remaining))
+                    if bucket.level < 1:
+                        reset = reset_seconds(headers.get(f"{prefix}reset") or headers.get(generic.format("reset")))
+                        if reset:
+                            bucket.paused_until = max(bucket.paused_until, time.monotonic() + reset)
+            if status_code in (429, 529):
+                increment(f"{self.name}_throttled_total")
+                self.concurrency = max(1.0, self.concurrency / 2)
+                pause = retry_after_seconds(headers) or 1.0
+                self.requests.paused_until = max(self.requests.paused_until, time.monotonic() + pause)
+            self._cond.notify_all()
+
+
+RATE_LIMITS = {
+    "deepgram": {"rpm": DEEPGRAM_RPM, "max_concurrency": DEEPGRAM_CONCURRENCY_LIMIT},
+    "anthropic": {"rpm": ANTHROPIC_RPM, "tpm": ANTHROPIC_ITPM, "max_concurrency": ANTHROPIC_CONCURRENCY_LIMIT},
+}
+
+
+@st.cache_resource
+def get_rate_limiter(name: str) -> RateLimiter:
+    """Process-wide limiter for one upstream API (see ``RATE_LIMITS``)."""
+    return RateLimiter(name, **RATE_LIMITS[name])
+
+
+@contextlib.contextmanager
+def anthropic_throttling():
+    """Turn the SDK's 429 / 529 errors into ``RateLimited`` so the call is queued again."""
+    try:
+        yield
+    except APIStatusError as e:
+        if e.status_code in (429, 529):
+            raise RateLimited(retry_after_seconds(e.response.headers)) from e
+        raise
+
+
+def observe_anthropic_response(response) -> None:
+    """httpx response hook: feed every Anthropic response into its rate limiter."""
+    get_rate_limiter("anthropic").observe(response.headers, response.status_code)
+
+
+# ============================================================
+# RETRIES AND HEDGING
+# ============================================================
+
+def backoff_delays(base: float = RETRY_BASE_SECONDS, cap: float = RETRY_MAX_SECONDS):
+    """Yield decorrelated-jitter delays: each is drawn between ``base`` and
+    three times the previous one, capped at ``cap``, so clients that failed
+    together do not retry in lockstep.
+    """
+    delay = base
+    while True:
+        delay = min(cap, random.uniform(base, delay * 3))
+        yield delay
+
+
+def is_transient(error: Exception) -> bool:
+    """Whether a failed request is safe and worth sending again."""
+    if isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout, httpx.RemoteProtocolError)):
+        return True
+    return isinstance(error, httpx.HTTPStatusError) and error.response.status_code >= 500
+
+
+def call_with_retries(fn, name: str, max_retries: int, retryable=is_transient):
+    """Call ``fn()``, retrying up to ``max_retries`` times on ``retryable`` errors."""
+    delays = backoff_delays()
+    for attempt in range(max_retries + 1):
+        try:
+            return fn()
+        except Exception as e:
+            if attempt == max_retries or not retryable(e):
+                raise
+            delay = next(delays)
+            increment(f"{name}_retries_total")
+            print(f"{name} request failed ({type(e).__name__}), retry {attempt + 1} of {max_retries} in {delay:.1f} s")
+            time.sleep(delay)
+
+
+class LatencyWindow:
+    """The most recent latencies of one kind of request."""
+
+    def __init__(self, size: int = 200):
+        self.samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float) -> None:
+        with self._lock:
+            self.samples.append(seconds)
+
+    def percentile(self, q: float, default: float, min_samples: int = HEDGE_MIN_SAMPLES) -> float:
+        """The ``q``th percentile, or ``default`` until ``min_samples`` are recorded."""
+        with self._lock:
+            if len(self.samples) < min_samples:
+                return default
+            return float(np.percentile(self.samples, q))
+
+
+@st.cache_resource
+def get_latency_window(name: str) -> LatencyWindow:
+    return LatencyWindow()
+
+
+@st.cache_resource
+def get_hedge_executor() -> ThreadPoolExecutor:
+    """Threads for hedged requests; a losing request finishes in the background."""
+    return ThreadPoolExecutor(max_workers=2 * DEEPGRAM_MAX_CONNECTIONS, thread_name_prefix="hedge")
+
+
+def hedged(fn, name: str, after: float):
+    """Call ``fn()``; if it has not returned after ``after`` seconds, start a
+    second call and return whichever succeeds first. Only for idempotent
+    requests: both may complete.
+    """
+    executor = get_hedge_executor()
+    first = executor.submit(fn)
+    done, _ = wait([first], timeout=after)
+    if done:
+        return first.result()
+    increment(f"{name}_hedged_total")
+    second = executor.submit(fn)
+    pending, error = {first, second}, None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                if future is second:
+                    increment(f"{name}_hedge_wins_total")
+                return future.result()
+            error = future.exception()
+    raise error
+
+
+# ============================================================
+# HTTP CLIENTS
+# ============================================================
+
+@st.cache_resource
+def get_deepgram_client(
+    max_connections: int = DEEPGRAM_MAX_CONNECTIONS,
+    max_keepalive_connections: int = DEEPGRAM_MAX_KEEPALIVE,
+    keepalive_expiry: float = DEEPGRAM_KEEPALIVE_EXPIRY,
+) -> httpx.Client:
+    """Return the process-wide Deepgram HTTP client.
+    ``st.cache_resource`` keeps a single instance per server process, so every
+    session and rerun reuses the same keep-alive pool instead of paying a new
+    TCP + TLS handshake per transcription. HTTP/2 is negotiated when the
+    server supports it.
+    """
+    limits = httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=max_keepalive_connections,
+        keepalive_expiry=keepalive_expiry,
+    )
+    return httpx.Client(http2=True, limits=limits, timeout=httpx.Timeout(600.0, connect=30.0))
+
+
+@st.cache_resource
+def get_anthropic_client(
+    max_connections: int = ANTHROPIC_MAX_CONNECTIONS,
+    max_keepalive_connections: int = ANTHROPIC_MAX_KEEPALIVE,
+    keepalive_expiry: float = ANTHROPIC_KEEPALIVE_EXPIRY,
+    timeout: float = ANTHROPIC_TIMEOUT,
+) -> Anthropic:
+    """Return the process-wide Anthropic client.
+    The client (and its httpx pool) is thread-safe, so one instance serves
+    every session and background job without a new TLS handshake per note.
+    """
+    # Use Streamlit secrets for API key (works locally and on Streamlit Cloud)
+    api_key = get_secret("ANTHROPIC_API_KEY")
+    # The SDK may ship its own httpx flavour, so build the pool limits with the
+    # same class as its defaults rather than with the httpx imported here
+    limits = type(DEFAULT_CONNECTION_LIMITS)(
+        max_connections=max_connections,
+        max_keepalive_connections=max_keepalive_connections,
+        keepalive_expiry=keepalive_expiry,
+    )
+    # No SDK retries: a 429 goes straight to the rate limiter, which queues it
+    return Anthropic(
+        api_key=api_key,
+        max_retries=0,
+        http_client=DefaultHttpxClient(limits=limits, event_hooks={"response": [observe_anthropic_response]}),
+        timeout=AnthropicTimeout(timeout, connect=ANTHROPIC_CONNECT_TIMEOUT),
+    )
+
+
 # ============================================================
 # TRANSCRIPTION MODULE
 # ============================================================
 
-def transcribe_audio_sync(audio_bytes: bytes, mimetype: str = "audio/wav") -> dict:
-    """Transcribe audio bytes using Deepgram's REST API with a longer timeout.
-    This bypasses the Deepgram SDK's default timeout limits for large files.
-    Returns a dict with ``transcript`` and ``confidence`` or raises an error.
+DEEPGRAM_PARAMS = {
+    "model": "nova-2",
+    "smart_format": "true",
+    "punctuate": "true",
+    "diarize": "true",
+    "utterances": "true",
+}
+
+
+# Upload bodies from files and iterators are sent in pieces of this size, so
+# peak memory per upload stays bounded regardless of recording length.
+STREAM_CHUNK_BYTES = 256 * 1024
+
+
+def iter_file_chunks(source, chunk_size: int = STREAM_CHUNK_BYTES):
+    """Yield a file-like object's remaining content in fixed-size pieces."""
+    while piece := source.read(chunk_size):
+        yield piece
+
+
+def remaining_size(source):
+    """Bytes left in a seekable file-like object, or ``None`` if unknown."""
+    try:
+        position = source.tell()
+        end = source.seek(0, os.SEEK_END)
+        source.seek(position)
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return None
+    return end - position
+
+
+def upload_body(audio):
+    """Return ``(make_content, size, replayable)`` for a request body.
+    ``make_content()`` returns a fresh body each call, so a throttled or
+    failed upload can be sent again: buffers are re-sliced and seekable files
+    rewound. An iterator or unseekable file can only be sent once.
+    """
+    if isinstance(audio, bytes):
+        return (lambda: audio), len(audio), True
+    if isinstance(audio, (bytearray, memoryview, mmap.mmap)):
+        view = memoryview(audio).cast("B")
+        return (
+            lambda: (bytes(view[i:i + STREAM_CHUNK_BYTES]) for i in range(0, len(view), STREAM_CHUNK_BYTES))
+        ), len(view), True
+    size = remaining_size(audio) if hasattr(audio, "read") else None
+    if size is not None:
+        start = audio.tell()
+
+        def rewound():
+            audio.seek(start)
+            return iter_file_chunks(audio)
+        return rewound, size, True
+    if hasattr(audio, "read"):
+        audio = iter_file_chunks(audio)
+
+    sent = []
+
+    def once():
+        if sent:
+            raise RuntimeError("Cannot resend a streamed upload")
+        sent.append(True)
+        return audio
+    return once, None, False
+
+
+def metered_upload(content, marks: dict):
+    """Yield a request body (bytes or an iterable of bytes), counting the
+    bytes sent and setting ``marks["uploaded"]`` once the last piece is taken.
+    """
+    for piece in [content] if isinstance(content, bytes) else content:
+        increment("deepgram_upload_bytes_total", len(piece))
+        yield piece
+    marks["uploaded"] = time.perf_counter()
+
+
+def request_transcription(audio, mimetype: str = "audio/wav") -> dict:
+    """POST audio to Deepgram and return the raw response JSON.
+    ``audio`` is ``bytes``, a buffer (memoryview, mmap), a binary file-like
+    object, or an iterator of ``bytes`` pieces; all but ``bytes`` are streamed
+    without being copied whole. Transient failures are retried (and short
+    clips optionally hedged) before this raises ``RuntimeError`` with a
+    UI-ready message.
     """
     # Use Streamlit secrets for API key (works locally and on Streamlit Cloud)
-    api_key = st.secrets["DEEPGRAM_API_KEY"]
+    api_key = get_secret("DEEPGRAM_API_KEY")
 
-    url = "https://api.deepgram.com/v1/listen"
+    url = DEEPGRAM_URL
     headers = {
         "Authorization": f"Token {api_key}",
         "Content-Type": mimetype,
     }
-    params = {
-        "model": "nova-2",
-        "smart_format": "true",
-        "punctuate": "true",
-        "diarize": "true",
-        "utterances": "true",
-    }
+    make_content, size, replayable = upload_body(audio)
+    short_clip = size is not None and size <= HEDGE_MAX_BYTES
+    if DEEPGRAM_HEDGE and short_clip and hasattr(audio, "read"):
+        # Two requests in flight cannot share one file position
+        make_content, size, replayable = upload_body(audio.read())
+    if size is not None:
+        # Known length: send Content-Length instead of chunked transfer encoding
+        headers["Content-Length"] = str(size)
     # Increased timeout for larger audio files (10 minutes total, 30 seconds connect)
     timeout = httpx.Timeout(600.0, connect=30.0)
+    audio_size_mb = (size or 0) / (1024 * 1024)
+    try:
+        # Log audio file size for debugging
+        print(f"Transcribing audio file: {audio_size_mb:.2f} MB" if size is not None else "Transcribing audio stream")
+        
+        client = get_deepgram_client()
+        limiter = get_rate_limiter("deepgram")
+
+        def post():
+            marks = {}
+            start = time.perf_counter()
+            content = metered_upload(make_content(), marks)
+            response = client.post(url, params=DEEPGRAM_PARAMS, headers=headers, content=content, timeout=timeout)
+            done = time.perf_counter()
+            # Upload ends when httpx takes the last piece of the body; the rest
+            # is Deepgram working (plus the download of a small JSON reply)
+            uploaded = marks.get("uploaded", done)
+            observe("upload", uploaded - start)
+            observe("deepgram_processing", done - uploaded)
+            limiter.observe(response.headers, response.status_code)
+            if response.status_code == 429:
+                raise RateLimited(retry_after_seconds(response.headers))
+            return response
+
+        def attempt():
+            start = time.perf_counter()
+            response = limiter.call(post)
+            response.raise_for_status()
+            if short_clip:
+                get_latency_window("deepgram_short_clip").add(time.perf_counter() - start)
+            return response
+
+        if DEEPGRAM_HEDGE and short_clip:
+            after = get_latency_window("deepgram_short_clip").percentile(95, HEDGE_AFTER_SECONDS)
+            response = call_with_retries(lambda: hedged(attempt, "deepgram", after), "deepgram", DEEPGRAM_MAX_RETRIES)
+        else:
+            response = call_with_retries(attempt, "deepgram", DEEPGRAM_MAX_RETRIES if replayable else 0)
+    except httpx.TimeoutException:
+        increment("deepgram_errors_total")
+        raise RuntimeError(f"Transcription timed out. Audio file may be too large ({audio_size_mb:.2f} MB). Try using a shorter recording or lower quality audio.")
+    except Exception as e:
+        increment("deepgram_errors_total")
+        # Propagate a clear error message for the UI
+        raise RuntimeError(f"Deepgram transcription failed: {e}")
+    with span("decode"):
+        return response.json()
+
+
+# ============================================================
+# WORD TIMINGS
+# ============================================================
+
+class Word:
+    """One word of a ``WordTable``, read from its columns on access."""
+
+    __slots__ = ("table", "index")
+
+    def __init__(self, table: "WordTable", index: int):
+        self.table = table
+        self.index = index
+
+    @property
+    def text(self) -> str:
+        return self.table.word_text(self.index)
+
+    @property
+    def start(self) -> float:
+        return float(self.table.start[self.index])
+
+    @property
+    def end(self) -> float:
+        return float(self.table.end[self.index])
+
+    @property
+    def speaker(self) -> int | None:
+        speaker = int(self.table.speaker[self.index])
+        return None if speaker < 0 else speaker
+
+    @property
+    def confidence(self) -> float:
+        return float(self.table.confidence[self.index])
+
+    def __repr__(self) -> str:
+        return f"Word({self.text!r}, {self.start:.2f}-{self.end:.2f}, speaker={self.speaker})"
+
+
+class Utterance:
+    """A run of consecutive words from one speaker: words ``first``..``stop - 1``."""
+
+    __slots__ = ("table", "first", "stop")
+
+    def __init__(self, table: "WordTable", first: int, stop: int):
+        self.table = table
+        self.first = first
+        self.stop = stop
+
+    @property
+    def speaker(self) -> int | None:
+        return Word(self.table, self.first).speaker
+
+    @property
+    def start(self) -> float:
+        return float(self.table.start[self.first])
+
+    @property
+    def end(self) -> float:
+        return float(self.table.end[self.stop - 1])
+
+    @property
+    def text(self) -> str:
+        return self.table.span_text(self.first, self.stop)
+
+    @property
+    def words(self) -> list:
+        return [Word(self.table, i) for i in range(self.first, self.stop)]
+
+    def __len__(self) -> int:
+        return self.stop - self.first
+
+    def to_dict(self) -> dict:
+        """The ``speaker/start/end/transcript`` dict used in transcription results."""
+        return {"speaker": self.speaker, "start": round(self.start, 3), "end": round(self.end, 3), "transcript": self.text}
+
+
+class WordTable:
+    """Words of a transcription with their timings, speakers and confidences,
+    stored column-wise: one string of the (punctuated) words joined by spaces
+    with an array of their offsets, and a NumPy array per attribute. A
+    90-minute session (~15k words) takes a few hundred KB instead of the
+    megabytes of per-word dicts. Words are in time order; a missing speaker
+    is stored as -1. ``Word`` and ``Utterance`` are views into the columns.
+    """
+
+    __slots__ = ("text", "offsets", "start", "end", "speaker", "confidence", "turns")
+
+    def __init__(self, words: list, start, end, speaker, confidence):
+        self.text = " ".join(words)
+        lengths = np.fromiter((len(w) + 1 for w in words), dtype=np.int32, count=len(words))
+        # offsets[i] is where word i starts; offsets[-1] is one past the end of the text
+        self.offsets = np.concatenate(([0], np.cumsum(lengths, dtype=np.int32)))
+        self.start = np.asarray(start, dtype=np.float32)
+        self.end = np.asarray(end, dtype=np.float32)
+        self.speaker = np.asarray(speaker, dtype=np.int16)
+        self.confidence = np.asarray(confidence, dtype=np.float32)
+        # Index of the first word of each speaker turn
+        self.turns = np.flatnonzero(np.diff(self.speaker, prepend=np.int16(-2)) != 0).astype(np.int32)
+
+    @classmethod
+    def from_words(cls, words: list) -> "WordTable":
+        """Build from Deepgram's per-word dicts."""
+        return cls(
+            [w.get("punctuated_word", w["word"]) for w in words],
+            [w["start"] for w in words],
+            [w["end"] for w in words],
+            [-1 if w.get("speaker") is None else w["speaker"] for w in words],
+            [w.get("confidence", 0.0) for w in words],
+        )
+
+    @classmethod
+    def from_columns(cls, columns: dict) -> "WordTable":
+        """Build from ``to_columns()`` output, e.g. a transcription result's ``words``.
+        Words are cut at the stored offsets, since a word may itself contain a
+        space ("$5 000"); columns cached before offsets were stored are split
+        on spaces.
+        """
+        text, offsets = columns["text"], columns.get("offsets")
+        if offsets is not None:
+            words = [text[offsets[i]:offsets[i + 1] - 1] for i in range(len(offsets) - 1)]
+        else:
+            words = text.split(" ") if text else []
+        return cls(words, columns["start"], columns["end"], columns["speaker"], columns["confidence"])
+
+    @classmethod
+    def from_result(cls, result: dict) -> "WordTable":
+        """The words of a transcription result (empty for results cached without them)."""
+        return cls.from_columns(result.get("words") or {"text": "", "start": [], "end": [], "speaker": [], "confidence": []})
+
+    def to_columns(self) -> dict:
+        """JSON-ready columns, the form transcription results and caches carry."""
+        return {
+            "text": self.text,
+            "offsets": self.offsets.tolist(),
+            "start": np.round(self.start.astype(np.float64), 3).tolist(),
+            "end": np.round(self.end.astype(np.float64), 3).tolist(),
+            "speaker": self.speaker.tolist(),
+            "confidence": np.round(self.confidence.astype(np.float64), 4).tolist(),
+        }
+
+    def __len__(self) -> int:
+        return len(self.start)
+
+    def __getitem__(self, index: int) -> Word:
+        if not -len(self) <= index < len(self):
+            raise IndexError("word index out of range")
+        return Word(self, index % len(self))
+
+    @property
+    def nbytes(self) -> int:
+        """Approximate memory held by the columns."""
+        arrays = (self.offsets, self.start, self.end, self.speaker, self.confidence, self.turns)
+        return len(self.text) + sum(a.nbytes for a in arrays)
+
+    def word_text(self, index: int) -> str:
+        return self.text[self.offsets[index]:self.offsets[index + 1] - 1]
+
+    def span_text(self, first: int, stop: int) -> str:
+        """Words ``first``..``stop - 1`` joined by spaces."""
+        if first >= stop:
+            return ""
+        return self.text[self.offsets[first]:self.offsets[stop] - 1]
+
+    def span(self, start: float | None = None, end: float | None = None) -> tuple:
+        """``(first, stop)`` word indices of the words overlapping ``[start, end)`` seconds."""
+        first = 0 if start is None else int(np.searchsorted(self.end, start, side="right"))
+        stop = len(self) if end is None else int(np.searchsorted(self.start, end, side="left"))
+        return first, max(first, stop)
+
+    def select(self, start: float | None = None, end: float | None = None, speaker: int | None = None) -> np.ndarray:
+        """Indices of the words overlapping ``[start, end)``, optionally from one speaker."""
+        first, stop = self.span(start, end)
+        if speaker is None:
+            return np.arange(first, stop)
+        return first + np.flatnonzero(self.speaker[first:stop] == speaker)
+
+    def words(self, start: float | None = None, end: float | None = None, speaker: int | None = None) -> list:
+        return [Word(self, int(i)) for i in self.select(start, end, speaker)]
+
+    def utterances(self, start: float | None = None, end: float | None = None, speaker: int | None = None) -> list:
+        """Speaker turns overlapping ``[start, end)``, clipped to it, optionally from one speaker."""
+        first, stop = self.span(start, end)
+        if first == stop:
+            return []
+        bounds = self.turns[np.searchsorted(self.turns, first, side="right") - 1:np.searchsorted(self.turns, stop)]
+        starts = np.maximum(bounds, first)
+        stops = np.append(bounds[1:], stop)
+        if speaker is not None:
+            keep = self.speaker[starts] == speaker
+            starts, stops = starts[keep], stops[keep]
+        return [Utterance(self, int(a), int(b)) for a, b in zip(starts, stops)]
+
+    def speakers(self) -> list:
+        """Speaker ids present, in order of their first turn."""
+        ids = self.speaker[self.turns]
+        _, first = np.unique(ids[ids >= 0], return_index=True)
+        return ids[ids >= 0][np.sort(first)].tolist()
+
+    def talk_time(self) -> dict:
+        """Seconds of speech per speaker id."""
+        known = self.speaker >= 0
+        seconds = np.bincount(self.speaker[known], weights=(self.end - self.start)[known])
+        return {speaker: float(seconds[speaker]) for speaker in self.speakers()}
+
+    def labelled_transcript(self, start: float | None = None, end: float | None = None, speaker: int | None = None) -> str:
+        """One ``Speaker N: ...`` paragraph per turn (speaker ids are 0-based, labels 1-based)."""
+        return "\n\n".join(
+            f"Speaker {u.speaker + 1}: {u.text}" if u.speaker is not None else u.text
+            for u in self.utterances(start, end, speaker)
+        )
+
+
+def speaker_transcript(result: dict) -> str:
+    """The transcript to write the note from: one ``Speaker N:`` paragraph per
+    turn when diarization found more than one speaker, else the plain text.
+    """
+    words = WordTable.from_result(result)
+    if len(words.speakers()) > 1:
+        return words.labelled_transcript()
+    return result["transcript"]
+
+
+def transcribe_audio_sync(audio, mimetype: str = "audio/wav") -> dict:
+    """Transcribe audio using Deepgram's REST API with a longer timeout.
+    This bypasses the Deepgram SDK's default timeout limits for large files.
+    ``audio`` may be bytes, a file-like object or an iterator of byte pieces;
+    file-likes and iterators are streamed in ``STREAM_CHUNK_BYTES`` pieces.
+    Returns a dict with ``transcript``, ``confidence``, speaker-labelled
+    ``utterances`` and the word timings as ``WordTable`` columns (``words``),
+    or raises an error.
+    """
+    data = request_transcription(audio, mimetype)
+    alternative = data["results"]["channels"][0]["alternatives"][0]
+    transcript = alternative["transcript"]
+    confidence = alternative["confidence"]
+    words = WordTable.from_words(alternative.get("words", []))
+    if "utterances" in data["results"]:
+        utterances = [
+            {"speaker": u.get("speaker"), "start": u["start"], "end": u["end"], "transcript": u["transcript"]}
+            for u in data["results"]["utterances"]
+        ]
+    else:
+        utterances = [u.to_dict() for u in words.utterances()]
+    return {"transcript": transcript, "confidence": confidence, "utterances": utterances, "words": words.to_columns()}
+
+
+# ============================================================
+# CHUNKED TRANSCRIPTION
+# ============================================================
+
+# Long PCM WAV recordings are split at pauses near these boundaries and the
+# pieces are transcribed concurrently, so wall-clock time tracks the slowest
+# chunk instead of the full session length.
+CHUNK_TARGET_SECONDS = 300.0
+CHUNK_SEARCH_SECONDS = 20.0
+# Audio repeated at the start of each chunk so diarization labels can be
+# matched against the previous chunk. Words in the overlap are dropped.
+CHUNK_OVERLAP_SECONDS = 4.0
+CHUNK_MAX_CONCURRENCY = int(os.environ.get("DEEPGRAM_CHUNK_CONCURRENCY", "4"))
+ENERGY_FRAME_SECONDS = 0.02
+
+
+WavParams = namedtuple("WavParams", "nchannels sampwidth framerate nframes")
+
+
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+# {00000001-0000-0010-8000-00AA00389B71} as stored in the fmt chunk
+KSDATAFORMAT_SUBTYPE_PCM = bytes.fromhex("0100000000001000800000aa00389b71")
+
+
+def read_wav_pcm(audio_bytes):
+    """Parse a PCM WAV file without copying its sample data.
+    ``audio_bytes`` may be any buffer (bytes, memoryview, mmap). Returns
+    ``(params, frames)`` where ``frames`` is a memoryview over the raw PCM
+    bytes, or ``None`` if the audio is not integer PCM WAV.
+    """
+    if len(audio_bytes) < 12 or audio_bytes[0:4] != b"RIFF" or audio_bytes[8:12] != b"WAVE":
+        return None
+    fmt = None
+    # Walk the RIFF chunks for the format description and the sample data
+    position = 12
+    while position + 8 <= len(audio_bytes):
+        chunk_id = bytes(audio_bytes[position:position + 4])
+        chunk_size = int.from_bytes(audio_bytes[position + 4:position + 8], "little")
+        position += 8
+        if chunk_id == b"fmt ":
+            fmt = struct.unpack("<HHIIHH", audio_bytes[position:position + 16])
+            if fmt[0] == WAVE_FORMAT_EXTENSIBLE:
+                # cbSize, then the SubFormat GUID at offset 24 says what the samples are
+                sub_format = bytes(audio_bytes[position + 24:position + 40]) if chunk_size >= 40 else None
+                if sub_format != KSDATAFORMAT_SUBTYPE_PCM:
+                    return None
+        elif chunk_id == b"data":
+            break
+        position += chunk_size + (chunk_size & 1)
+    else:
+        return None
+    if fmt is None:
+        return None
+    format_tag, nchannels, framerate, _, _, bits = fmt
+    # Floating point (3, or its extensible SubFormat) and compressed formats
+    # are sent as they are
+    if format_tag not in (WAVE_FORMAT_PCM, WAVE_FORMAT_EXTENSIBLE) or bits not in (8, 16, 32) or not nchannels:
+        return None
+    frame_bytes = nchannels * bits // 8
+    data_size = min(chunk_size, len(audio_bytes) - position)
+    nframes = data_size // frame_bytes
+    frames = memoryview(audio_bytes)[position:position + nframes * frame_bytes]
+    return WavParams(nchannels, bits // 8, framerate, nframes), frames
+
+
+def pcm_as_array(frames, sampwidth: int, nchannels: int) -> np.ndarray:
+    """View raw little-endian PCM bytes as an ``(n, channels)`` integer array."""
+    dtype = {1: np.uint8, 2: np.int16, 4: np.int32}[sampwidth]
+    samples = np.frombuffer(frames, dtype=dtype)
+    samples = samples[: len(samples) - len(samples) % nchannels]
+    return samples.reshape(-1, nchannels)
+
+
+def frame_energy(samples: np.ndarray, frame_len: int, block_frames: int = 4096) -> np.ndarray:
+    """Mean-square energy of consecutive ``frame_len``-sample frames.
+    Works block by block so long recordings are never converted to float in
+    one piece.
+    """
+    n_frames = len(samples) // frame_len
+    energy = np.empty(n_frames, dtype=np.float32)
+    offset = 128.0 if samples.dtype == np.uint8 else 0.0
+    for i in range(0, n_frames, block_frames):
+        stop = min(i + block_frames, n_frames)
+        block = samples[i * frame_len:stop * frame_len].astype(np.float32) - offset
+        energy[i:stop] = np.mean(block.reshape(stop - i, -1) ** 2, axis=1)
+    return energy
+
+
+def find_split_points(energy: np.ndarray, frame_seconds: float, target_seconds: float = CHUNK_TARGET_SECONDS,
+                      search_seconds: float = CHUNK_SEARCH_SECONDS) -> list[float]:
+    """Pick split times (seconds) at the quietest pause near each target boundary."""
+    # Smooth over ~300 ms so a split lands in a real pause, not a gap between syllables
+    window = max(1, int(0.3 / frame_seconds))
+    smoothed = np.convolve(energy, np.ones(window, dtype=np.float32) / window, mode="same")
+    duration = len(energy) * frame_seconds
+    splits = []
+    target = target_seconds
+    while target < duration - target_seconds / 4:
+        lo = max(0, int((target - search_seconds) / frame_seconds))
+        hi = min(len(smoothed), int((target + search_seconds) / frame_seconds))
+        split = (lo + int(np.argmin(smoothed[lo:hi]))) * frame_seconds
+        splits.append(split)
+        target = split + target_seconds
+    return splits
+
+
+def encode_wav_frames(params, frames) -> bytes:
+    """Wrap raw PCM frames in a WAV header using ``params`` from the source."""
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(params.nchannels)
+        wav.setsampwidth(params.sampwidth)
+        wav.setframerate(params.framerate)
+        wav.writeframes(frames)
+    return buffer.getvalue()
+
+
+def match_speakers(previous_words: list, overlap_words: list, tolerance: float = 0.3) -> dict:
+    """Map a chunk's local speaker ids onto global ids using the overlap region.
+    Words heard in both chunks are paired by text and time; each local speaker
+    takes the global speaker it co-occurs with most often.
+    """
+    votes = {}
+    for word in overlap_words:
+        if word.get("speaker") is None:
+            continue
+        midpoint = (word["start"] + word["end"]) / 2
+        for prev in reversed(previous_words):
+            if prev["end"] < midpoint - tolerance:
+                break
+            if prev["word"] == word["word"] and abs((prev["start"] + prev["end"]) / 2 - midpoint) <= tolerance:
+                key = (word["speaker"], prev["speaker"])
+                votes[key] = votes.get(key, 0) + 1
+                break
+    mapping = {}
+    for (local, global_id), _ in sorted(votes.items(), key=lambda item: -item[1]):
+        if local not in mapping and global_id not in mapping.values():
+            mapping[local] = global_id
+    return mapping
+
+
+def stitch_transcripts(chunks: list) -> dict:
+    """Merge per-chunk Deepgram responses into one transcript.
+    ``chunks`` holds ``(offset, overlap, duration, data)`` tuples in order.
+    Word timestamps are shifted onto the original timeline and diarization
+    labels are renumbered so a speaker keeps one id across chunks.
+    """
+    words = []
+    texts = []
+    confidence_total = 0.0
+    duration_total = 0.0
+    known_speakers = []
+    for offset, overlap, duration, data in chunks:
+        alternative = data["results"]["channels"][0]["alternatives"][0]
+        confidence_total += alternative.get("confidence", 0.0) * duration
+        duration_total += duration
+        chunk_words = [
+            dict(w, start=w["start"] + offset, end=w["end"] + offset)
+            for w in alternative.get("words", [])
+        ]
+        if not chunk_words:
+            if alternative.get("transcript"):
+                texts.append(alternative["transcript"])
+            continue
+        head = [w for w in chunk_words if w["start"] < offset + overlap]
+        body = [w for w in chunk_words if w["start"] >= offset + overlap]
+        mapping = match_speakers(words, head)
+        for local in sorted({w["speaker"] for w in body if w.get("speaker") is not None}):
+            if local in mapping:
+                continue
+            unused = [g for g in known_speakers if g not in mapping.values()]
+            mapping[local] = unused[0] if unused else len(known_speakers)
+            if mapping[local] not in known_speakers:
+                known_speakers.append(mapping[local])
+        for word in body:
+            if word.get("speaker") is not None:
+                word["speaker"] = mapping[word["speaker"]]
+        words.extend(body)
+        texts.append(" ".join(w.get("punctuated_word", w["word"]) for w in body))
+
+    table = WordTable.from_words(words)
+    return {
+        "transcript": " ".join(t for t in texts if t),
+        "confidence": confidence_total / duration_total if duration_total else 0.0,
+        "utterances": [u.to_dict() for u in table.utterances()],
+        "words": table.to_columns(),
+    }
+
+
+def audio_buffer(source):
+    """Zero-copy buffer over the audio, or ``None`` if one is not available.
+    In-memory uploads expose their buffer directly and real files are
+    memory-mapped, so chunking never reads the recording into a new copy.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview, mmap.mmap)):
+        return source
+    if hasattr(source, "getbuffer"):
+        return source.getbuffer()[source.tell():]
+    try:
+        mapped = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        return None
+    return memoryview(mapped)[source.tell():]
+
+
+def transcribe_audio_chunked(audio, mimetype: str = "audio/wav",
+                             target_seconds: float = CHUNK_TARGET_SECONDS,
+                             max_concurrency: int = CHUNK_MAX_CONCURRENCY) -> dict:
+    """Transcribe a long recording as concurrent chunks split at silences.
+    Audio that is not PCM WAV, or is shorter than one chunk, goes through
+    ``transcribe_audio_sync`` unchanged (streamed when ``audio`` is a file).
+    Returns the same keys as ``transcribe_audio_sync``.
+    """
+    buffer = audio_buffer(audio)
+    parsed = read_wav_pcm(buffer) if buffer is not None else None
+    if parsed is None:
+        return transcribe_audio_sync(audio, mimetype)
+    params, frames = parsed
+    if params.nframes / params.framerate < target_seconds * 1.25:
+        return transcribe_audio_sync(audio, mimetype)
+
+    samples = pcm_as_array(frames, params.sampwidth, params.nchannels)
+    frame_len = max(1, int(params.framerate * ENERGY_FRAME_SECONDS))
+    energy = frame_energy(samples, frame_len)
+    frame_seconds = frame_len / params.framerate
+    bounds = [0.0] + find_split_points(energy, frame_seconds, target_seconds) + [params.nframes / params.framerate]
+
+    frame_bytes = params.nchannels * params.sampwidth
+    segments = []
+    for start, stop in zip(bounds, bounds[1:]):
+        overlap = min(CHUNK_OVERLAP_SECONDS, start)
+        first = int((start - overlap) * params.framerate)
+        last = int(stop * params.framerate)
+        chunk = encode_wav_frames(params, frames[first * frame_bytes:last * frame_bytes])
+        segments.append((start - overlap, overlap, stop - start, chunk))
+
+    workers = max(1, min(max_concurrency, len(segments)))
+    responses = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for data in executor.map(lambda seg: request_transcription(seg[3], "audio/wav"), segments):
+            responses.append(data)
+            report_progress(0.2 + 0.8 * len(responses) / len(segments),
+                            f"Transcribed {len(responses)} of {len(segments)} segments...")
+    return stitch_transcripts(
+        [(offset, overlap, duration, data) for (offset, overlap, duration, _), data in zip(segments, responses)]
+    )
+
+
+# ============================================================
+# AUDIO PREPROCESSING
+# ============================================================
+
+# Speech recognition needs neither stereo nor more than 16 kHz. Downmixing and
+# resampling a 48 kHz stereo recording to 16 kHz mono 16-bit PCM shrinks the
+# upload ~6x (3x for 48 kHz mono) before any time is spent on the network.
+PREPROCESS_SAMPLE_RATE = 16000
+PREPROCESS_BLOCK_SECONDS = 30.0
+PREPROCESS_FILTER_TAPS = 63
+
+
+def pcm_to_float(samples: np.ndarray) -> np.ndarray:
+    """Scale integer PCM samples to float32 in [-1, 1)."""
+    if samples.dtype == np.uint8:
+        return (samples.astype(np.float32) - 128.0) / 128.0
+    return samples.astype(np.float32) / float(np.iinfo(samples.dtype).max + 1)
+
+
+def lowpass_taps(cutoff: float, taps: int = PREPROCESS_FILTER_TAPS) -> np.ndarray:
+    """Hamming-windowed sinc low-pass filter; ``cutoff`` is a fraction of the sample rate."""
+    n = np.arange(taps) - (taps - 1) / 2
+    kernel = 2 * cutoff * np.sinc(2 * cutoff * n) * np.hamming(taps)
+    return (kernel / kernel.sum()).astype(np.float32)
+
+
+def wav_header(nchannels: int, sampwidth: int, framerate: int, nframes: int) -> bytes:
+    """44-byte canonical PCM WAV header."""
+    data_size = nframes * nchannels * sampwidth
+    return struct.pack(
+        "<4sI4s4sIHHIIHH4sI",
+        b"RIFF", 36 + data_size, b"WAVE", b"fmt ", 16, 1, nchannels, framerate,
+        framerate * nchannels * sampwidth, nchannels * sampwidth, sampwidth * 8, b"data", data_size,
+    )
+
+
+def preprocess_audio(audio, target_rate: int = PREPROCESS_SAMPLE_RATE):
+    """Downmix PCM WAV to mono, resample to ``target_rate`` and re-encode as 16-bit PCM.
+    Works block by block over a zero-copy view of the input, so only the
+    (much smaller) output is held in memory. Returns ``(processed, stats)``
+    with ``processed`` as bytes, or ``(None, None)`` when the audio is not
+    PCM WAV or would not get smaller.
+    """
+    buffer = audio_buffer(audio)
+    parsed = read_wav_pcm(buffer) if buffer is not None else None
+    if parsed is None:
+        return None, None
+    params, frames = parsed
+    if params.nchannels == 1 and params.sampwidth <= 2 and params.framerate <= target_rate:
+        return None, None
+
+    samples = pcm_as_array(frames, params.sampwidth, params.nchannels)
+    rate = min(target_rate, params.framerate)
+    ratio = params.framerate / rate
+    taps = lowpass_taps(0.45 / ratio) if ratio > 1 else None
+    pad = PREPROCESS_FILTER_TAPS // 2 + 1
+    n_out = int(len(samples) / ratio)
+
+    out = io.BytesIO()
+    out.write(wav_header(1, 2, rate, n_out))
+    block = int(PREPROCESS_BLOCK_SECONDS * rate)
+    for first in range(0, n_out, block):
+        positions = np.arange(first, min(first + block, n_out)) * ratio
+        lo = max(0, int(positions[0]) - pad)
+        hi = min(len(samples), int(positions[-1]) + pad + 1)
+        mono = pcm_to_float(samples[lo:hi]).mean(axis=1)
+        if taps is not None:
+            mono = np.convolve(mono, taps, mode="same")
+        resampled = np.interp(positions - lo, np.arange(hi - lo), mono)
+        out.write((np.clip(resampled, -1.0, 1.0) * 32767).astype("<i2").tobytes())
+
+    processed = out.getvalue()
+    original_bytes = len(buffer)
+    if len(processed) >= original_bytes:
+        return None, None
+    stats = {
+        "original_bytes": original_bytes,
+        "processed_bytes": len(processed),
+        "bytes_saved": original_bytes - len(processed),
+        "ratio": original_bytes / len(processed),
+    }
+    increment("preprocess_bytes_saved_total", stats["bytes_saved"])
+    print(f"Preprocessed audio: {original_bytes / 1e6:.1f} MB -> {len(processed) / 1e6:.1f} MB ({stats['ratio']:.1f}x smaller)")
+    return processed, stats
+
+
+# ============================================================
+# SILENCE TRIMMING
+# ============================================================
+
+# Pauses longer than VAD_MIN_SILENCE_SECONDS are shortened to
+# VAD_KEEP_SILENCE_SECONDS, which keeps a natural gap for punctuation and
+# diarization while cutting dead air from the upload and the bill.
+VAD_FRAME_SECONDS = 0.02
+VAD_MIN_SILENCE_SECONDS = 1.0
+VAD_KEEP_SILENCE_SECONDS = 0.3
+VAD_HANGOVER_SECONDS = 0.2
+# Speech must be this many dB above the estimated noise floor
+VAD_THRESHOLD_DB = 12.0
+
+
+def speech_mask(energy: np.ndarray, frame_seconds: float = VAD_FRAME_SECONDS,
+                threshold_db: float = VAD_THRESHOLD_DB, hangover_seconds: float = VAD_HANGOVER_SECONDS) -> np.ndarray:
+    """Boolean per-frame voice activity from frame energies.
+    The threshold adapts to the recording's noise floor (10th percentile
+    energy) and speech is extended by a short hangover on both sides so word
+    onsets and tails are never clipped.
+    """
+    floor = max(float(np.percentile(energy, 10)), 1e-10 * float(energy.max(initial=1.0)), 1e-12)
+    active = energy > floor * 10 ** (threshold_db / 10)
+    hangover = int(hangover_seconds / frame_seconds)
+    if hangover:
+        kernel = np.ones(2 * hangover + 1, dtype=np.float32)
+        active = np.convolve(active.astype(np.float32), kernel, mode="same") > 0
+    return active
+
+
+def kept_spans(active: np.ndarray, frame_seconds: float = VAD_FRAME_SECONDS,
+               min_silence_seconds: float = VAD_MIN_SILENCE_SECONDS,
+               keep_silence_seconds: float = VAD_KEEP_SILENCE_SECONDS) -> np.ndarray:
+    """Frame ranges ``[[start, stop), ...]`` to keep after shortening long silences."""
+    edges = np.flatnonzero(np.diff(np.concatenate(([True], active, [True])).astype(np.int8)))
+    # Edges alternate silence start / silence end, since the padding is "active"
+    silences = edges.reshape(-1, 2)
+    min_frames = int(min_silence_seconds / frame_seconds)
+    keep_half = int(keep_silence_seconds / frame_seconds) // 2
+    long = silences[(silences[:, 1] - silences[:, 0]) >= min_frames]
+    # Cut each long silence down to keep_half frames on either side of speech
+    cut_start = long[:, 0] + keep_half
+    cut_stop = long[:, 1] - keep_half
+    starts = np.concatenate(([0], cut_stop))
+    stops = np.concatenate((cut_start, [len(active)]))
+    spans = np.stack([starts, stops], axis=1)
+    return spans[spans[:, 1] > spans[:, 0]]
+
+
+def trim_silence(audio):
+    """Shorten long silent spans in PCM WAV audio.
+    Returns ``(trimmed, offset_map, stats)`` where ``offset_map`` is a pair of
+    arrays (trimmed start times, original start times) for ``map_to_original``;
+    ``(None, None, None)`` if the audio is not PCM WAV or nothing was cut.
+    """
+    buffer = audio_buffer(audio)
+    parsed = read_wav_pcm(buffer) if buffer is not None else None
+    if parsed is None:
+        return None, None, None
+    params, frames = parsed
+    samples = pcm_as_array(frames, params.sampwidth, params.nchannels)
+    frame_len = max(1, int(params.framerate * VAD_FRAME_SECONDS))
+    frame_seconds = frame_len / params.framerate
+    energy = frame_energy(samples, frame_len)
+    if not len(energy):
+        return None, None, None
+    spans = kept_spans(speech_mask(energy, frame_seconds), frame_seconds)
+    kept_frames = int((spans[:, 1] - spans[:, 0]).sum())
+    if kept_frames >= len(energy):
+        return None, None, None
+
+    sample_bytes = params.nchannels * params.sampwidth
+    # Samples after the last whole energy frame stay if the last span reaches the end
+    tail = len(samples) - len(energy) * frame_len if spans[-1, 1] == len(energy) else 0
+    nframes = kept_frames * frame_len + tail
+    pieces = [wav_header(params.nchannels, params.sampwidth, params.framerate, nframes)]
+    for start, stop in spans:
+        end = stop * frame_len + (tail if stop == len(energy) else 0)
+        pieces.append(frames[start * frame_len * sample_bytes:end * sample_bytes])
+    trimmed = b"".join(pieces)
+
+    lengths = (spans[:, 1] - spans[:, 0]) * frame_seconds
+    offset_map = (np.concatenate(([0.0], np.cumsum(lengths)[:-1])), spans[:, 0] * frame_seconds)
+    original_seconds = len(samples) / params.framerate
+    stats = {
+        "original_seconds": original_seconds,
+        "trimmed_seconds": nframes / params.framerate,
+        "silence_removed_seconds": original_seconds - nframes / params.framerate,
+    }
+    increment("vad_seconds_removed_total", stats["silence_removed_seconds"])
+    return trimmed, offset_map, stats
+
+
+def map_to_original(times, offset_map) -> np.ndarray:
+    """Translate times on the trimmed timeline back to the original recording."""
+    trimmed_starts, original_starts = offset_map
+    times = np.asarray(times, dtype=np.float64)
+    span = np.clip(np.searchsorted(trimmed_starts, times, side="right") - 1, 0, len(trimmed_starts) - 1)
+    return original_starts[span] + (times - trimmed_starts[span])
+
+
+def remap_utterances(result: dict, offset_map) -> dict:
+    """Rewrite ``utterances`` and ``words`` start/end times in place onto the original timeline."""
+    utterances = result.get("utterances") or []
+    if utterances:
+        starts = map_to_original([u["start"] for u in utterances], offset_map)
+        ends = map_to_original([u["end"] for u in utterances], offset_map)
+        for utterance, start, end in zip(utterances, starts, ends):
+            utterance["start"], utterance["end"] = float(start), float(end)
+    words = result.get("words")
+    if words and words["start"]:
+        words["start"] = np.round(map_to_original(words["start"], offset_map), 3).tolist()
+        words["end"] = np.round(map_to_original(words["end"], offset_map), 3).tolist()
+    return result
+
+
+def transcribe_audio(audio, mimetype: str = "audio/wav", preprocess: bool = True, trim: bool = True) -> dict:
+    """Transcribe through the shared result cache.
+    ``audio`` is bytes, a buffer or a seekable file-like object such as a
+    Streamlit upload; it is hashed and uploaded in pieces, never copied whole.
+    With ``preprocess``, PCM WAV is downmixed and resampled to 16 kHz mono
+    before upload and the result carries ``preprocessing`` size stats. With
+    ``trim``, long silences are shortened first and utterance times are
+    mapped back onto the original recording (``silence_trimming`` stats).
+    The same audio with the same request params returns the stored result
+    without another Deepgram call, across sessions and (with the disk tier)
+    server restarts.
+    """
+    cache = get_transcription_cache()
+    key = content_key(audio, {
+        **DEEPGRAM_PARAMS,
+        "mimetype": mimetype,
+        "chunk_seconds": CHUNK_TARGET_SECONDS,
+        "preprocess_rate": PREPROCESS_SAMPLE_RATE if preprocess else None,
+        "trim_silence": (VAD_MIN_SILENCE_SECONDS, VAD_KEEP_SILENCE_SECONDS, VAD_THRESHOLD_DB) if trim else None,
+    })
+    result = cache.get(key)
+    if result is None:
+        report_progress(0.05, "Preparing audio...")
+        processed, stats = preprocess_audio(audio) if preprocess else (None, None)
+        source, source_type = (processed, "audio/wav") if processed is not None else (audio, mimetype)
+        trimmed, offset_map, vad_stats = trim_silence(source) if trim else (None, None, None)
+        if trimmed is not None:
+            source, source_type = trimmed, "audio/wav"
+        report_progress(0.2, "Transcribing audio with Deepgram Nova-2...")
+        result = transcribe_audio_chunked(source, source_type)
+        if offset_map is not None:
+            remap_utterances(result, offset_map)
+        if stats is not None:
+            result["preprocessing"] = stats
+        if vad_stats is not None:
+            result["silence_trimming"] = vad_stats
+        cache.set(key, result)
+    return result
+
+
+# ============================================================
+# SOAP NOTE GENERATOR
+# ============================================================
+
+class SOAPNote(BaseModel):
+    """Structured SOAP note model."""
+    client_name: str = Field(description="Client's name or identifier")
+    session_date: str = Field(description="Date of the session")
+    session_length: str = Field(description="Duration of the session")
+    subjective: str = Field(description="Client's reported symptoms, feelings, and concerns")
+    objective: str = Field(description="Clinician's observations during the session")
+    assessment: str = Field(description="Clinical assessment and analysis")
+    plan: str = Field(description="Treatment plan and next steps")
+    clinical_tone: str = Field(default="Not specified", description="Overall clinical tone/presentation")
+    is_complete: bool = Field(default=False)
+    validation_notes: list = Field(default_factory=list)
+
+
+SOAP_SYSTEM_PROMPT = """You are an experienced clinical documentation specialist at a substance abuse treatment center. Your role is to generate accurate, professional SOAP notes from therapy session transcripts.
+
+IMPORTANT GUIDELINES:
+1. Use professional clinical terminology while maintaining warmth and person-centered language
+2. Never fabricate information - only document what is clearly stated or observed in the transcript
+3. If information is unclear or missing, note it as "Not documented in session"
+4. Be specific about substance use history, triggers, and recovery progress when mentioned
+5. Include relevant recovery milestones (clean time, meeting attendance, sponsor contact) when discussed
+6. Document emotional states accurately - people in recovery deserve to have their experiences validated
+7. Keep notes concise but thorough enough for insurance documentation requirements
+
+SOAP FORMAT:
+- Subjective: What the client reports - their feelings, concerns, symptoms, and experiences in their own words
+- Objective: Observable data - appearance, behavior, affect, speech patterns, engagement level
+- Assessment: Your clinical interpretation - progress toward goals, risk factors, strengths observed
+- Plan: Next steps - homework, referrals, follow-up appointments, treatment adjustments
+
+Extract the client name, session date, and session length if mentioned. If not explicitly stated, note as "Not specified in transcript."
+"""
+
+
+SOAP_MODEL = "claude-sonnet-4-20250514"
+
+# Fields the model is asked for, and the note sections shown in Step 4
+SOAP_FIELDS = [
+    "client_name", "session_date", "session_length",
+    "subjective", "objective", "assessment", "plan", "clinical_tone",
+]
+SOAP_SECTIONS = [
+    ("subjective", "Subjective"),
+    ("objective", "Objective"),
+    ("assessment", "Assessment"),
+    ("plan", "Plan"),
+]
+
+SOAP_TOOL_NAME = "record_soap_note"
+
+
+def soap_tool_schema() -> dict:
+    """JSON schema for the model's output, derived from the SOAPNote model.
+    Only SOAP_FIELDS are requested (and all of them are required);
+    is_complete and validation_notes are filled in by validate_soap_note.
+    """
+    schema = SOAPNote.model_json_schema()
+    properties = {
+        name: {key: value for key, value in schema["properties"][name].items() if key != "title"}
+        for name in SOAP_FIELDS
+    }
+    return {"type": "object", "properties": properties, "required": list(SOAP_FIELDS)}
+
+
+# Forcing this tool makes the API return the note as a schema-shaped object
+# instead of free text, so there are no fences or prose to strip.
+SOAP_TOOL = {
+    "name": SOAP_TOOL_NAME,
+    "description": "Record the structured SOAP note for the therapy session.",
+    "input_schema": soap_tool_schema(),
+}
+
+# Same fields, none required: used to rewrite selected sections of a note.
+# Every request carries both tools so they share one cached prompt prefix.
+SOAP_SECTION_TOOL_NAME = "update_soap_sections"
+SOAP_SECTION_TOOL = {
+    "name": SOAP_SECTION_TOOL_NAME,
+    "description": "Record rewritten sections of an existing SOAP note. Fill in only the requested fields.",
+    "input_schema": {**soap_tool_schema(), "required": []},
+}
+SOAP_TOOLS = [SOAP_TOOL, SOAP_SECTION_TOOL]
+
+# Fixed output instructions. Together with SOAP_SYSTEM_PROMPT and SOAP_TOOL
+# this forms the byte-stable prefix of every request, so it is marked for
+# prompt caching; nothing per-session may be interpolated into these.
+SOAP_OUTPUT_SPEC = """Record the note with the record_soap_note tool, filling in these exact fields:
+- client_name (string): Client's name or "Not specified"
+- session_date (string): Session date or "Not specified"
+- session_length (string): Duration or "Not specified"
+- subjective (string): Client's reported experience
+- objective (string): Clinician observations
+- assessment (string): Clinical assessment
+- plan (string): Treatment plan
+- clinical_tone (string): Brief description of client's overall presentation"""
+
+CACHE_CONTROL = {"type": "ephemeral"}
+
+
+def build_soap_request(transcript: str, additional_context: str = "", summarized: bool = False) -> dict:
+    """Messages API arguments for a SOAP note, ordered for prompt caching.
+    Cache breakpoints sit after the static system prefix and after the
+    transcript, so regenerating a note for the same transcript (e.g. with
+    different session context) also reuses the transcript tokens. Prefixes
+    below the model's minimum cacheable length are simply not cached.
+    With ``summarized``, ``transcript`` holds the segment summaries of a
+    map-reduce run instead of the transcript itself.
+    """
+    system = [
+        {"type": "text", "text": SOAP_SYSTEM_PROMPT},
+        {"type": "text", "text": SOAP_OUTPUT_SPEC, "cache_control": CACHE_CONTROL},
+    ]
+    if summarized:
+        source = f"SEGMENT SUMMARIES:\n{transcript}"
+        instruction = "Please generate a SOAP note from the summaries of the therapy session segments above."
+    else:
+        source = f"TRANSCRIPT:\n{transcript}"
+        instruction = "Please generate a SOAP note from the therapy session transcript above."
+    if additional_context:
+        instruction += f"\n\nAdditional Context: {additional_context}"
+    content = [
+        {"type": "text", "text": source, "cache_control": CACHE_CONTROL},
+        {"type": "text", "text": instruction},
+    ]
+    return {
+        "model": SOAP_MODEL,
+        "max_tokens": 2000,
+        "tools": SOAP_TOOLS,
+        "tool_choice": {"type": "tool", "name": SOAP_TOOL_NAME},
+        "system": system,
+        "messages": [{"role": "user", "content": content}],
+    }
+
+
+def request_tokens(request: dict) -> int:
+    """Estimated input tokens of a Messages API request, for the token-rate limit."""
+    return estimate_tokens(json.dumps([request.get("tools"), request.get("system"), request["messages"]]))
+
+
+def billed_input_tokens(counts: dict) -> int:
+    """Input tokens that count against the input-token rate limit (cache reads do not)."""
+    return counts["input_tokens"] + counts["cache_creation_input_tokens"]
+
+
+def record_usage(usage) -> dict:
+    """Count token usage (including prompt-cache reads and writes) from a response."""
+    counts = {
+        "input_tokens": getattr(usage, "input_tokens", 0) or 0,
+        "output_tokens": getattr(usage, "output_tokens", 0) or 0,
+        "cache_read_input_tokens": getattr(usage, "cache_read_input_tokens", 0) or 0,
+        "cache_creation_input_tokens": getattr(usage, "cache_creation_input_tokens", 0) or 0,
+    }
+    for name, value in counts.items():
+        increment(f"anthropic_{name}_total", value)
+    print(
+        f"SOAP generation tokens: input={counts['input_tokens']} output={counts['output_tokens']} "
+        f"cache_read={counts['cache_read_input_tokens']} cache_write={counts['cache_creation_input_tokens']}"
+    )
+    return counts
+
+
+class IncrementalJSONParser:
+    """Parse a flat JSON object as it streams in.
+    ``feed`` takes the next piece of text and returns the ``(key, value)``
+    members completed by it, so each field can be used as soon as its closing
+    quote arrives. Text before the opening brace (e.g. a ```json fence) and
+    after the closing brace is ignored, as are trailing commas, raw control
+    characters inside strings and members whose value does not parse.
+    ``finish`` recovers what it can from truncated input.
+    """
+
+    def __init__(self):
+        self.members = {}
+        self._buffer = ""
+        self._pos = 0
+        self._state = "start"
+        self._in_string = False
+        self._escaped = False
+        self._start = 0
+        self._depth = 0
+        self._key = None
+
+    def feed(self, text: str) -> list:
+        self._buffer += text
+        buf = self._buffer
+        completed = []
+        i = self._pos
+        while i < len(buf):
+            c = buf[i]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif c == "\\":
+                    self._escaped = True
+                elif c == '"':
+                    self._in_string = False
+                    if self._state == "key":
+                        self._key = json.loads(buf[self._start:i + 1])
+                        self._state = "colon"
+                    elif self._state == "string":
+                        try:
+                            completed.append((self._key, json.loads(buf[self._start:i + 1], strict=False)))
+                        except json.JSONDecodeError:
+                            pass
+                        self._state = "next"
+            elif self._state == "start":
+                if c == "{":
+                    self._state = "next"
+            elif self._state == "next":
+                if c == '"':
+                    self._state, self._in_string, self._start = "key", True, i
+                elif c == "}":
+                    self._state = "done"
+            elif self._state == "colon":
+                if c == ":":
+                    self._state = "value"
+            elif self._state == "value":
+                if c == '"':
+                    self._state, self._in_string, self._start = "string", True, i
+                elif not c.isspace():
+                    # Number, literal, array or object: read until the member ends
+                    self._state, self._start, self._depth = "scalar", i, 0
+                    continue
+            elif self._state == "scalar":
+                if c in "[{":
+                    self._depth += 1
+                elif c in "]}" and self._depth:
+                    self._depth -= 1
+                elif c == '"':
+                    self._in_string = True
+                elif c in ",}" and not self._depth:
+                    try:
+                        completed.append((self._key, json.loads(buf[self._start:i])))
+                    except json.JSONDecodeError:
+                        pass
+                    self._state = "next" if c == "," else "done"
+            i += 1
+        self._pos = i
+        self.members.update(completed)
+        return completed
+
+    def finish(self) -> dict:
+        """Close a value left open by truncated input and return all members."""
+        if self._state in ("string", "scalar"):
+            tail = self._buffer[self._start:].rstrip().rstrip(",")
+            if self._state == "string":
+                tail = (tail[:-1] if tail.endswith("\\") and not tail.endswith("\\\\") else tail) + '"'
+            try:
+                self.members[self._key] = json.loads(tail, strict=False)
+            except json.JSONDecodeError:
+                pass
+            self._state = "done"
+        return self.members
+
+
+def complete_note_data(note_data: dict) -> dict:
+    """Fill fields missing from a recovered (e.g. truncated) response with "Not specified"."""
+    missing = [field for field in SOAP_FIELDS if not isinstance(note_data.get(field), str)]
+    if missing:
+        print(f"Recovered partial SOAP response; missing fields: {', '.join(missing)}")
+    return {**note_data, **{field: "Not specified" for field in missing}}
+
+
+PARSE_FAILURE_OBJECTIVE = "Unable to parse structured response"
+
+
+def parse_soap_response(response_text: str) -> dict:
+    """Turn the model's full response text into note fields, degrading gracefully."""
+    # Clean up response
+    if response_text.startswith("```"):
+        response_text = response_text.split("```")[1]
+        if response_text.startswith("json"):
+            response_text = response_text[4:]
+    response_text = response_text.strip()
+    
+    try:
+        note_data = json.loads(response_text)
+    except json.JSONDecodeError:
+        # Malformed or truncated JSON: keep every member that can be recovered
+        parser = IncrementalJSONParser()
+        parser.feed(response_text)
+        note_data = parser.finish()
+        if any(field in note_data for field, _ in SOAP_SECTIONS):
+            increment("soap_parse_failures_avoided_total")
+            return complete_note_data(note_data)
+        increment("soap_parse_failures_total")
+        note_data = {
+            "client_name": "Not specified",
+            "session_date": "Not specified",
+            "session_length": "Not specified",
+            "subjective": response_text,
+            "objective": PARSE_FAILURE_OBJECTIVE,
+            "assessment": "Please review transcript manually",
+            "plan": "Regenerate note or enter manually",
+            "clinical_tone": "Unknown"
+        }
+    return note_data
+
+
+def note_data_from_message(response) -> dict:
+    """Note fields from a Messages API response.
+    The forced tool call normally carries a complete, schema-shaped object; a
+    response cut off at max_tokens keeps whatever fields it finished.
+    """
+    for block in response.content:
+        if block.type == "tool_use" and isinstance(block.input, dict):
+            if response.stop_reason == "max_tokens":
+                increment("soap_parse_failures_avoided_total")
+                return complete_note_data(block.input)
+            return block.input
+    return parse_soap_response("".join(block.text for block in response.content if block.type == "text"))
+
+
+# Map-reduce generation. Above SOAP_MAP_REDUCE_TOKENS (estimated) the
+# transcript is split into segments that are summarized in parallel, and the
+# note is generated from the summaries. This keeps very long or group sessions
+# well inside the context window, and the reduce pass's latency no longer
+# grows with the length of the session. Below about 60k tokens the extra map
+# round trip costs more than it saves (benchmarks/bench_map_reduce.py).
+SOAP_MAP_REDUCE_TOKENS = int(os.environ.get("MOONLIGHT_MAP_REDUCE_TOKENS", "60000"))
+SOAP_SEGMENT_TOKENS = int(os.environ.get("MOONLIGHT_SEGMENT_TOKENS", "8000"))
+SOAP_MAP_CONCURRENCY = int(os.environ.get("MOONLIGHT_MAP_CONCURRENCY", "8"))
+SEGMENT_SUMMARY_MAX_TOKENS = 1000
+
+SEGMENT_SUMMARY_PROMPT = """You are summarizing one segment of a longer therapy session transcript at a substance abuse treatment center. The summaries of all segments will be combined into a single SOAP note.
+
+Write concise clinical notes covering only this segment:
+- What the client reports: feelings, concerns, symptoms, substance use, triggers and recovery milestones (clean time, meeting attendance, sponsor contact)
+- Observable presentation: affect, speech, behavior, engagement level
+- Interventions, homework, referrals and follow-up plans that were discussed
+- The client name, session date and session length, if they are stated
+
+Never fabricate information - only record what is said in the segment. Keep short direct quotes where they matter clinically."""
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about 4 characters per token for English text)."""
+    return len(text) // 4 + 1
+
+
+def segment_transcript(transcript: str, max_tokens: int = SOAP_SEGMENT_TOKENS) -> list:
+    """Split a transcript into segments of at most ``max_tokens`` (estimated).
+    Segments break between speaker turns (lines); a single turn longer than a
+    segment is broken between sentences.
+    """
+    max_chars = max_tokens * 4
+    pieces = []
+    for turn in transcript.splitlines():
+        turn = turn.strip()
+        while len(turn) > max_chars:
+            cut = turn.rfind(". ", 0, max_chars) + 1 or max_chars
+            pieces.append(turn[:cut].strip())
+            turn = turn[cut:].strip()
+        if turn:
+            pieces.append(turn)
+
+    segments, current, size = [], [], 0
+    for piece in pieces:
+        if current and size + len(piece) + 1 > max_chars:
+            segments.append("\n".join(current))
+            current, size = [], 0
+        current.append(piece)
+        size += len(piece) + 1
+    if current:
+        segments.append("\n".join(current))
+    return segments
+
+
+def summarize_segment(segment: str, index: int, count: int) -> str:
+    """Map step: clinical summary of one transcript segment."""
+    client = get_anthropic_client()
+    request = {
+        "model": SOAP_MODEL,
+        "max_tokens": SEGMENT_SUMMARY_MAX_TOKENS,
+        "system": [{"type": "text", "text": SEGMENT_SUMMARY_PROMPT, "cache_control": CACHE_CONTROL}],
+        "messages": [{"role": "user", "content": f"SEGMENT {index} OF {count}:\n{segment}"}],
+    }
+
+    @span("llm_segment_summary")
+    def create():
+        with anthropic_throttling():
+            return client.messages.create(**request)
+
+    limiter = get_rate_limiter("anthropic")
+    estimate = request_tokens(request)
+    response = limiter.call(create, tokens=estimate)
+    limiter.settle(estimate, billed_input_tokens(record_usage(response.usage)))
+    return "".join(block.text for block in response.content if block.type == "text").strip()
+
+
+def summarize_transcript(transcript: str) -> str:
+    """Summarize a long transcript segment by segment, in parallel.
+    Returns the summaries in session order, ready for the reduce pass.
+    """
+    segments = segment_transcript(transcript)
+    print(f"Map-reduce SOAP generation: {len(segments)} segments, ~{estimate_tokens(transcript)} tokens")
+    increment("soap_map_reduce_notes_total")
+    workers = max(1, min(SOAP_MAP_CONCURRENCY, len(segments)))
+    summaries = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        jobs = [(segment, i + 1, len(segments)) for i, segment in enumerate(segments)]
+        for summary in executor.map(lambda job: summarize_segment(*job), jobs):
+            summaries.append(f"[Segment {len(summaries) + 1} of {len(segments)}]\n{summary}")
+            report_progress(0.1 + 0.4 * len(summaries) / len(segments),
+                            f"Summarized {len(summaries)} of {len(segments)} transcript segments...")
+    return "\n\n".join(summaries)
+
+
+def stream_note_fields(request: dict):
+    """Stream a Messages API request, yielding ``(field, value)`` as each
+    field of the tool input completes. The final item is ``("message", Message)``.
+    """
+    client = get_anthropic_client()
+    parser = IncrementalJSONParser()
+    limiter = get_rate_limiter("anthropic")
+    estimate = request_tokens(request)
+    with contextlib.ExitStack() as stack:
+        def open_stream():
+            nonlocal start
+            start = time.perf_counter()
+            with anthropic_throttling():
+                return stack.enter_context(client.messages.stream(**request))
+
+        # The slot is held until the response has finished streaming
+        start, first_token = 0.0, None
+        stream = limiter.call(open_stream, tokens=estimate, hold=True)
+        stack.callback(limiter.release)
+        for event in stream:
+            if first_token is None and event.type == "content_block_delta":
+                first_token = time.perf_counter()
+                observe("llm_first_token", first_token - start)
+            if event.type == "content_block_delta" and event.delta.type == "input_json_delta":
+                yield from parser.feed(event.delta.partial_json)
+            elif event.type == "content_block_delta" and event.delta.type == "text_delta":
+                yield from parser.feed(event.delta.text)
+        response = stream.get_final_message()
+        observe("llm_total", time.perf_counter() - start)
+    limiter.settle(estimate, billed_input_tokens(record_usage(response.usage)))
+    yield "message", response
+
+
+def stream_soap_note(transcript: str, additional_context: str = "", summarized: bool = False):
+    """Stream a SOAP note, yielding ``(field, value)`` as each field completes.
+    The final item is ``("note", SOAPNote)`` holding the validated note built
+    from the complete response.
+    """
+    for field, value in stream_note_fields(build_soap_request(transcript, additional_context, summarized)):
+        if field != "message":
+            yield field, value
+    with span("parse"):
+        soap_note = SOAPNote(**note_data_from_message(value))
+    soap_note = validate_soap_note(soap_note)
+    yield "note", soap_note
+
+
+# Transcript condensing. Before a note is generated, filler words ("um",
+# "uh"), stutter repeats of function words ("I I"), cut-off word fragments
+# ("go- going") and backchannel-only turns ("Mm-hmm.", "Okay, got it.") are
+# dropped, and consecutive turns by one speaker are merged. Only words from
+# these lists are ever removed; a backchannel turn is dropped only when it
+# interrupts the other speaker mid-turn and can be neither a question nor an
+# answer: "Yeah." after "Did you drink? It was your birthday." or after an
+# unpunctuated "So you stopped the medication" is kept. Backchannels are comma-separated phrases, matched against the
+# whole turn, so "got it" never removes "got" from "I got it." The result is
+# checked to contain every other word of the original, and the original is
+# used instead if it does not. The clinician still sees and edits the full
+# transcript. MOONLIGHT_CONDENSE_TRANSCRIPT=0 turns condensing off.
+CONDENSE_TRANSCRIPT = os.environ.get("MOONLIGHT_CONDENSE_TRANSCRIPT", "1") != "0"
+FILLER_WORDS = frozenset(os.environ.get(
+    "MOONLIGHT_FILLER_WORDS", "um umm uh uhh uhm erm er ah hmm hm mm",
+).lower().split())
+BACKCHANNEL_PHRASES = frozenset(filter(None, (" ".join(phrase.split()) for phrase in os.environ.get(
+    "MOONLIGHT_BACKCHANNEL_PHRASES", "mm-hmm, mhm, uh-huh, yeah, yep, okay, ok, right, sure, alright, i see, got it",
+).lower().split(","))))
+STUTTER_WORDS = frozenset("""
+    i i'm a an the and but so to of in on at it it's is was we you he she they my your that this
+""".split())
+TURN_LABEL = re.compile(r"^([A-Z][\w .'-]{0,30}):\s+")
+WORD_PUNCTUATION = ".,!?;:\"'()[]…"
+
+CondensedTranscript = namedtuple(
+    "CondensedTranscript", "text tokens_before tokens_after disfluencies_removed backchannels_removed turns_merged",
+)
+
+
+def word_core(token: str) -> str:
+    """A transcript token lower-cased, without surrounding punctuation."""
+    return token.strip(WORD_PUNCTUATION).lower()
+
+
+def split_turns(transcript: str) -> list:
+    """``(label, text)`` per non-empty line; ``label`` is ``None`` for unlabelled lines."""
+    turns = []
+    for line in transcript.splitlines():
+        line = line.strip()
+        if line:
+            match = TURN_LABEL.match(line)
+            turns.append((match.group(1), line[match.end():]) if match else (None, line))
+    return turns
+
+
+def false_start(kept_cores: list, cores: list, i: int) -> int:
+    """How many kept words a cut-off word ``cores[i]`` ("go-") restarts, or -1
+    if it is not one. "go- going" restarts no kept words; "I can- I can't"
+    restarts "I". Only function words (STUTTER_WORDS) are taken back.
+    """
+    stem = cores[i].rstrip("-")
+    if not stem:
+        return -1
+    for n in range(3):
+        following = cores[i + 1:i + 2 + n]
+        if len(following) < n + 1 or n > len(kept_cores):
+            break
+        repeated = kept_cores[len(kept_cores) - n:]
+        if repeated == following[:n] and all(w in STUTTER_WORDS for w in repeated) and following[n].startswith(stem):
+            return n
+    return -1
+
+
+def strip_disfluencies(text: str) -> tuple:
+    """``(text, words removed)`` for one turn, dropping fillers, stutters and false starts."""
+    tokens = text.split()
+    cores = [word_core(token) for token in tokens]
+    kept, kept_cores = [], []
+    for i, token in enumerate(tokens):
+        core = cores[i]
+        restarted = false_start(kept_cores, cores, i) if token.endswith("-") else -1
+        stutter = (core in STUTTER_WORDS and kept and kept_cores[-1] == core
+                   and kept[-1][-1] not in WORD_PUNCTUATION)
+        if restarted > 0:
+            del kept[-restarted:], kept_cores[-restarted:]
+        if core in FILLER_WORDS or restarted >= 0 or stutter:
+            ending = token.rstrip("-")[-1:]
+            if ending in ".?!" and kept and kept[-1][-1] not in ".?!":
+                # Keep the sentence break the dropped word carried
+                kept[-1] = kept[-1].rstrip(",;:") + ending
+            elif ending == "," and kept and kept[-1].endswith(","):
+                # "at, um, 3" -> "at 3"
+                kept[-1] = kept[-1][:-1]
+            continue
+        if token[:1].islower() and i and cores[i - 1] in FILLER_WORDS and (not kept or kept[-1][-1] in ".?!"):
+            # "Um, so we..." -> "So we..."
+            token = token[0].upper() + token[1:]
+        kept.append(token)
+        kept_cores.append(core)
+    return " ".join(kept), len(tokens) - len(kept)
+
+
+def is_backchannel(text: str) -> bool:
+    """Whether a turn is nothing but backchannel phrases and filler words.
+    A question ("Okay?") never is.
+    """
+    tokens = text.split()
+    if len(tokens) > 4 or text.rstrip().endswith("?"):
+        return False
+    cores = [core for token in tokens if (core := word_core(token))]
+    phrases = [phrase.split() for phrase in BACKCHANNEL_PHRASES] + [[word] for word in FILLER_WORDS]
+    # Word positions reachable by a sequence of whole phrases
+    reachable = {0}
+    for i in range(len(cores)):
+        if i in reachable:
+            reachable.update(i + len(phrase) for phrase in phrases if cores[i:i + len(phrase)] == phrase)
+    return bool(cores) and len(cores) in reachable
+
+
+def may_be_question(text: str) -> bool:
+    """Whether a turn asks something anywhere, or ends without punctuation
+    (Deepgram leaves some questions unpunctuated), so a reply may answer it.
+    """
+    return "?" in text or text.rstrip()[-1:] not in ".!,;:…"
+
+
+def clinical_words(turns: list) -> Counter:
+    """Every word the condenser must keep: all but fillers, stutter words,
+    one-word backchannels and cut-off words. A turn that is only backchannel
+    phrases holds none.
+    """
+    removable = FILLER_WORDS | STUTTER_WORDS | {phrase for phrase in BACKCHANNEL_PHRASES if " " not in phrase}
+    return Counter(
+        core for _, text in turns if not is_backchannel(text) for token in text.split()
+        if (core := word_core(token)) and core not in removable and not token.endswith("-")
+    )
+
+
+def condense_transcript(transcript: str) -> CondensedTranscript:
+    """Condense a transcript for the note prompt. Lines are speaker turns,
+    labelled ``Name: ...`` or not; unlabelled lines are never merged.
+    Deterministic: the same transcript and word lists always give the same text.
+    """
+    turns = split_turns(transcript)
+    cleaned, disfluencies = [], 0
+    for label, text in turns:
+        text, removed = strip_disfluencies(text)
+        disfluencies += removed
+        if text:
+            cleaned.append((label, text))
+
+    condensed, kept, backchannels, merged = [], [], 0, 0
+    for i, (label, text) in enumerate(cleaned):
+        previous = condensed[-1] if condensed else None
+        following = cleaned[i + 1] if i + 1 < len(cleaned) else None
+        if (label is not None and previous and following and previous[0] == following[0] not in (None, label)
+                and not may_be_question(kept[-1][1]) and is_backchannel(text)):
+            backchannels += 1
+            continue
+        kept.append((label, text))
+        if label is not None and previous and previous[0] == label:
+            condensed[-1] = (label, f"{previous[1]} {text}")
+            merged += 1
+        else:
+            condensed.append((label, text))
+
+    separator = "\n\n" if "\n\n" in transcript else "\n"
+    text = separator.join(f"{label}: {body}" if label else body for label, body in condensed)
+    # Checked turn by turn, before merging, so a backchannel phrase stays one
+    if (disfluencies or backchannels) and clinical_words(kept) != clinical_words(turns):
+        text, disfluencies, backchannels, merged = transcript, 0, 0, 0
+    return CondensedTranscript(
+        text, estimate_tokens(transcript), estimate_tokens(text), disfluencies, backchannels, merged,
+    )
+
+
+def condense_version() -> str:
+    """Short hash of the condenser's word lists, part of the note cache key."""
+    lists = [FILLER_WORDS, BACKCHANNEL_PHRASES, STUTTER_WORDS]
+    return hashlib.sha256("\0".join(",".join(sorted(words)) for words in lists).encode()).hexdigest()[:16]
+
+
+CONDENSE_VERSION = condense_version()
+
+
+def prompt_transcript(transcript: str) -> str:
+    """The transcript as the note prompt gets it: condensed unless turned off."""
+    if not CONDENSE_TRANSCRIPT:
+        return transcript
+    condensed = condense_transcript(transcript)
+    increment("transcript_tokens_condensed_total", condensed.tokens_before - condensed.tokens_after)
+    return condensed.text
+
+
+def soap_prompt_version() -> str:
+    """Short hash of every prompt text that shapes the note.
+    It is part of the note cache key, so editing a prompt (or the tool
+    schema) invalidates previously cached notes automatically.
+    """
+    parts = [SOAP_SYSTEM_PROMPT, SOAP_OUTPUT_SPEC, json.dumps(SOAP_TOOLS, sort_keys=True), SEGMENT_SUMMARY_PROMPT]
+    return hashlib.sha256("\0".join(parts).encode()).hexdigest()[:16]
+
+
+SOAP_PROMPT_VERSION = soap_prompt_version()
+
+
+def soap_note_key(transcript: str, additional_context: str = "") -> str:
+    """Note cache key: whitespace-normalized transcript and context, model,
+    prompt version and condensing settings.
+    """
+    map_reduce = estimate_tokens(transcript) > SOAP_MAP_REDUCE_TOKENS
+    return content_key(" ".join(transcript.split()).encode(), {
+        "context": " ".join(additional_context.split()),
+        "model": SOAP_MODEL,
+        "prompt_version": SOAP_PROMPT_VERSION,
+        "condense": CONDENSE_VERSION if CONDENSE_TRANSCRIPT else None,
+        "map_reduce": (SOAP_MAP_REDUCE_TOKENS, SOAP_SEGMENT_TOKENS) if map_reduce else None,
+    })
+
+
+def cached_soap_note(transcript: str, additional_context: str = ""):
+    """The stored note for an identical request, or None."""
+    note_data = get_note_cache().get(soap_note_key(transcript, additional_context))
+    return SOAPNote(**note_data) if note_data is not None else None
+
+
+def session_context(client_name: str = "", session_date: str = "", session_length: str = "") -> str:
+    """The "Additional Context" string for a note from optional session details."""
+    context_parts = []
+    if client_name:
+        context_parts.append(f"Client Name: {client_name}")
+    if session_date:
+        context_parts.append(f"Session Date: {session_date}")
+    if session_length:
+        context_parts.append(f"Session Length: {session_length}")
+    return ". ".join(context_parts)
+
+
+def generate_soap_note(transcript: str, additional_context: str = "", use_cache: bool = True) -> SOAPNote:
+    """Generate a SOAP note from a session transcript.
+    When run as a background job, each field is published to the job as soon
+    as it has streamed in, so the UI can show sections before the note is done.
+    The prompt gets the condensed transcript (see ``condense_transcript``);
+    above SOAP_MAP_REDUCE_TOKENS it is summarized segment by segment first
+    (see ``summarize_transcript``). Notes are stored in the note cache under
+    the transcript as given; pass ``use_cache=False`` to skip the lookup
+    (e.g. when the caller has just checked ``cached_soap_note``).
+    """
+    if use_cache:
+        soap_note = cached_soap_note(transcript, additional_context)
+        if soap_note is not None:
+            return soap_note
+    key = soap_note_key(transcript, additional_context)
+    report_progress(0.1, "Generating clinical documentation...")
+    transcript = prompt_transcript(transcript)
+    summarized = estimate_tokens(transcript) > SOAP_MAP_REDUCE_TOKENS
+    if summarized:
+        transcript = summarize_transcript(transcript)
+    start = 0.5 if summarized else 0.1
+    fields_done = 0
+    for field, value in stream_soap_note(transcript, additional_context, summarized):
+        if field == "note":
+            if value.objective != PARSE_FAILURE_OBJECTIVE:
+                get_note_cache().set(key, value.model_dump())
+            return value
+        fields_done += 1
+        report_partial(field, value)
+        report_progress(start + (1 - start) * fields_done / len(SOAP_FIELDS), "Generating clinical documentation...")
+
+
+# Section-level regeneration. After a transcript edit only the sections that
+# mention the edited text are rewritten; the rest of the note is passed along
+# as context and kept verbatim. Instead of the whole edited transcript the
+# model reads the changed sentences with SECTION_CONTEXT_SENTENCES either
+# side, plus the current text of the sections it rewrites. When the edits
+# are spread so widely that the excerpt would be more than
+# SECTION_EXCERPT_MAX_SHARE of the transcript, the whole transcript is sent.
+SECTION_MAX_TOKENS = 1200
+SECTION_CONTEXT_SENTENCES = 3
+SECTION_EXCERPT_MAX_SHARE = 0.5
+
+STOPWORDS = frozenset("""
+    about after again also been before being could does doing from have having into just like more most
+    much only other over same some such than that their them then there these they this those through
+    very what when where which while will with would your client therapist session
+""".split())
+
+
+def content_words(text: str) -> set:
+    """Lower-cased words of four or more letters, minus common stopwords."""
+    return {word for word in re.findall(r"[a-z0-9']{4,}", text.lower()) if word not in STOPWORDS}
+
+
+def split_sentences(text: str) -> list:
+    """Sentences and speaker turns of a transcript, whitespace-normalized."""
+    pieces = re.split(r"(?<=[.!?])\s+|\n+", text)
+    return [" ".join(piece.split()) for piece in pieces if piece.strip()]
+
+
+def sentence_edits(old_sentences: list, new_sentences: list) -> list:
+    """``(i1, i2, j1, j2)`` of each run of sentences that differs between the two lists."""
+    matcher = difflib.SequenceMatcher(None, old_sentences, new_sentences, autojunk=False)
+    return [(i1, i2, j1, j2) for tag, i1, i2, j1, j2 in matcher.get_opcodes() if tag != "equal"]
+
+
+def transcript_changes(old: str, new: str) -> list:
+    """Sentences removed from ``old`` or added in ``new``."""
+    old_sentences, new_sentences = split_sentences(old), split_sentences(new)
+    changed = []
+    for i1, i2, j1, j2 in sentence_edits(old_sentences, new_sentences):
+        changed.extend(old_sentences[i1:i2] + new_sentences[j1:j2])
+    return changed
+
+
+def transcript_excerpt(old: str, new: str, context: int = SECTION_CONTEXT_SENTENCES) -> str | None:
+    """The edited passages of ``new`` with ``context`` sentences either side,
+    in transcript order with "[...]" for what is left out, followed by the
+    sentences the edits removed. None if nothing changed.
+    """
+    old_sentences, new_sentences = split_sentences(old), split_sentences(new)
+    edits = sentence_edits(old_sentences, new_sentences)
+    if not edits:
+        return None
+    shown, removed = set(), []
+    for i1, i2, j1, j2 in edits:
+        shown.update(range(max(0, j1 - context), min(len(new_sentences), j2 + context)))
+        removed.extend(old_sentences[i1:i2])
+    lines, previous = [], -1
+    for j in sorted(shown):
+        if j != previous + 1:
+            lines.append("[...]")
+        lines.append(new_sentences[j])
+        previous = j
+    if previous != len(new_sentences) - 1:
+        lines.append("[...]")
+    excerpt = "\n".join(lines)
+    if removed:
+        excerpt += "\n\nREMOVED BY THE EDIT:\n" + "\n".join(removed)
+    return excerpt
+
+
+def affected_sections(old_transcript: str, new_transcript: str, note: SOAPNote) -> list:
+    """Note fields that need rewriting after ``old_transcript`` was edited into ``new_transcript``.
+    A field is affected when it shares content words with a changed sentence.
+    Changes that no field mentions yet (new material) affect all four SOAP
+    sections; an unchanged transcript affects none.
+    """
+    changed = transcript_changes(old_transcript, new_transcript)
+    if not changed:
+        return []
+    words = content_words(" ".join(changed))
+    affected = [field for field in SOAP_FIELDS if words & content_words(getattr(note, field))]
+    return affected or [field for field, _ in SOAP_SECTIONS]
+
+
+def build_section_request(transcript: str, additional_context: str, note: SOAPNote, sections: list,
+                          summarized: bool = False, excerpt: str | None = None) -> dict:
+    """Messages API arguments for rewriting ``sections`` of ``note``.
+    Built on ``build_soap_request``; the instruction carries the kept sections
+    and the section tool is forced. With ``excerpt`` (see
+    ``transcript_excerpt``) the model gets that instead of ``transcript``,
+    along with the current text of the sections to rewrite.
+    """
+    request = build_soap_request(transcript, additional_context, summarized)
+    kept = "\n\n".join(
+        f"{field}: {getattr(note, field)}" for field in SOAP_FIELDS if field not in sections
+    )
+    if excerpt is None:
+        instruction = (
+            "The transcript above was edited after this SOAP note was written. The fields below are unchanged:\n\n"
+            f"{kept}\n\n"
+            f"Rewrite only these fields: {', '.join(sections)}. Keep them consistent with the unchanged fields."
+        )
+    else:
+        # Unique to this edit, so not worth a cache write
+        request["messages"][0]["content"][0] = {"type": "text", "text": f"TRANSCRIPT EDITS:\n{excerpt}"}
+        current = "\n\n".join(f"{field}: {getattr(note, field)}" for field in sections)
+        instruction = (
+            "The therapy session transcript was edited after this SOAP note was written. Above are the edited "
+            "passages with their surrounding lines; [...] marks transcript left out. The fields below are "
+            f"unchanged:\n\n{kept}\n\n"
+            f"These fields currently read:\n\n{current}\n\n"
+            f"Rewrite only these fields: {', '.join(sections)}. Update what the edits change and keep the rest. "
+            "Keep them consistent with the unchanged fields."
+        )
+    if additional_context:
+        instruction += f"\n\nAdditional Context: {additional_context}"
+    request["messages"][0]["content"][1] = {"type": "text", "text": instruction}
+    request["tool_choice"] = {"type": "tool", "name": SOAP_SECTION_TOOL_NAME}
+    request["max_tokens"] = SECTION_MAX_TOKENS
+    return request
+
+
+def regenerate_sections(transcript: str, additional_context: str, note: SOAPNote, sections: list,
+                        previous_transcript: str | None = None) -> SOAPNote:
+    """Rewrite only ``sections`` of ``note`` from the (edited) transcript.
+    Given the ``previous_transcript`` the note was written from, the model
+    reads only the edited passages (see ``SECTION_CONTEXT_SENTENCES``).
+    The other fields are published as job partials straight away and kept
+    verbatim. The updated note is stored in the note cache under the new
+    transcript, so generating it again is a cache hit.
+    """
+    sections = [field for field in SOAP_FIELDS if field in sections]
+    for field in SOAP_FIELDS:
+        if field not in sections:
+            report_partial(field, getattr(note, field))
+    report_progress(0.1, f"Regenerating {', '.join(sections)}...")
+
+    source = prompt_transcript(transcript)
+    excerpt = transcript_excerpt(previous_transcript, transcript) if previous_transcript is not None else None
+    if excerpt is not None and estimate_tokens(excerpt) <= SECTION_EXCERPT_MAX_SHARE * estimate_tokens(source):
+        request = build_section_request(source, additional_context, note, sections, excerpt=excerpt)
+    else:
+        summarized = estimate_tokens(source) > SOAP_MAP_REDUCE_TOKENS
+        source = summarize_transcript(source) if summarized else source
+        request = build_section_request(source, additional_context, note, sections, summarized)
+    done = 0
+    for field, value in stream_note_fields(request):
+        if field in sections:
+            done += 1
+            report_partial(field, value)
+            report_progress(0.1 + 0.9 * done / len(sections), f"Regenerating {', '.join(sections)}...")
+    response = value
+
+    updates = next((block.input for block in response.content if block.type == "tool_use"), None)
+    if not isinstance(updates, dict):
+        raise RuntimeError("Section regeneration returned no structured output")
+    note_data = note.model_dump(include=set(SOAP_FIELDS))
+    note_data.update({field: updates[field] for field in sections if isinstance(updates.get(field), str)})
+    increment("soap_sections_regenerated_total", len(sections))
+
+    soap_note = validate_soap_note(SOAPNote(**note_data))
+    get_note_cache().set(soap_note_key(transcript, additional_context), soap_note.model_dump())
+    return soap_note
+
+
+@span("validation")
+def validate_soap_note(note: SOAPNote) -> SOAPNote:
+    """Validate a SOAP note for completeness."""
+    validation_notes = []
+    
+    if note.client_name == "Not specified" or not note.client_name:
+        validation_notes.append("⚠️ Client name is missing")
+    
+    if note.session_length == "Not specified" or not note.session_length:
+        validation_notes.append("⚠️ Session length is missing")
+    
+    if len(note.subjective) < 20:
+        validation_notes.append("⚠️ Subjective section may be incomplete")
+    
+    if len(note.objective) < 20:
+        validation_notes.append("⚠️ Objective section may be incomplete")
+    
+    if len(note.assessment) < 20:
+        validation_notes.append("⚠️ Assessment section may be incomplete")
+    
+    if len(note.plan) < 20:
+        validation_notes.append("⚠️ Plan section may be incomplete")
+    
+    note.validation_notes = validation_notes
+    note.is_complete = len(validation_notes) == 0
+    
+    return note
+
+
+# Export formats, in download-button order. Renderers run only when a
+# download is clicked, once per note (see NoteExports).
+ExportFormat = namedtuple("ExportFormat", "label extension mime render")
+EXPORT_FORMATS: dict[str, ExportFormat] = {}
+
+
+def export_format(name: str, label: str, extension: str, mime: str):
+    """Register ``render(note) -> str | bytes`` as an export format."""
+    def register(render):
+        EXPORT_FORMATS[name] = ExportFormat(label, extension, mime, render)
+        return render
+    return register
+
+
+@export_format("text", "📄 Download as Text", "txt", "text/plain")
+@span("export")
+def note_as_text(note: SOAPNote) -> str:
+    """Plain-text export of a note."""
+    return f"""SOAP NOTE
+Generated: {datetime.now().strftime('%Y-%m-%d %H:%M')}
+Client: {note.client_name}
+Date: {note.session_date}
+Session Length: {note.session_length}
+Clinical Tone: {note.clinical_tone}
+
+SUBJECTIVE:
+{note.subjective}
+
+OBJECTIVE:
+{note.objective}
+
+ASSESSMENT:
+{note.assessment}
+
+PLAN:
+{note.plan}
+
+---
+Validation Status: {"Complete" if note.is_complete else "Warnings Present"}
+"""
+
+
+@export_format("json", "🔗 Download as JSON (EMR)", "json", "application/json")
+@span("export")
+def note_as_json(note: SOAPNote) -> str:
+    """JSON export of a note for EMR import."""
+    return json.dumps(note.model_dump(), indent=2)
+
+
+class NoteExports:
+    """Export payloads of one stored note, rendered on first request and kept
+    as ``owner``'s artifacts. Notes are replaced, never edited, so a new note
+    gets a new instance. Thread-safe: download buttons fetch their data off
+    the script thread.
+    """
+
+    def __init__(self, store: ArtifactStore, owner: str, note_handle: str):
+        self.store = store
+        self.owner = owner
+        self.note_handle = note_handle
+        self._payloads: dict[str, str] = {}  # format -> artifact handle
+        self._lock = threading.Lock()
+
+    def render(self, name: str) -> bytes:
+        with self._lock:
+            if name not in self._payloads:
+                note = SOAPNote.model_validate_json(self.store.get(self.note_handle))
+                self._payloads[name] = self.store.put(self.owner, EXPORT_FORMATS[name].render(note))
+            return self.store.get(self._payloads[name])
+
+    def release(self) -> None:
+        """Drop the rendered payloads."""
+        with self._lock:
+            for handle in self._payloads.values():
+                self.store.release(self.owner, handle)
+            self._payloads.clear()
+
+    def loader(self, name: str):
+        """A zero-argument callable for ``st.download_button(data=...)``."""
+        return functools.partial(self.render, name)
+
+
+# ============================================================
+# BACKGROUND JOBS
+# ============================================================
+
+# Transcription and note generation run as background jobs so a slow API
+# call never holds a Streamlit script thread. One asyncio loop per process
+# schedules every session's jobs; blocking work runs on a worker pool whose
+# size is the global concurrency cap, and the UI polls job progress.
+JOB_MAX_CONCURRENCY = int(os.environ.get("MOONLIGHT_JOB_CONCURRENCY", "8"))
+JOB_RETENTION_SECONDS = 3600.0
+JOB_POLL_SECONDS = 1.0
+
+@st.cache_resource
+def current_job_var() -> contextvars.ContextVar:
+    """The process-wide "job running in this context" variable. Like the
+    metrics registry it must outlive a rerun: the cached engine sets it, and
+    job functions from later reruns read it.
+    """
+    return contextvars.ContextVar("current_job", default=None)
+
+
+_current_job = current_job_var()
+
+
+def report_partial(key: str, value) -> None:
+    """Publish part of the running job's result before it finishes."""
+    job = _current_job.get()
+    if job is not None:
+        job.partial[key] = value
+
+
+def report_progress(fraction: float, message: str = "") -> None:
+    """Update the running job's progress; a no-op outside a background job."""
+    job = _current_job.get()
+    if job is not None:
+        job.progress = max(0.0, min(1.0, fraction))
+        if message:
+            job.message = message
+
+
+class Job:
+    """Handle for one background job. Fields are updated by the engine."""
+
+    def __init__(self, owner: str, kind: str):
+        self.id = uuid.uuid4().hex
+        self.owner = owner
+        self.kind = kind
+        self.status = "queued"
+        self.progress = 0.0
+        self.message = "Waiting for a free worker"
+        self.result = None
+        self.partial = {}
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("done", "failed")
+
+
+class JobEngine:
+    """Process-wide asyncio scheduler for background jobs.
+    ``submit`` is safe to call from any thread and returns immediately with a
+    job id; at most ``max_workers`` jobs run at once, the rest wait queued.
+    With a ``store``, the engine is also a worker for durable jobs: it leases
+    queued (or abandoned) jobs from the store whenever it has a free slot.
+    """
+
+    def __init__(self, max_workers: int = JOB_MAX_CONCURRENCY, store=None):
+        self.max_workers = max_workers
+        self.store = store
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._jobs: dict[str, Job] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="moonlight-job")
+        self._loop = asyncio.new_event_loop()
+        self._slots = asyncio.Semaphore(max_workers)
+        self._wakeup = asyncio.Event()
+        threading.Thread(target=self._loop.run_forever, name="moonlight-jobs", daemon=True).start()
+        if store is not None:
+            asyncio.run_coroutine_threadsafe(self._poll_store(), self._loop)
+
+    def submit(self, owner: str, kind: str, fn, *args, **kwargs) -> str:
+        """Schedule ``fn(*args, **kwargs)`` and return the new job's id."""
+        job = Job(owner, kind)
+        with self._lock:
+            self._purge()
+            self._jobs[job.id] = job
+        # Scheduled from an empty context: the job must not inherit the submitting
+        # script run's Streamlit state (a fragment's, say), which outlives the run
+        contextvars.Context().run(
+            asyncio.run_coroutine_threadsafe, self._run(job, functools.partial(fn, *args, **kwargs)), self._loop,
+        )
+        increment(f"{kind}_jobs_submitted_total")
+        return job.id
+
+    def submit_stored(self, owner: str, kind: str, params: dict, audio=None) -> str:
+        """Queue a durable job (see ``JOB_PIPELINES``) in the store and return its id."""
+        job_id = self.store.create(owner, kind, params, audio)
+        self._loop.call_soon_threadsafe(self._wakeup.set)
+        increment(f"{kind}_jobs_submitted_total")
+        return job_id
+
+    async def _run(self, job: Job, call) -> None:
+        async with self._slots:
+            await self._execute(job, call)
+
+    async def _execute(self, job: Job, call) -> None:
+        job.status = "running"
+        job.message = "Starting"
+        job.started = time.time()
+        observe("job_queue", job.started - job.created)
+        context = contextvars.copy_context()
+        context.run(_current_job.set, job)
+        try:
+            job.result = await self._loop.run_in_executor(self._executor, context.run, call)
+            job.status = "done"
+            job.progress = 1.0
+        except Exception as e:
+            # Some exceptions (InvalidTag, a bare TimeoutError) have no message
+            job.error = str(e) or type(e).__name__
+            job.status = "failed"
+            increment(f"{job.kind}_jobs_failed_total")
+        finally:
+            job.finished = time.time()
+
+    async def _poll_store(self) -> None:
+        """Lease durable jobs while there is capacity; sleep until woken or the next poll."""
+        while True:
+            await self._slots.acquire()
+            try:
+                row = await self._loop.run_in_executor(None, self.store.lease, self.worker_id)
+            except Exception as e:
+                print(f"Job store lease failed: {e}")
+                row = None
+            if row is None:
+                self._slots.release()
+                self._wakeup.clear()
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._wakeup.wait(), JOB_HEARTBEAT_SECONDS)
+                continue
+            job = Job(row["owner"], row["kind"])
+            job.id, job.created = row["id"], row["created"]
+            with self._lock:
+                self._purge()
+                self._jobs[job.id] = job
+            self._loop.create_task(self._run_stored(job, row["params"]))
+
+    async def _run_stored(self, job: Job, params: dict) -> None:
+        lease_lost = threading.Event()
+        heartbeat = self._loop.create_task(self._heartbeat(job, lease_lost))
+        try:
+            await self._execute(job, functools.partial(run_stored_job, self.store, job.id, job.kind, params, lease_lost))
+        finally:
+            heartbeat.cancel()
+            self._slots.release()
+            if lease_lost.is_set():
+                # Another worker owns the job now; the store has its state
+                with self._lock:
+                    self._jobs.pop(job.id, None)
+            else:
+                await self._loop.run_in_executor(
+                    None, self.store.finish, job.id, self.worker_id, job.status, job.error,
+                )
+
+    async def _heartbeat(self, job: Job, lease_lost: threading.Event) -> None:
+        """Renew the job's lease and publish its progress to other processes.
+        Sets ``lease_lost`` and stops if the lease expired and was taken over.
+        """
+        while True:
+            await asyncio.sleep(JOB_HEARTBEAT_SECONDS)
+            renewed = await self._loop.run_in_executor(
+                None, self.store.renew, job.id, self.worker_id, job.progress, job.message,
+            )
+            if not renewed:
+                increment("job_leases_lost_total")
+                lease_lost.set()
+                return
+
+    def get(self, job_id):
+        """A job by id: in-memory if this process ran it, else from the store."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None and job_id and self.store is not None:
+            job = self.store.load_job(job_id)
+        return job
+
+    def jobs_for(self, owner: str) -> list:
+        """An owner's jobs, oldest first, including durable jobs from the store."""
+        with self._lock:
+            jobs = {job.id: job for job in self._jobs.values() if job.owner == owner}
+        if self.store is not None:
+            for job in self.store.jobs_for(owner):
+                jobs.setdefault(job.id, job)
+        return sorted(jobs.values(), key=lambda job: job.created)
+
+    def _purge(self) -> None:
+        cutoff = time.time() - JOB_RETENTION_SECONDS
+        for job_id in [j.id for j in self._jobs.values() if j.finished and j.finished < cutoff]:
+            del self._jobs[job_id]
+
+
+@st.cache_resource
+def get_job_engine() -> JobEngine:
+    """Process-wide job engine shared by every session."""
+    return JobEngine(store=get_job_store())
+
+
+# ============================================================
+# JOB STORE
+# ============================================================
+
+# Durable job state. With MOONLIGHT_JOB_DB and CACHE_ENCRYPTION_KEY set, jobs
+# and the output of every completed stage live in SQLite (WAL mode), so a
+# browser refresh or a server restart resumes a job from its last completed
+# stage instead of paying for transcription again. Every JobEngine on the
+# database (the app and any worker.py processes) leases queued jobs; a lease
+# that is not renewed expires and another worker picks the job up.
+JOB_DB_PATH = os.environ.get("MOONLIGHT_JOB_DB", "")
+JOB_LEASE_SECONDS = float(os.environ.get("MOONLIGHT_JOB_LEASE_SECONDS", "60"))
+JOB_HEARTBEAT_SECONDS = 5.0
+JOB_MAX_ATTEMPTS = 3
+
+JOB_STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    params BLOB NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    progress REAL NOT NULL DEFAULT 0,
+    message TEXT NOT NULL DEFAULT '',
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    lease_owner TEXT,
+    lease_expires REAL,
+    created REAL NOT NULL,
+    finished REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_by_status ON jobs (status, created);
+CREATE INDEX IF NOT EXISTS jobs_by_owner ON jobs (owner, created);
+CREATE TABLE IF NOT EXISTS stages (
+    job_id TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    stage_key TEXT NOT NULL,
+    payload BLOB NOT NULL,
+    created REAL NOT NULL,
+    PRIMARY KEY (job_id, stage)
+);
+CREATE INDEX IF NOT EXISTS stages_by_key ON stages (stage_key);
+"""
+
+
+def derive_key(secret: str, purpose: bytes) -> bytes:
+    """A 256-bit key for ``purpose`` derived (HKDF-SHA256) from a configured secret."""
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=purpose).derive(secret.encode())
+
+
+class JobStore:
+    """SQLite (WAL) store of durable jobs and their completed stages.
+    Job params and stage payloads are Fernet-encrypted; uploaded audio is
+    written next to the database with a ``ChunkedCipher`` (under a key derived
+    from the same secret), streamed in and out a chunk at a time. Stage writes are
+    idempotent: each stage is recorded once per job, and a stage key that
+    any job has already completed is reused instead of recomputed.
+    """
+
+    def __init__(self, path: str, key: str):
+        from cryptography.fernet import Fernet
+
+        self.path = path
+        self._fernet = Fernet(key)
+        self._local = threading.local()
+        self._audio = ChunkedCipher(derive_key(key, b"moonlight job audio"))
+        self.audio_dir = f"{path}.audio"
+        os.makedirs(self.audio_dir, mode=0o700, exist_ok=True)
+        self._db().executescript(JOB_STORE_SCHEMA)
+
+    def _db(self) -> sqlite3.Connection:
+        # One connection per thread; WAL lets readers proceed during a write
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30.0, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def _encrypt(self, value) -> bytes:
+        return self._fernet.encrypt(json.dumps(value).encode())
+
+    def _decrypt(self, token: bytes):
+        return json.loads(self._fernet.decrypt(token))
+
+    def _audio_path(self, blob: str) -> str:
+        return os.path.join(self.audio_dir, f"{blob}.bin")
+
+    def create(self, owner: str, kind: str, params: dict, audio=None) -> str:
+        """Insert a queued job; ``audio`` (a buffer, a file-like object or an
+        iterable of byte pieces) is stored as its "uploaded" stage.
+        """
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        if audio is not None:
+            tmp_path = os.path.join(self.audio_dir, f"{job_id}.tmp")
+            try:
+                blob, size = self._audio.write(tmp_path, audio)
+            except BaseException:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(tmp_path)
+                raise
+            os.replace(tmp_path, self._audio_path(blob))
+        with self._transaction() as db:
+            db.execute(
+                "INSERT INTO jobs (id, owner, kind, params, created) VALUES (?, ?, ?, ?, ?)",
+                (job_id, owner, kind, self._encrypt(params), now),
+            )
+            if audio is not None:
+                db.execute(
+                    "INSERT INTO stages (job_id, stage, stage_key, payload, created) VALUES (?, ?, ?, ?, ?)",
+                    (job_id, "uploaded", blob, self._encrypt({"blob": blob, "bytes": size}), now),
+                )
+        return job_id
+
+    def lease(self, worker: str):
+        """Claim the oldest runnable job for ``worker``.
+        Runnable means queued, or running under a lease that has expired (its
+        worker died). Jobs that have used up JOB_MAX_ATTEMPTS are failed.
+        Returns the job row with decrypted ``params``, or None.
+        """
+        now = time.time()
+        with self._transaction() as db:
+            db.execute(
+                "UPDATE jobs SET status = 'failed', error = 'Gave up after repeated worker failures', finished = ? "
+                "WHERE status = 'running' AND lease_expires < ? AND attempts >= ?",
+                (now, now, JOB_MAX_ATTEMPTS),
+            )
+            row = db.execute(
+                "SELECT * FROM jobs WHERE status = 'queued' OR (status = 'running' AND lease_expires < ?) "
+                "ORDER BY created LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is None:
+                return None
+            db.execute(
+                "UPDATE jobs SET status = 'running', lease_owner = ?, lease_expires = ?, attempts = attempts + 1 "
+                "WHERE id = ?",
+                (worker, now + JOB_LEASE_SECONDS, row["id"]),
+            )
+        return {**dict(row), "params": self._decrypt(row["params"])}
+
+    def renew(self, job_id: str, worker: str, progress: float, message: str) -> bool:
+        """Extend ``worker``'s lease and record progress; False if the lease was lost."""
+        cursor = self._db().execute(
+            "UPDATE jobs SET lease_expires = ?, progress = ?, message = ? "
+            "WHERE id = ? AND lease_owner = ? AND status = 'running'",
+            (time.time() + JOB_LEASE_SECONDS, progress, message, job_id, worker),
+        )
+        return cursor.rowcount == 1
+
+    def finish(self, job_id: str, worker: str, status: str, error: str | None = None) -> None:
+        """Mark a leased job ``status`` ("done" or "failed", with ``error``) and release the lease."""
+        self._db().execute(
+            "UPDATE jobs SET status = ?, error = ?, progress = ?, finished = ?, lease_owner = NULL "
+            "WHERE id = ? AND lease_owner = ?",
+            (status, error, 1.0 if status == "done" else 0.0, time.time(), job_id, worker),
+        )
+
+    def stage(self, job_id: str, stage: str):
+        """Payload of a stage this job has completed, or None."""
+        row = self._db().execute(
+            "SELECT payload FROM stages WHERE job_id = ? AND stage = ?", (job_id, stage),
+        ).fetchone()
+        return self._decrypt(row["payload"]) if row else None
+
+    def find_stage(self, stage_key: str):
+        """Payload of any job's completed stage with this key, or None."""
+        row = self._db().execute(
+            "SELECT payload FROM stages WHERE stage_key = ? LIMIT 1", (stage_key,),
+        ).fetchone()
+        return self._decrypt(row["payload"]) if row else None
+
+    def complete_stage(self, job_id: str, stage: str, stage_key: str, payload) -> None:
+        """Record a stage's output; a repeated write for the same job and stage is ignored."""
+        self._db().execute(
+            "INSERT OR IGNORE INTO stages (job_id, stage, stage_key, payload, created) VALUES (?, ?, ?, ?, ?)",
+            (job_id, stage, stage_key, self._encrypt(payload), time.time()),
+        )
+
+    def _as_job(self, row) -> Job:
+        job = Job(row["owner"], row["kind"])
+        job.id, job.created, job.finished = row["id"], row["created"], row["finished"]
+        job.status, job.progress, job.error = row["status"], row["progress"], row["error"]
+        job.message = row["message"] or {"queued": "Waiting for a free worker", "running": "Running"}.get(job.status, "")
+        if job.status == "done":
+            job.result = self.stage(job.id, JOB_PIPELINES[job.kind][-1])
+        return job
+
+    def load_job(self, job_id: str):
+        """A ``Job`` snapshot of a stored job (with its result once done), or None."""
+        row = self._db().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._as_job(row) if row else None
+
+    def jobs_for(self, owner: str) -> list:
+        rows = self._db().execute("SELECT * FROM jobs WHERE owner = ? ORDER BY created", (owner,)).fetchall()
+        return [self._as_job(row) for row in rows]
+
+    def load_audio(self, blob: str) -> bytearray | None:
+        """The uploaded audio stored as ``blob``, or None once purged."""
+        try:
+            return self._audio.read(self._audio_path(blob))
+        except FileNotFoundError:
+            return None
+
+    def purge(self, older_than: float = CACHE_TTL_SECONDS) -> None:
+        """Delete finished jobs (and their stages) and uploaded audio older than ``older_than`` seconds."""
+        cutoff = time.time() - older_than
+        with self._transaction() as db:
+            db.execute("DELETE FROM stages WHERE job_id IN (SELECT id FROM jobs WHERE finished < ?)", (cutoff,))
+            db.execute("DELETE FROM jobs WHERE finished < ?", (cutoff,))
+        for entry in os.scandir(self.audio_dir):
+            with contextlib.suppress(FileNotFoundError):
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+
+
+def transcribed_stage(store: JobStore, job_id: str, params: dict, upload: dict):
+    """Stage key and runner for transcribing the job's uploaded audio."""
+    key = content_key(upload["blob"].encode(), {"stage": "transcribed", **params})
+
+    def run():
+        audio = store.load_audio(upload["blob"])
+        if audio is None:
+            raise RuntimeError("The uploaded audio has expired; please upload it again")
+        return transcribe_audio(audio, params["mimetype"], preprocess=params["preprocess"], trim=params["preprocess"])
+    return key, run
+
+
+def generated_stage(store: JobStore, job_id: str, params: dict, transcription):
+    """Stage key and runner for generating the note from the (given or transcribed) transcript."""
+    transcript = params.get("transcript") or transcription["transcript"]
+    context = params.get("context", "")
+
+    def run():
+        return generate_soap_note(transcript, context, use_cache=params.get("use_cache", True)).model_dump()
+    return soap_note_key(transcript, context), run
+
+
+def validated_stage(store: JobStore, job_id: str, params: dict, note: dict):
+    """Stage key and runner for validating the generated note."""
+    key = content_key(json.dumps(note, sort_keys=True).encode(), {"stage": "validated"})
+    return key, lambda: validate_soap_note(SOAPNote(**note)).model_dump()
+
+
+JOB_STAGES = {"transcribed": transcribed_stage, "generated": generated_stage, "validated": validated_stage}
+
+# Stages each durable job kind runs after "uploaded"; the last one's payload is the result
+JOB_PIPELINES = {
+    "transcribe": ["transcribed"],
+    "generate": ["generated", "validated"],
+    "pipeline": ["transcribed", "generated", "validated"],
+}
+
+
+def run_stored_job(store: JobStore, job_id: str, kind: str, params: dict, lease_lost=None):
+    """Run a durable job's remaining stages and return the last stage's payload.
+    Each stage runs on the previous stage's payload. Stages this job completed
+    before a crash are skipped, and unless ``params["use_cache"]`` is False, a
+    stage whose key another job already completed reuses that output. A note
+    that could not be parsed is passed on but not recorded, so it is never
+    reused. Stops once ``lease_lost`` (a ``threading.Event``) is set.
+    """
+    payload = store.stage(job_id, "uploaded")
+    for stage in JOB_PIPELINES[kind]:
+        if lease_lost is not None and lease_lost.is_set():
+            raise RuntimeError("Lost the job's lease to another worker")
+        previous, payload = payload, store.stage(job_id, stage)
+        if payload is not None:
+            increment("job_stages_resumed_total")
+            continue
+        key, run = JOB_STAGES[stage](store, job_id, params, previous)
+        payload = store.find_stage(key) if params.get("use_cache", True) else None
+        if payload is None:
+            payload = run()
+        else:
+            increment("job_stages_reused_total")
+        if stage == "generated" and payload["objective"] == PARSE_FAILURE_OBJECTIVE:
+            continue
+        if lease_lost is not None and lease_lost.is_set():
+            raise RuntimeError("Lost the job's lease to another worker")
+        store.complete_stage(job_id, stage, key, payload)
+    return payload
+
+
+@st.cache_resource
+def get_job_store():
+    """Process-wide durable job store, or None when not configured."""
+    encryption_key = get_secret("CACHE_ENCRYPTION_KEY", default=None)
+    if not (JOB_DB_PATH and encryption_key):
+        return None
+    store = JobStore(JOB_DB_PATH, encryption_key)
+    store.purge()
+    return store
+
+
+# ============================================================
+# STREAMLIT UI
+# ============================================================
+
+# Session-state keys that hold artifact handles rather than values
+ARTIFACT_KEYS = ("audio", "transcription", "transcript", "soap_note", "note_transcript", "pending_note_transcript")
+
+
+def session_store() -> ArtifactStore:
+    """The artifact store, with this session marked active. Fragments rerun
+    without ``main()``, so every artifact access counts as activity.
+    """
+    store = get_artifact_store()
+    store.touch(st.session_state.artifact_owner)
+    return store
+
+
+def keep_artifact(key: str, data) -> None:
+    """Store ``data`` (or None) as this session's ``key`` artifact, releasing the one it replaces."""
+    store = session_store()
+    previous = st.session_state.get(key)
+    st.session_state[key] = None if data is None else store.put(st.session_state.artifact_owner, data)
+    if previous:
+        store.release(st.session_state.artifact_owner, previous)
+
+
+def move_artifact(source: str, target: str) -> None:
+    """Hand the ``source`` artifact's reference over to ``target``."""
+    previous = st.session_state.get(target)
+    st.session_state[target] = st.session_state.get(source)
+    st.session_state[source] = None
+    if previous:
+        get_artifact_store().release(st.session_state.artifact_owner, previous)
+
+
+def load_artifact(key: str) -> bytes | None:
+    """This session's ``key`` artifact. If the session sat idle for long
+    enough to lose its artifacts, start it over instead.
+    """
+    handle = st.session_state.get(key)
+    if handle is None:
+        return None
+    try:
+        return session_store().get(handle)
+    except KeyError:
+        reset_session()
+        st.session_state.session_expired = True
+        st.rerun()
+
+
+def load_text(key: str) -> str | None:
+    data = load_artifact(key)
+    return None if data is None else data.decode()
+
+
+def load_note() -> SOAPNote | None:
+    data = load_artifact("soap_note")
+    return None if data is None else SOAPNote.model_validate_json(data)
+
+
+def reset_session() -> None:
+    """Clear the workflow under a new session id, releasing the old session's artifacts."""
+    get_artifact_store().release_owner(st.session_state.artifact_owner)
+    for key in ARTIFACT_KEYS:
+        st.session_state[key] = None
+    st.session_state.note_exports = None
+    st.session_state.audio_stats = None
+    st.session_state.vad_stats = None
+    st.session_state.talk_time = None
+    st.session_state.step = 1
+    st.session_state.session_id = uuid.uuid4().hex
+    st.session_state.session_link_renew = 0.0
+    publish_session_link()
+
+
+def drop_upload(upload) -> None:
+    """Free Streamlit's in-memory copy of an upload, which it otherwise keeps
+    until the browser session ends.
+    """
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+    ctx = get_script_run_ctx()
+    remove_file = getattr(ctx and ctx.uploaded_file_mgr, "remove_file", None)
+    if remove_file is not None:
+        remove_file(session_id=ctx.session_id, file_id=upload.file_id)
+
+
+def apply_transcription(result: dict) -> str:
+    """Store a finished transcription in the session, advance to Step 2 and return the status message."""
+    keep_artifact("transcription", json.dumps(result))
+    keep_artifact("transcript", speaker_transcript(result))
+    # Transcribed: the recording itself is no longer needed
+    keep_artifact("audio", None)
+    st.session_state.confidence = result.get('confidence', 0)
+    st.session_state.audio_stats = result.get('preprocessing')
+    st.session_state.vad_stats = result.get('silence_trimming')
+    talk_time = WordTable.from_result(result).talk_time()
+    st.session_state.talk_time = talk_time if len(talk_time) > 1 else None
+    st.session_state.step = 2
+    return f"✅ Transcription complete! Confidence: {st.session_state.confidence:.1%}"
+
+
+def apply_soap_note(soap_note) -> str:
+    """Store a finished SOAP note in the session, advance to Step 4 and return the status message.
+    Durable jobs return the note as a dict.
+    """
+    if isinstance(soap_note, dict):
+        soap_note = SOAPNote(**soap_note)
+    keep_artifact("soap_note", soap_note.model_dump_json())
+    move_artifact("pending_note_transcript", "note_transcript")
+    st.session_state.step = 4
+    return "✅ SOAP note generated!"
+
+
+def transcribe_artifact(handle: str, mimetype: str, optimize: bool) -> dict:
+    """Transcription job for a recording held in the artifact store."""
+    return transcribe_audio(get_artifact_store().get(handle), mimetype, preprocess=optimize, trim=optimize)
+
+
+def submit_transcription(upload, mimetype: str, optimize: bool) -> None:
+    """Move an upload into the artifact store and start this session's
+    transcription job on it; durable when the job store is configured. The
+    input widgets are cleared, so the session keeps only a handle to the audio.
+    """
+    keep_artifact("audio", upload.getbuffer())
+    drop_upload(upload)
+    engine = get_job_engine()
+    if engine.store is not None:
+        st.session_state.transcribe_job = engine.submit_stored(
+            st.session_state.session_id, "transcribe", {"mimetype": mimetype, "preprocess": optimize},
+            audio=get_artifact_store().chunks(st.session_state.audio),
+        )
+    else:
+        st.session_state.transcribe_job = engine.submit(
+            st.session_state.session_id, "transcribe", transcribe_artifact, st.session_state.audio, mimetype, optimize,
+        )
+    st.session_state.input_generation += 1
+    st.rerun()
+
+
+def submit_generation(transcript: str, additional_context: str) -> str:
+    """Start this session's note generation job; the caller has already checked the note cache."""
+    engine = get_job_engine()
+    if engine.store is not None:
+        return engine.submit_stored(
+            st.session_state.session_id, "generate",
+            {"transcript": transcript, "context": additional_context, "use_cache": False},
+        )
+    return engine.submit(
+        st.session_state.session_id, "generate", generate_soap_note,
+        transcript, additional_context, use_cache=False,
+    )
+
+
+# A browser refresh finds its session's jobs again through a link token in
+# the URL: the session id and an expiry, HMAC-signed with a server secret.
+# The token is renewed while the page is in use and is worth nothing after
+# SESSION_LINK_SECONDS, so a copied or logged URL does not open the session.
+SESSION_LINK_SECONDS = float(os.environ.get("MOONLIGHT_SESSION_LINK_SECONDS", "900"))
+
+
+@st.cache_resource
+def session_link_key() -> bytes:
+    """Key for signing session links. Derived from CACHE_ENCRYPTION_KEY when
+    set, so links outlive a restart as the job store does; otherwise random
+    per process.
+    """
+    secret = get_secret("CACHE_ENCRYPTION_KEY", default=None)
+    return derive_key(secret, b"moonlight session link") if secret else os.urandom(32)
+
+
+def sign_session_link(session_id: str, expires: float) -> str:
+    message = f"{session_id}.{int(expires)}"
+    signature = hmac.new(session_link_key(), message.encode(), hashlib.sha256).hexdigest()
+    return f"{message}.{signature}"
+
+
+def verify_session_link(token: str) -> str | None:
+    """The session id in a genuine, unexpired link token, or None."""
+    session_id, _, expires = token.rpartition(".")[0].partition(".")
+    if not expires.isdigit() or int(expires) < time.time():
+        return None
+    return session_id if hmac.compare_digest(token, sign_session_link(session_id, int(expires))) else None
+
+
+def publish_session_link() -> None:
+    """Put a link token for this session in the URL, renewed once half its lifetime has passed."""
+    now = time.time()
+    if now < st.session_state.get("session_link_renew", 0.0):
+        return
+    st.query_params["session"] = sign_session_link(st.session_state.session_id, now + SESSION_LINK_SECONDS)
+    st.session_state.session_link_renew = now + SESSION_LINK_SECONDS / 2
+
+
+def restore_jobs(owner: str) -> None:
+    """Reattach a reloaded page to its session's latest jobs, so running jobs
+    keep reporting progress and finished ones are applied again.
+    """
+    for job in get_job_engine().jobs_for(owner):
+        if job.status != "failed":
+            st.session_state["transcribe_job" if job.kind == "transcribe" else "generate_job"] = job.id
+
+
+@st.cache_resource
+def heap_freeze_state() -> dict:
+    return {"lock": threading.Lock(), "frozen": None}
+
+
+def freeze_heap() -> None:
+    """Move the live heap (modules, SDK clients, pydantic models) out of the
+    garbage collector's reach, at most once per GC_REFREEZE_SECONDS per
+    process. Walking it after every run cost more than rendering the page.
+    Unfreezing first lets the collection free whatever was frozen and has
+    died since.
+    """
+    state = heap_freeze_state()
+    if state["frozen"] is not None and time.monotonic() - state["frozen"] < GC_REFREEZE_SECONDS:
+        return
+    if not state["lock"].acquire(blocking=False):
+        return
     try:
-        # Log audio file size for debugging
-        audio_size_mb = len(audio_bytes) / (1024 * 1024)
-        print(f"Transcribing audio file: {audio_size_mb:.2f} MB")
-        
-        response = httpx.post(url, params=params, headers=headers, content=audio_bytes, timeout=timeout)
-        response.raise_for_status()
-    except httpx.TimeoutException:
-        raise RuntimeError(f"Transcription timed out. Audio file may be too large ({audio_size_mb:.2f} MB). Try using a shorter recording or lower quality audio.")
-    except Exception as e:
-        # Propagate a clear error message for the UI
-        raise RuntimeError(f"Deepgram transcription failed: {e}")
-    data = response.json()
-    transcript = data["results"]["channels"][0]["alternatives"][0]["transcript"]
-    confidence = data["results"]["channels"][0]["alternatives"][0]["confidence"]
-    return {"transcript": transcript, "confidence": confidence}
+        gc.unfreeze()
+        gc.collect()
+        gc.freeze()
+        state["frozen"] = time.monotonic()
+    finally:
+        state["lock"].release()
 
 
-# ============================================================
-# SOAP NOTE GENERATOR
-# ============================================================
+def render_soap_section(text: str) -> None:
+    """Render one SOAP section body in the note card style."""
+    st.markdown(f'<div class="soap-section">{text}</div>', unsafe_allow_html=True)
 
-class SOAPNote(BaseModel):
-    """Structured SOAP note model."""
-    client_name: str = Field(description="Client's name or identifier")
-    session_date: str = Field(description="Date of the session")
-    session_length: str = Field(description="Duration of the session")
-    subjective: str = Field(description="Client's reported symptoms, feelings, and concerns")
-    objective: str = Field(description="Clinician's observations during the session")
-    assessment: str = Field(description="Clinical assessment and analysis")
-    plan: str = Field(description="Treatment plan and next steps")
-    clinical_tone: str = Field(default="Not specified", description="Overall clinical tone/presentation")
-    is_complete: bool = Field(default=False)
-    validation_notes: list = Field(default_factory=list)
 
+def render_partial_note(partial: dict) -> None:
+    """Step 4 while the note streams in: finished sections, placeholders for the rest."""
+    st.markdown("---")
+    st.subheader("📋 Step 4: Review & Validate")
+    for field, title in SOAP_SECTIONS:
+        st.markdown(f"#### {title}")
+        if field in partial:
+            render_soap_section(partial[field])
+        else:
+            st.caption("⏳ Drafting...")
 
-SOAP_SYSTEM_PROMPT = """You are an experienced clinical documentation specialist at a substance abuse treatment center. Your role is to generate accurate, professional SOAP notes from therapy session transcripts.
 
-IMPORTANT GUIDELINES:
-1. Use professional clinical terminology while maintaining warmth and person-centered language
-2. Never fabricate information - only document what is clearly stated or observed in the transcript
-3. If information is unclear or missing, note it as "Not documented in session"
-4. Be specific about substance use history, triggers, and recovery progress when mentioned
-5. Include relevant recovery milestones (clean time, meeting attendance, sponsor contact) when discussed
-6. Document emotional states accurately - people in recovery deserve to have their experiences validated
-7. Keep notes concise but thorough enough for insurance documentation requirements
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def render_job_progress(state_key: str, on_done, error_prefix: str, render_partial=None) -> None:
+    """Poll a background job; when it finishes, apply its result and rerun the app."""
+    job = get_job_engine().get(st.session_state.get(state_key))
+    if job is None:
+        st.session_state[state_key] = None
+        return
+    if not job.done:
+        st.progress(job.progress, text=job.message)
+        if render_partial is not None:
+            render_partial(dict(job.partial))
+        return
+    st.session_state[state_key] = None
+    if job.status == "failed":
+        st.session_state[f"{state_key}_message"] = ("error", f"{error_prefix}: {job.error}")
+    else:
+        st.session_state[f"{state_key}_message"] = ("success", on_done(job.result))
+    st.rerun()
 
-SOAP FORMAT:
-- Subjective: What the client reports - their feelings, concerns, symptoms, and experiences in their own words
-- Objective: Observable data - appearance, behavior, affect, speech patterns, engagement level
-- Assessment: Your clinical interpretation - progress toward goals, risk factors, strengths observed
-- Plan: Next steps - homework, referrals, follow-up appointments, treatment adjustments
 
-Extract the client name, session date, and session length if mentioned. If not explicitly stated, note as "Not specified in transcript."
-"""
+def render_job(state_key: str, on_done, error_prefix: str, render_partial=None) -> None:
+    """Show a job's live progress, or the outcome of the job that just finished."""
+    if st.session_state.get(state_key):
+        render_job_progress(state_key, on_done, error_prefix, render_partial)
+    outcome = st.session_state.pop(f"{state_key}_message", None)
+    if outcome:
+        kind, text = outcome
+        getattr(st, kind)(text)
 
 
-def generate_soap_note(transcript: str, additional_context: str = "") -> SOAPNote:
-    """Generate a SOAP note from a session transcript."""
-    from anthropic import Anthropic
-    
-    # Use Streamlit secrets for API key (works locally and on Streamlit Cloud)
-    api_key = st.secrets["ANTHROPIC_API_KEY"]
+@st.fragment
+def render_input_step() -> None:
+    """Step 1. A fragment: its widgets rerun only this step, and a finished
+    transcription reruns the app to show Step 2.
+    """
+    st.subheader("📤 Step 1: Input Session Content")
+    # Bumped to clear the inputs once their content is in the artifact store
+    generation = st.session_state.input_generation
+
+    input_mode = st.radio(
+        "Choose input method:",
+        ["🎙️ Record Audio", "📁 Upload Audio File", "📝 Enter Transcript Directly"],
+        horizontal=True,
+    )
+
+    uploaded_file = None
+    optimize_audio = True
+    if input_mode != "📝 Enter Transcript Directly":
+        optimize_audio = st.checkbox(
+            "⚡ Optimize WAV audio before upload (mono, 16 kHz, trim silence)",
+            value=True,
+            help="Shrinks uploads several-fold and shortens long pauses. Transcript timings still match the original recording.",
+        )
+
+    if input_mode == "🎙️ Record Audio":
+        st.info("🎙️ Click the microphone to start recording your session notes")
+        audio_value = st.audio_input("Record your session summary", key=f"recording_{generation}")
     
-    client = Anthropic(api_key=api_key)
+        if audio_value:
+            st.audio(audio_value)
+            if st.button("🎯 Transcribe Recording", type="primary", use_container_width=True,
+                         disabled=bool(st.session_state.transcribe_job)):
+                submit_transcription(audio_value, "audio/wav", optimize_audio)
+
+    elif input_mode == "📁 Upload Audio File":
+        uploaded_file = st.file_uploader(
+            "Upload an audio recording of the therapy session",
+            type=['wav', 'mp3', 'm4a', 'mp4', 'ogg', 'webm', 'aac'],
+            key=f"upload_{generation}",
+        )
+    elif input_mode == "📝 Enter Transcript Directly":
+        direct_transcript = st.text_area(
+            "Paste or type session transcript:",
+            height=200,
+            placeholder="Enter the session transcript here...",
+            key=f"direct_transcript_{generation}",
+        )
+        if direct_transcript and st.button("✅ Use This Transcript", type="primary"):
+            keep_artifact("transcript", direct_transcript)
+            keep_artifact("transcription", None)
+            st.session_state.input_generation += 1
+            st.session_state.confidence = 1.0
+            st.session_state.audio_stats = None
+            st.session_state.vad_stats = None
+            st.session_state.talk_time = None
+            st.session_state.step = 2
+            st.success("✅ Transcript loaded!")
+            st.rerun()
+
+    # Optional context, read by Step 2 through the widget keys
+    with st.expander("➕ Add Session Context (Optional)", expanded=False):
+        st.text_input("Client Name", placeholder="e.g., John D.", key="context_client_name")
+        st.date_input("Session Date", value=datetime.now(), key="context_date")
+        st.selectbox(
+            "Session Length",
+            ["30 minutes", "45 minutes", "50 minutes", "60 minutes", "90 minutes"],
+            index=2,
+            key="context_length",
+        )
+
+    # Audio transcription
+    if uploaded_file is not None:
+        st.audio(uploaded_file, format=uploaded_file.type)
     
-    user_prompt = f"""Please generate a SOAP note from the following therapy session transcript.
+        if st.button("🎯 Transcribe Audio", type="primary", use_container_width=True,
+                     disabled=bool(st.session_state.transcribe_job)):
+            submit_transcription(uploaded_file, uploaded_file.type, optimize_audio)
 
-{f"Additional Context: {additional_context}" if additional_context else ""}
+    render_job("transcribe_job", apply_transcription, "Transcription error")
 
-TRANSCRIPT:
-{transcript}
 
-Respond with a JSON object containing these exact fields:
-- client_name (string): Client's name or "Not specified"
-- session_date (string): Session date or "Not specified"  
-- session_length (string): Duration or "Not specified"
-- subjective (string): Client's reported experience
-- objective (string): Clinician observations
-- assessment (string): Clinical assessment
-- plan (string): Treatment plan
-- clinical_tone (string): Brief description of client's overall presentation
+@st.fragment
+def render_transcript_step() -> None:
+    """Step 2, with section regeneration, which follows the live transcript edits.
+    A fragment: editing the transcript does not re-render the note or the exports.
+    """
+    if not st.session_state.transcript:
+        if st.session_state.generate_job:
+            # A note job reattached after a refresh, before any transcript is in the session
+            render_job("generate_job", apply_soap_note, "Error generating note", render_partial=render_partial_note)
+        return
+
+    st.markdown("---")
+    st.subheader("📝 Step 2: Review Transcript")
 
-Return ONLY valid JSON, no other text."""
+    audio_stats = st.session_state.get("audio_stats")
+    if audio_stats:
+        st.caption(
+            f"⚡ Upload optimized: {audio_stats['original_bytes'] / 1e6:.1f} MB → "
+            f"{audio_stats['processed_bytes'] / 1e6:.1f} MB ({audio_stats['ratio']:.1f}x smaller)"
+        )
+    vad_stats = st.session_state.get("vad_stats")
+    if vad_stats:
+        st.caption(f"🔇 Trimmed {vad_stats['silence_removed_seconds']:.0f} s of silence before upload")
+    talk_time = st.session_state.get("talk_time")
+    if talk_time:
+        total = sum(talk_time.values()) or 1.0
+        st.caption("🗣️ Talk time: " + " · ".join(
+            f"Speaker {speaker + 1} {seconds / total:.0%}" for speaker, seconds in talk_time.items()
+        ))
 
-    response = client.messages.create(
-        model="claude-sonnet-4-20250514",
-        max_tokens=2000,
-        system=SOAP_SYSTEM_PROMPT,
-        messages=[{"role": "user", "content": user_prompt}]
+    edited_transcript = st.text_area(
+        "Edit transcript if needed:",
+        value=load_text("transcript"),
+        height=200,
     )
-    
-    response_text = response.content[0].text
-    
-    # Clean up response
-    if response_text.startswith("```"):
-        response_text = response_text.split("```")[1]
-        if response_text.startswith("json"):
-            response_text = response_text[4:]
-    response_text = response_text.strip()
-    
-    try:
-        note_data = json.loads(response_text)
-    except json.JSONDecodeError:
-        note_data = {
-            "client_name": "Not specified",
-            "session_date": "Not specified",
-            "session_length": "Not specified",
-            "subjective": response_text,
-            "objective": "Unable to parse structured response",
-            "assessment": "Please review transcript manually",
-            "plan": "Regenerate note or enter manually",
-            "clinical_tone": "Unknown"
-        }
-    
-    soap_note = SOAPNote(**note_data)
-    soap_note = validate_soap_note(soap_note)
-    
-    return soap_note
+    if CONDENSE_TRANSCRIPT and edited_transcript.strip():
+        condensed = condense_transcript(edited_transcript)
+        if condensed.tokens_after < condensed.tokens_before:
+            st.caption(
+                f"✂️ The note is written from a condensed copy: {condensed.tokens_before:,} → "
+                f"{condensed.tokens_after:,} tokens ({1 - condensed.tokens_after / condensed.tokens_before:.0%} fewer). "
+                f"{condensed.disfluencies_removed} filler words and repeats, {condensed.backchannels_removed} "
+                f"backchannels removed, {condensed.turns_merged} turns merged; the transcript above is unchanged."
+            )
+            # A toggle rather than an expander, so edits do not re-send the copy while it is hidden
+            if st.toggle("🔍 Show the condensed transcript sent to the model"):
+                st.text(condensed.text)
 
+    context_date = st.session_state.get("context_date")
+    additional_context = session_context(
+        st.session_state.get("context_client_name", ""),
+        context_date.strftime('%Y-%m-%d') if context_date else "",
+        st.session_state.get("context_length", ""),
+    )
 
-def validate_soap_note(note: SOAPNote) -> SOAPNote:
-    """Validate a SOAP note for completeness."""
-    validation_notes = []
-    
-    if note.client_name == "Not specified" or not note.client_name:
-        validation_notes.append("⚠️ Client name is missing")
-    
-    if note.session_length == "Not specified" or not note.session_length:
-        validation_notes.append("⚠️ Session length is missing")
-    
-    if len(note.subjective) < 20:
-        validation_notes.append("⚠️ Subjective section may be incomplete")
-    
-    if len(note.objective) < 20:
-        validation_notes.append("⚠️ Objective section may be incomplete")
-    
-    if len(note.assessment) < 20:
-        validation_notes.append("⚠️ Assessment section may be incomplete")
-    
-    if len(note.plan) < 20:
-        validation_notes.append("⚠️ Plan section may be incomplete")
-    
-    note.validation_notes = validation_notes
-    note.is_complete = len(validation_notes) == 0
-    
-    return note
+    if st.button("🧠 Generate SOAP Note", type="primary", use_container_width=True,
+                 disabled=bool(st.session_state.generate_job)):
+        keep_artifact("pending_note_transcript", edited_transcript)
+        cached_note = cached_soap_note(edited_transcript, additional_context)
+        if cached_note is not None:
+            st.session_state.generate_job_message = ("success", apply_soap_note(cached_note))
+        else:
+            st.session_state.generate_job = submit_generation(edited_transcript, additional_context)
+        # The whole page changes: the old note gives way to the new one
+        st.rerun()
+    render_job("generate_job", apply_soap_note, "Error generating note", render_partial=render_partial_note)
 
+    # Section regeneration after transcript edits
+    if st.session_state.soap_note and st.session_state.note_transcript and not st.session_state.generate_job:
+        note = load_note()
+        source_transcript = load_text("note_transcript")
+        titles = dict(SOAP_SECTIONS)
+        with st.expander("🔁 Regenerate sections"):
+            suggested = affected_sections(source_transcript, edited_transcript, note)
+            if suggested:
+                st.caption("Sections affected by your transcript edits are preselected.")
+            sections = st.multiselect(
+                "Sections to regenerate",
+                SOAP_FIELDS,
+                default=suggested,
+                format_func=lambda field: titles.get(field, field.replace("_", " ").title()),
+            )
+            if st.button("🔁 Regenerate selected sections", use_container_width=True, disabled=not sections):
+                keep_artifact("pending_note_transcript", edited_transcript)
+                st.session_state.generate_job = get_job_engine().submit(
+                    st.session_state.session_id, "regenerate", regenerate_sections,
+                    edited_transcript, additional_context, note, sections, source_transcript,
+                )
+                st.rerun()
 
-# ============================================================
-# STREAMLIT UI
-# ============================================================
 
-st.set_page_config(
-    page_title="Moonlight AI Note Builder",
-    page_icon="🌙",
-    layout="centered",
-    initial_sidebar_state="collapsed"
-)
+@st.fragment
+def render_note_step(note: SOAPNote) -> None:
+    """Step 4: the finished note and its validation status."""
+    st.markdown("---")
+    st.subheader("📋 Step 4: Review & Validate")
+
+    if note.is_complete:
+        st.markdown('<div class="status-complete">✅ <strong>Note is complete and validated</strong></div>', unsafe_allow_html=True)
+    else:
+        st.markdown('<div class="status-warning">⚠️ <strong>Validation warnings detected</strong></div>', unsafe_allow_html=True)
+        for v_note in note.validation_notes:
+            st.warning(v_note)
+
+    st.markdown("### Clinical Documentation")
+
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.metric("Client", note.client_name)
+    with col2:
+        st.metric("Date", note.session_date)
+    with col3:
+        st.metric("Duration", note.session_length)
+
+    st.markdown(f"**Clinical Tone:** {note.clinical_tone}")
+    st.markdown("---")
+
+    for field, title in SOAP_SECTIONS:
+        st.markdown(f"#### {title}")
+        render_soap_section(getattr(note, field))
+
+
+def note_exports() -> NoteExports:
+    """This session's exports of its note, started afresh whenever the note changes."""
+    exports = st.session_state.get("note_exports")
+    if exports is None or exports.note_handle != st.session_state.soap_note:
+        if exports is not None:
+            exports.release()
+        exports = st.session_state.note_exports = NoteExports(
+            session_store(), st.session_state.artifact_owner, st.session_state.soap_note,
+        )
+    return exports
+
+
+@st.fragment
+def render_exports() -> None:
+    """Export downloads. Payloads are rendered when clicked, and downloading
+    does not rerun anything.
+    """
+    st.markdown("---")
+    st.subheader("📤 Export Options")
+
+    exports = note_exports()
+    stamp = datetime.now().strftime('%Y%m%d_%H%M')
+    for column, (name, export) in zip(st.columns(len(EXPORT_FORMATS)), EXPORT_FORMATS.items()):
+        with column:
+            st.download_button(
+                export.label,
+                data=exports.loader(name),
+                file_name=f"soap_note_{stamp}.{export.extension}",
+                mime=export.mime,
+                use_container_width=True,
+                on_click="ignore",
+            )
+
+    st.info("💡 **Lightning Step Integration:** JSON export format designed for EMR integration.")
+
+
+def main():
+    """Render the four-step note builder workflow."""
+    st.set_page_config(
+        page_title="Moonlight AI Note Builder",
+        page_icon="🌙",
+        layout="centered",
+        initial_sidebar_state="collapsed"
+    )
 
-st.markdown("""
+    st.markdown("""
 <style>
     .main-header {
         text-align: center;
@@ -249,7 +4151,7 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
-st.markdown("""
+    st.markdown("""
 <div class="main-header">
     <h1>🌙 Moonlight AI Note Builder</h1>
     <p>Clinical Documentation Assistant</p>
@@ -257,230 +4159,66 @@ st.markdown("""
 </div>
 """, unsafe_allow_html=True)
 
-# Initialize session state
-if 'transcript' not in st.session_state:
-    st.session_state.transcript = None
-if 'soap_note' not in st.session_state:
-    st.session_state.soap_note = None
-if 'step' not in st.session_state:
-    st.session_state.step = 1
-
-# Progress indicator
-st.markdown("---")
-col1, col2, col3, col4 = st.columns(4)
-with col1:
-    st.markdown("**1️⃣ Input**" if st.session_state.step >= 1 else "1️⃣ Input")
-with col2:
-    st.markdown("**2️⃣ Transcript**" if st.session_state.step >= 2 else "2️⃣ Transcript")
-with col3:
-    st.markdown("**3️⃣ Generate**" if st.session_state.step >= 3 else "3️⃣ Generate")
-with col4:
-    st.markdown("**4️⃣ Validate**" if st.session_state.step >= 4 else "4️⃣ Validate")
-st.markdown("---")
-
-# Step 1: Input
-st.subheader("📤 Step 1: Input Session Content")
-
-input_mode = st.radio(
-    "Choose input method:",
-    ["🎙️ Record Audio", "📁 Upload Audio File", "📝 Enter Transcript Directly"],
-    horizontal=True,
-)
-
-uploaded_file = None
-audio_bytes = None
-
-if input_mode == "🎙️ Record Audio":
-    st.info("🎙️ Click the microphone to start recording your session notes")
-    audio_value = st.audio_input("Record your session summary")
-    
-    if audio_value:
-        st.audio(audio_value)
-        if st.button("🎯 Transcribe Recording", type="primary", use_container_width=True):
-            with st.spinner("Transcribing audio with Deepgram Nova-2..."):
-                try:
-                    audio_bytes = audio_value.read()
-                    result = transcribe_audio_sync(audio_bytes, "audio/wav")
-                    st.session_state.transcript = result['transcript']
-                    st.session_state.confidence = result.get('confidence', 0)
-                    st.session_state.step = 2
-                    st.success(f"✅ Transcription complete! Confidence: {st.session_state.confidence:.1%}")
-                    st.rerun()
-                except Exception as e:
-                    st.error(f"Transcription error: {str(e)}")
-
-elif input_mode == "📁 Upload Audio File":
-    uploaded_file = st.file_uploader(
-        "Upload an audio recording of the therapy session",
-        type=['wav', 'mp3', 'm4a', 'mp4', 'ogg', 'webm', 'aac'],
-    )
-elif input_mode == "📝 Enter Transcript Directly":
-    direct_transcript = st.text_area(
-        "Paste or type session transcript:",
-        height=200,
-        placeholder="Enter the session transcript here..."
-    )
-    if direct_transcript and st.button("✅ Use This Transcript", type="primary"):
-        st.session_state.transcript = direct_transcript
-        st.session_state.confidence = 1.0
-        st.session_state.step = 2
-        st.success("✅ Transcript loaded!")
-        st.rerun()
-
-# Optional context
-with st.expander("➕ Add Session Context (Optional)", expanded=False):
-    context_client_name = st.text_input("Client Name", placeholder="e.g., John D.")
-    context_date = st.date_input("Session Date", value=datetime.now())
-    context_length = st.selectbox(
-        "Session Length",
-        ["30 minutes", "45 minutes", "50 minutes", "60 minutes", "90 minutes"],
-        index=2
-    )
-
-# Audio transcription
-if uploaded_file is not None:
-    st.audio(uploaded_file, format=uploaded_file.type)
-    
-    if st.button("🎯 Transcribe Audio", type="primary", use_container_width=True):
-        with st.spinner("Transcribing audio with Deepgram Nova-2..."):
-            try:
-                audio_bytes = uploaded_file.read()
-                result = transcribe_audio_sync(audio_bytes, uploaded_file.type)
-                st.session_state.transcript = result['transcript']
-                st.session_state.confidence = result.get('confidence', 0)
-                st.session_state.step = 2
-                st.success(f"✅ Transcription complete! Confidence: {st.session_state.confidence:.1%}")
-            except Exception as e:
-                st.error(f"Transcription error: {str(e)}")
+    freeze_heap()
+    if METRICS_PORT:
+        start_metrics_server()
 
-# Step 2: Review Transcript
-if st.session_state.transcript:
-    st.markdown("---")
-    st.subheader("📝 Step 2: Review Transcript")
-    
-    edited_transcript = st.text_area(
-        "Edit transcript if needed:",
-        value=st.session_state.transcript,
-        height=200,
-    )
-    
-    context_parts = []
-    if context_client_name:
-        context_parts.append(f"Client Name: {context_client_name}")
-    if context_date:
-        context_parts.append(f"Session Date: {context_date.strftime('%Y-%m-%d')}")
-    if context_length:
-        context_parts.append(f"Session Length: {context_length}")
-    additional_context = ". ".join(context_parts)
-    
-    if st.button("🧠 Generate SOAP Note", type="primary", use_container_width=True):
-        with st.spinner("Generating clinical documentation..."):
-            try:
-                soap_note = generate_soap_note(edited_transcript, additional_context)
-                st.session_state.soap_note = soap_note
-                st.session_state.step = 4
-                st.success("✅ SOAP note generated!")
-            except Exception as e:
-                st.error(f"Error generating note: {str(e)}")
+    # Initialize session state. Large values are artifacts: the session
+    # holds handles into the artifact store, owned by this browser session.
+    if 'artifact_owner' not in st.session_state:
+        st.session_state.artifact_owner = uuid.uuid4().hex
+        for key in ARTIFACT_KEYS:
+            st.session_state[key] = None
+        st.session_state.input_generation = 0
+    if 'step' not in st.session_state:
+        st.session_state.step = 1
+    if 'session_id' not in st.session_state:
+        # A valid link in the URL reconnects a browser refresh to the same jobs
+        linked = verify_session_link(st.query_params.get("session", ""))
+        st.session_state.session_id = linked or uuid.uuid4().hex
+        if linked:
+            restore_jobs(linked)
+    publish_session_link()
+    if 'transcribe_job' not in st.session_state:
+        st.session_state.transcribe_job = None
+    if 'generate_job' not in st.session_state:
+        st.session_state.generate_job = None
+    session_store()
+    if st.session_state.pop("session_expired", False):
+        st.warning("⌛ This session was idle for too long, so its transcript and note were cleared.")
 
-# Step 4: Display SOAP Note
-if st.session_state.soap_note:
+    # Progress indicator
     st.markdown("---")
-    st.subheader("📋 Step 4: Review & Validate")
-    
-    note = st.session_state.soap_note
-    
-    if note.is_complete:
-        st.markdown('<div class="status-complete">✅ <strong>Note is complete and validated</strong></div>', unsafe_allow_html=True)
-    else:
-        st.markdown('<div class="status-warning">⚠️ <strong>Validation warnings detected</strong></div>', unsafe_allow_html=True)
-        for v_note in note.validation_notes:
-            st.warning(v_note)
-    
-    st.markdown("### Clinical Documentation")
-    
-    col1, col2, col3 = st.columns(3)
+    col1, col2, col3, col4 = st.columns(4)
     with col1:
-        st.metric("Client", note.client_name)
+        st.markdown("**1️⃣ Input**" if st.session_state.step >= 1 else "1️⃣ Input")
     with col2:
-        st.metric("Date", note.session_date)
+        st.markdown("**2️⃣ Transcript**" if st.session_state.step >= 2 else "2️⃣ Transcript")
     with col3:
-        st.metric("Duration", note.session_length)
-    
-    st.markdown(f"**Clinical Tone:** {note.clinical_tone}")
-    st.markdown("---")
-    
-    st.markdown("#### Subjective")
-    st.markdown(f'<div class="soap-section">{note.subjective}</div>', unsafe_allow_html=True)
-    
-    st.markdown("#### Objective")
-    st.markdown(f'<div class="soap-section">{note.objective}</div>', unsafe_allow_html=True)
-    
-    st.markdown("#### Assessment")
-    st.markdown(f'<div class="soap-section">{note.assessment}</div>', unsafe_allow_html=True)
-    
-    st.markdown("#### Plan")
-    st.markdown(f'<div class="soap-section">{note.plan}</div>', unsafe_allow_html=True)
-    
-    # Export
+        st.markdown("**3️⃣ Generate**" if st.session_state.step >= 3 else "3️⃣ Generate")
+    with col4:
+        st.markdown("**4️⃣ Validate**" if st.session_state.step >= 4 else "4️⃣ Validate")
     st.markdown("---")
-    st.subheader("📤 Export Options")
-    
-    col1, col2 = st.columns(2)
-    
-    with col1:
-        export_text = f"""SOAP NOTE
-Generated: {datetime.now().strftime('%Y-%m-%d %H:%M')}
-Client: {note.client_name}
-Date: {note.session_date}
-Session Length: {note.session_length}
-Clinical Tone: {note.clinical_tone}
-
-SUBJECTIVE:
-{note.subjective}
-
-OBJECTIVE:
-{note.objective}
-
-ASSESSMENT:
-{note.assessment}
-
-PLAN:
-{note.plan}
 
----
-Validation Status: {"Complete" if note.is_complete else "Warnings Present"}
-"""
-        st.download_button(
-            "📄 Download as Text",
-            data=export_text,
-            file_name=f"soap_note_{datetime.now().strftime('%Y%m%d_%H%M')}.txt",
-            mime="text/plain",
-            use_container_width=True
-        )
-    
-    with col2:
-        export_json = json.dumps(note.model_dump(), indent=2)
-        st.download_button(
-            "🔗 Download as JSON (EMR)",
-            data=export_json,
-            file_name=f"soap_note_{datetime.now().strftime('%Y%m%d_%H%M')}.json",
-            mime="application/json",
-            use_container_width=True
-        )
-    
-    st.info("💡 **Lightning Step Integration:** JSON export format designed for EMR integration.")
+    render_input_step()
+    render_transcript_step()
+    # While generating, the job renders the note section by section
+    if st.session_state.soap_note and not st.session_state.generate_job:
+        render_note_step(load_note())
+        render_exports()
 
-# Reset
-st.markdown("---")
-if st.button("🔄 Start New Note", use_container_width=True):
-    st.session_state.transcript = None
-    st.session_state.soap_note = None
-    st.session_state.step = 1
-    st.rerun()
+    # Reset
+    st.markdown("---")
+    if st.button("🔄 Start New Note", use_container_width=True):
+        reset_session()
+        st.rerun()
 
-st.markdown("""
+    st.markdown("""
 <div style="text-align: center; color: #666; font-size: 0.9rem; margin-top: 2rem;">
     <p>🌙 Moonlight AI Note Builder | Built for Moonlight Mountain Recovery</p>
 </div>
 """, unsafe_allow_html=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""
+Moonlight AI Note Builder - batch mode
+Transcribe and document a directory (or manifest) of session recordings
+without the UI, writing one NDJSON record per recording.
+
+    python batch.py recordings/ --output notes.ndjson --workers 4
+    python batch.py manifest.jsonl --output notes.ndjson --resume
+
+A manifest is either a text file with one audio path per line, or NDJSON
+with a "path" per line and optional "client_name", "session_date" and
+"session_length" (or a ready-made "context" string). Relative paths are
+resolved against the manifest's directory.
+
+The output file doubles as the checkpoint: each record is flushed and
+fsynced as soon as its recording finishes, and --resume skips recordings
+that already have an "ok" record. Progress and the throughput summary go
+to stderr. API keys are read from the environment (or Streamlit secrets).
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import app
+
+AUDIO_TYPES = {
+    ".wav": "audio/wav",
+    ".mp3": "audio/mpeg",
+    ".m4a": "audio/mp4",
+    ".mp4": "audio/mp4",
+    ".ogg": "audio/ogg",
+    ".webm": "audio/webm",
+    ".aac": "audio/aac",
+}
+
+
+def load_items(source: str) -> list:
+    """Work items (dicts with "id", "path" and "context") from a directory or manifest."""
+    if os.path.isdir(source):
+        items = []
+        for root, _, files in os.walk(source):
+            for name in sorted(files):
+                if os.path.splitext(name)[1].lower() in AUDIO_TYPES:
+                    path = os.path.join(root, name)
+                    items.append({"id": os.path.relpath(path, source), "path": path, "context": ""})
+        return sorted(items, key=lambda item: item["id"])
+
+    base = os.path.dirname(os.path.abspath(source))
+    items = []
+    with open(source, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            entry = json.loads(line) if line.startswith("{") else {"path": line}
+            context = entry.get("context") or app.session_context(
+                entry.get("client_name", ""), entry.get("session_date", ""), entry.get("session_length", ""),
+            )
+            items.append({
+                "id": entry.get("id", entry["path"]),
+                "path": os.path.join(base, entry["path"]),
+                "context": context,
+            })
+    return items
+
+
+def completed_ids(output: str) -> set:
+    """Ids with an "ok" record in an existing output file (a torn last line is ignored)."""
+    done = set()
+    if output == "-" or not os.path.exists(output):
+        return done
+    with open(output, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record.get("status") == "ok":
+                done.add(record["id"])
+    return done
+
+
+def process(item: dict, preprocess: bool) -> dict:
+    """Transcribe one recording and generate its validated note."""
+    record = {"id": item["id"], "path": item["path"]}
+    started = time.perf_counter()
+    try:
+        mimetype = AUDIO_TYPES.get(os.path.splitext(item["path"])[1].lower(), "audio/wav")
+        with open(item["path"], "rb") as audio:
+            result = app.transcribe_audio(audio, mimetype, preprocess=preprocess, trim=preprocess)
+        transcribed = time.perf_counter()
+        if not result["transcript"].strip():
+            raise RuntimeError("Empty transcript")
+        transcript = app.speaker_transcript(result)
+        note = app.validate_soap_note(app.generate_soap_note(transcript, item["context"]))
+        record.update({
+            "status": "ok",
+            "confidence": result["confidence"],
+            "transcript": transcript,
+            "note": note.model_dump(),
+            "is_complete": note.is_complete,
+            "transcribe_seconds": round(transcribed - started, 3),
+            "generate_seconds": round(time.perf_counter() - transcribed, 3),
+        })
+    except Exception as e:
+        record.update({"status": "error", "error": f"{type(e).__name__}: {e}"})
+    record["seconds"] = round(time.perf_counter() - started, 3)
+    return record
+
+
+def summarize(records: list, skipped: int, elapsed: float) -> str:
+    """Human-readable throughput summary for a finished run."""
+    ok = [r for r in records if r["status"] == "ok"]
+    lines = [
+        f"processed {len(records)} recordings in {elapsed:.1f} s "
+        f"({len(ok)} ok, {len(records) - len(ok)} failed, {skipped} skipped as already done)",
+    ]
+    if records:
+        lines.append(f"throughput: {len(records) / elapsed * 60:.1f} recordings/min")
+    if ok:
+        seconds = sorted(r["seconds"] for r in ok)
+        p95 = seconds[max(0, int(len(seconds) * 0.95) - 1)]
+        lines.append(f"per recording: p50 {statistics.median(seconds):.1f} s, p95 {p95:.1f} s; "
+                     f"{sum(r['is_complete'] for r in ok)} of {len(ok)} notes complete")
+    metrics = app.metrics_snapshot()
+    lines.append(
+        "tokens: input {} output {} cache read {} cache write {}".format(
+            *(metrics.get(f"anthropic_{name}_total", 0) for name in
+              ("input_tokens", "output_tokens", "cache_read_input_tokens", "cache_creation_input_tokens"))
+        )
+    )
+    return "\n".join(lines)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("source", help="directory of recordings or a manifest file")
+    parser.add_argument("--output", default="notes.ndjson", help="NDJSON output and checkpoint file ('-' for stdout)")
+    parser.add_argument("--workers", type=int, default=4, help="recordings processed in parallel")
+    parser.add_argument("--resume", action="store_true", help="skip recordings with an ok record in --output")
+    parser.add_argument("--no-preprocess", action="store_true", help="upload audio as-is (no downmix, resample or trim)")
+    args = parser.parse_args(argv)
+
+    items = load_items(args.source)
+    done = completed_ids(args.output) if args.resume else set()
+    pending = [item for item in items if item["id"] not in done]
+    print(f"{len(items)} recordings, {len(items) - len(pending)} already done, {len(pending)} to process",
+          file=sys.stderr)
+
+    to_stdout = args.output == "-"
+    output = sys.stdout if to_stdout else open(args.output, "a" if args.resume else "w", encoding="utf-8")
+    records = []
+    started = time.perf_counter()
+    # The app logs to stdout; keep that off the NDJSON stream
+    with contextlib.redirect_stdout(sys.stderr), ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        futures = [executor.submit(process, item, not args.no_preprocess) for item in pending]
+        for future in as_completed(futures):
+            record = future.result()
+            output.write(json.dumps(record) + "\n")
+            output.flush()
+            if not to_stdout:
+                os.fsync(output.fileno())
+            records.append(record)
+            status = "ok" if record["status"] == "ok" else record["error"]
+            print(f"[{len(records)}/{len(pending)}] {record['id']}: {status} ({record['seconds']:.1f} s)",
+                  file=sys.stderr)
+    if not to_stdout:
+        output.close()
+
+    print(summarize(records, len(items) - len(pending), time.perf_counter() - started), file=sys.stderr)
+    return 0 if all(r["status"] == "ok" for r in records) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,74 @@
+"""
+Per-note client overhead of generate_soap_note: a new Anthropic client per
+call (the previous behaviour) vs the shared process-wide client.
+
+Runs against a local TLS stand-in for the Messages API with no model latency,
+so the difference is client construction plus TCP + TLS setup.
+
+    python benchmarks/bench_anthropic_client.py --notes 100
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_servers import AnthropicHandler, MockServer  # noqa: E402
+
+TRANSCRIPT = "Therapist: How was your week? Client: Better. I went to three meetings and called my sponsor."
+
+
+def timed(fn, n: int) -> list[float]:
+    samples = []
+    for _ in range(n):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def summarize(label: str, samples: list[float]) -> float:
+    ms = sorted(s * 1000 for s in samples)
+    p95 = ms[int(len(ms) * 0.95) - 1]
+    print(f"{label:<26} mean {statistics.fmean(ms):7.2f} ms   p50 {statistics.median(ms):7.2f} ms   p95 {p95:7.2f} ms")
+    return statistics.fmean(ms)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--notes", type=int, default=100)
+    args = parser.parse_args()
+
+    with MockServer(handler=AnthropicHandler, tls=True, path="") as server:
+        os.environ["SSL_CERT_FILE"] = server.certfile
+        os.environ["ANTHROPIC_BASE_URL"] = server.url
+        os.environ.setdefault("ANTHROPIC_API_KEY", "benchmark")
+
+        import app
+        from anthropic import Anthropic
+
+        shared = app.get_anthropic_client()
+
+        def new_client_per_note():
+            # What generate_soap_note used to do on every call
+            app.get_anthropic_client = lambda: Anthropic(api_key=os.environ["ANTHROPIC_API_KEY"])
+            app.generate_soap_note(TRANSCRIPT, use_cache=False)
+
+        def shared_client():
+            app.get_anthropic_client = lambda: shared
+            app.generate_soap_note(TRANSCRIPT, use_cache=False)
+
+        new_client_per_note()
+        shared_client()
+
+        print(f"{args.notes} sequential notes, TLS on localhost\n")
+        before = summarize("new client per note", timed(new_client_per_note, args.notes))
+        after = summarize("shared client", timed(shared_client, args.notes))
+        print(f"\nsaved per note: {before - after:.2f} ms ({(before - after) / before:.0%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+Wall-clock time of one whole-file transcription request vs concurrent chunks
+split at silences.
+
+The local Deepgram stand-in takes time proportional to the audio it receives,
+so the single request scales with session length while the chunked path
+scales with the slowest chunk.
+
+    python benchmarks/bench_chunked_transcription.py --minutes 60
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_servers import MockServer, synthetic_session_wav  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--minutes", type=float, default=60)
+    parser.add_argument("--processing-ms-per-audio-second", type=float, default=2.0)
+    parser.add_argument("--chunk-seconds", type=float, default=300)
+    parser.add_argument("--concurrency", type=int, default=4)
+    args = parser.parse_args()
+
+    audio = synthetic_session_wav(args.minutes * 60)
+    with MockServer(latency_per_audio_second=args.processing_ms_per_audio_second / 1000) as server:
+        os.environ["DEEPGRAM_API_URL"] = server.url
+        os.environ.setdefault("DEEPGRAM_API_KEY", "benchmark")
+        import app
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            single = app.transcribe_audio_sync(audio)
+            single_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            chunked = app.transcribe_audio_chunked(
+                audio, target_seconds=args.chunk_seconds, max_concurrency=args.concurrency
+            )
+            chunked_seconds = time.perf_counter() - start
+
+    print(f"{args.minutes:g} min session, {len(audio) / 1e6:.1f} MB WAV, "
+          f"{args.chunk_seconds:g} s chunks, concurrency {args.concurrency}\n")
+    print(f"single request   {single_seconds:7.2f} s   {len(single['transcript'].split())} words")
+    print(f"chunked          {chunked_seconds:7.2f} s   {len(chunked['transcript'].split())} words, "
+          f"{len(chunked['utterances'])} utterances")
+    print(f"\nspeedup: {single_seconds / chunked_seconds:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Note generation from the verbatim transcript vs the condensed one (fillers,
+stutters and backchannel turns removed, same-speaker turns merged).
+
+Uses synthetic diarized sessions with a configurable rate of disfluencies,
+runs against a local stand-in for the Messages API that charges prefill
+time per uncached input token, and checks that the condensed transcript
+still holds every word outside the condenser's word lists.
+
+    python benchmarks/bench_condense.py --tokens 6000 24000 --disfluency-rate 0.08
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_map_reduce import TURNS  # noqa: E402
+from mock_servers import AnthropicHandler, MockServer  # noqa: E402
+
+FILLERS = ["um,", "uh,", "Um,", "uh, um,", "hmm,"]
+BACKCHANNELS = ["Mm-hmm.", "Yeah.", "Okay.", "Right.", "Uh-huh."]
+
+
+def disfluent_transcript(tokens: int, rate: float, seed: int = 0) -> str:
+    """Alternating speaker turns (about 4 chars per token) with fillers, stutters
+    and listener backchannels inserted at ``rate`` per word.
+    """
+    rng = random.Random(seed)
+    lines, size, i = [], 0, 0
+    while size < tokens * 4:
+        words = []
+        for word in TURNS[i % len(TURNS)].split():
+            words.append(word)
+            roll = rng.random()
+            if roll < rate / 2 and not word.endswith(":"):
+                words.append(rng.choice(FILLERS))
+            elif roll < rate and word.lower() in ("i", "the", "and", "to", "my"):
+                words.append(word)
+        line = " ".join(words)
+        added = [line]
+        # The listener chimes in halfway through some turns
+        if rng.random() < rate * 3 and "?" not in line:
+            other = "Therapist" if line.startswith("Client") else "Client"
+            added.append(f"{other}: {rng.choice(BACKCHANNELS)}")
+            added.append(f"{line.split(':')[0]}: {rng.choice(TURNS).split(': ', 1)[1]}")
+        lines.extend(added)
+        size += sum(len(line) + 1 for line in added)
+        i += 1
+    return "\n".join(lines)
+
+
+def timed_note(app, transcript: str, condense: bool) -> float:
+    app.CONDENSE_TRANSCRIPT = condense
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        app.generate_soap_note(transcript, use_cache=False)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--tokens", type=int, nargs="+", default=[4000, 12000, 24000])
+    parser.add_argument("--disfluency-rate", type=float, default=0.08, help="share of words followed by a filler or repeat")
+    parser.add_argument("--prefill-tokens-per-second", type=float, default=10000)
+    parser.add_argument("--tokens-per-second", type=float, default=150)
+    args = parser.parse_args()
+
+    server = MockServer(handler=AnthropicHandler, path="", latency=0.3, tokens_per_second=args.tokens_per_second,
+                        latency_per_input_token=1 / args.prefill_tokens_per_second)
+    with server:
+        os.environ.update(ANTHROPIC_BASE_URL=server.url, ANTHROPIC_API_KEY="benchmark", ANTHROPIC_ITPM="1000000000")
+        with contextlib.redirect_stderr(io.StringIO()):
+            import app
+
+        # Warm the cached prompt prefix, so neither variant pays for it
+        timed_note(app, disfluent_transcript(500, 0), False)
+        print(f"disfluency rate {args.disfluency_rate:.0%}; prefill {args.prefill_tokens_per_second:g} tok/s, "
+              f"decode {args.tokens_per_second:g} tok/s\n")
+        print(f"{'tokens':>7}  {'condensed':>9}  {'saved':>6}  {'removed':>7}  {'merged':>6}  "
+              f"{'condense':>8}  {'note verbatim':>13}  {'condensed':>9}")
+        for tokens in args.tokens:
+            transcript = disfluent_transcript(tokens, args.disfluency_rate)
+            start = time.perf_counter()
+            condensed = app.condense_transcript(transcript)
+            elapsed = time.perf_counter() - start
+            if condensed.text == transcript:
+                raise SystemExit("the condenser fell back to the verbatim transcript")
+            kept = app.clinical_words(app.split_turns(condensed.text))
+            assert kept == app.clinical_words(app.split_turns(transcript)), "clinical words were removed"
+            verbatim, short = timed_note(app, transcript, False), timed_note(app, transcript, True)
+            print(f"{condensed.tokens_before:>7}  {condensed.tokens_after:>9}  "
+                  f"{1 - condensed.tokens_after / condensed.tokens_before:>6.0%}  "
+                  f"{condensed.disfluencies_removed + condensed.backchannels_removed:>7}  {condensed.turns_merged:>6}  "
+                  f"{elapsed * 1000:>6.1f}ms  {verbatim:>12.2f}s  {short:>8.2f}s")
+
+
+if __name__ == "__main__":
+    main()
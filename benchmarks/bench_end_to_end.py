@@ -0,0 +1,127 @@
+"""
+End-to-end pipeline benchmark: audio -> transcribe_audio_sync ->
+generate_soap_note (which validates the note) at increasing concurrency.
+
+Runs fully offline against the local Deepgram and Messages API stand-ins,
+with configurable latency, payload size (clip length; the transcript grows
+with it) and injected failure rates. Each concurrency level runs in a fresh
+process so its peak RSS is its own.
+
+    python benchmarks/bench_end_to_end.py --concurrency 1 4 16 --pipelines 48 --error-rate 0.02
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_streaming_upload import peak_rss_mb  # noqa: E402
+from mock_servers import AnthropicHandler, Faults, MockServer, synthetic_session_wav  # noqa: E402
+
+STAGES = ["upload", "deepgram_processing", "decode", "llm_first_token", "llm_total", "parse", "validation"]
+
+
+def child(concurrency: int, pipelines: int, clip_seconds: float) -> None:
+    """Run the pipelines in this process and print one JSON line of results."""
+    import app
+
+    clip = synthetic_session_wav(clip_seconds)
+
+    def pipeline(i):
+        start = time.perf_counter()
+        try:
+            result = app.transcribe_audio_sync(clip, "audio/wav")
+            # A distinct transcript per pipeline, so the note cache never answers
+            app.generate_soap_note(f"Session {i}\n{result['transcript']}", use_cache=False)
+        except Exception:
+            return None
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()), ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(pipeline, range(pipelines)))
+    elapsed = time.perf_counter() - start
+    latencies = [r for r in results if r is not None]
+    histograms = app.histogram_snapshot()
+    print(json.dumps({
+        "elapsed": elapsed,
+        "failed": len(results) - len(latencies),
+        "latencies": latencies,
+        "stages": {stage: h["sum"] / h["count"] for stage, h in histograms.items() if h["count"]},
+        "peak_rss_mb": peak_rss_mb(),
+    }))
+
+
+def measure(concurrency: int, args, env: dict) -> dict:
+    output = subprocess.run(
+        [sys.executable, __file__, "--child", str(concurrency), str(args.pipelines), str(args.clip_seconds)],
+        env=env, capture_output=True, text=True, check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--pipelines", type=int, default=32, help="pipelines per concurrency level")
+    parser.add_argument("--clip-seconds", type=float, default=120)
+    parser.add_argument("--deepgram-latency", type=float, default=0.3)
+    parser.add_argument("--processing-ms-per-audio-second", type=float, default=5)
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="time to first token")
+    parser.add_argument("--tokens-per-second", type=float, default=150)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of 5xx responses from each API")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="share of dropped connections")
+    parser.add_argument("--child", nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(int(args.child[0]), int(args.child[1]), float(args.child[2]))
+        return
+
+    faults = Faults(args.error_rate, args.drop_rate) if args.error_rate or args.drop_rate else None
+    deepgram = MockServer(latency=args.deepgram_latency, faults=faults,
+                          latency_per_audio_second=args.processing_ms_per_audio_second / 1000)
+    anthropic = MockServer(handler=AnthropicHandler, path="", latency=args.llm_latency,
+                           tokens_per_second=args.tokens_per_second, faults=faults)
+    with deepgram, anthropic:
+        env = dict(
+            os.environ,
+            DEEPGRAM_API_URL=deepgram.url, DEEPGRAM_API_KEY="benchmark",
+            ANTHROPIC_BASE_URL=anthropic.url, ANTHROPIC_API_KEY="benchmark",
+            # Measure the pipeline, not the client-side rate limits
+            DEEPGRAM_RPM="1000000", ANTHROPIC_RPM="1000000", ANTHROPIC_ITPM="1000000000",
+        )
+        clip_kb = len(synthetic_session_wav(args.clip_seconds)) // 1024
+        print(f"{args.pipelines} pipelines per level, {args.clip_seconds:.0f} s clips ({clip_kb} KB); "
+              f"Deepgram {args.deepgram_latency} s + {args.processing_ms_per_audio_second:g} ms/audio-s, "
+              f"LLM {args.llm_latency} s + {args.tokens_per_second:g} tok/s; "
+              f"{args.error_rate:.0%} errors, {args.drop_rate:.0%} drops\n")
+        print(f"{'concurrency':>11}  {'per min':>8}  {'failed':>6}  {'p50':>7}  {'p95':>7}  {'p99':>7}  {'peak RSS':>9}")
+        stages = {}
+        for concurrency in args.concurrency:
+            result = measure(concurrency, args, env)
+            p50, p95, p99 = np.percentile(result["latencies"] or [0], [50, 95, 99])
+            done = len(result["latencies"])
+            print(f"{concurrency:>11}  {done / result['elapsed'] * 60:>8.1f}  {result['failed']:>6}  "
+                  f"{p50:>6.2f}s  {p95:>6.2f}s  {p99:>6.2f}s  {result['peak_rss_mb']:>6.0f} MB")
+            stages[concurrency] = result["stages"]
+
+        print("\nmean seconds per stage")
+        print(f"{'concurrency':>11}  " + "  ".join(f"{stage:>{max(8, len(stage))}}" for stage in STAGES))
+        for concurrency, means in stages.items():
+            print(f"{concurrency:>11}  " + "  ".join(
+                f"{means.get(stage, 0):>{max(8, len(stage))}.3f}" for stage in STAGES
+            ))
+
+
+if __name__ == "__main__":
+    main()
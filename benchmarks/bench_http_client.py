@@ -0,0 +1,82 @@
+"""
+Per-request latency of transcribe_audio_sync: new connection per call vs the
+shared keep-alive client.
+
+Runs against a local TLS stand-in for Deepgram, so the numbers isolate the
+TCP + TLS setup cost (real WAN round trips make the gap larger).
+
+    python benchmarks/bench_http_client.py --requests 200
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_servers import MockServer  # noqa: E402
+
+
+def timed(fn, n: int) -> list[float]:
+    samples = []
+    for _ in range(n):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def summarize(label: str, samples: list[float]) -> float:
+    ms = sorted(s * 1000 for s in samples)
+    p50 = statistics.median(ms)
+    p95 = ms[int(len(ms) * 0.95) - 1]
+    print(f"{label:<28} mean {statistics.fmean(ms):7.2f} ms   p50 {p50:7.2f} ms   p95 {p95:7.2f} ms")
+    return statistics.fmean(ms)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--payload-kb", type=int, default=64)
+    args = parser.parse_args()
+
+    payload = os.urandom(args.payload_kb * 1024)
+
+    with MockServer(tls=True) as server:
+        # Both paths trust the throwaway certificate through the environment.
+        os.environ["SSL_CERT_FILE"] = server.certfile
+        os.environ["DEEPGRAM_API_URL"] = server.url
+        os.environ.setdefault("DEEPGRAM_API_KEY", "benchmark")
+
+        import httpx
+        import app
+
+        def per_call_connection():
+            response = httpx.post(
+                server.url,
+                headers={"Authorization": "Token benchmark", "Content-Type": "audio/wav"},
+                content=payload,
+                timeout=httpx.Timeout(600.0, connect=30.0),
+            )
+            response.raise_for_status()
+
+        def shared_client():
+            with contextlib.redirect_stdout(io.StringIO()):
+                app.transcribe_audio_sync(payload, "audio/wav")
+
+        # Warm up imports, the TLS context and the shared pool.
+        per_call_connection()
+        shared_client()
+
+        print(f"{args.requests} sequential requests, {args.payload_kb} KB payload, TLS on localhost\n")
+        before = summarize("httpx.post per call", timed(per_call_connection, args.requests))
+        after = summarize("shared client (keep-alive)", timed(shared_client, args.requests))
+        print(f"\nsaved per request: {before - after:.2f} ms ({(before - after) / before:.0%})")
+
+
+if __name__ == "__main__":
+    main()
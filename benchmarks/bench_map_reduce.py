@@ -0,0 +1,83 @@
+"""
+End-to-end SOAP generation latency: single-shot prompt vs map-reduce
+(parallel segment summaries + a reduce pass) as the transcript grows.
+
+Runs against a local stand-in for the Messages API whose time to first token
+grows with the uncached input (prefill) and which then emits tokens at a
+fixed rate, so the numbers show where the crossover lies rather than real
+model timings.
+
+    python benchmarks/bench_map_reduce.py --tokens 10000 30000 60000 120000
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_servers import AnthropicHandler, MockServer  # noqa: E402
+
+TURNS = [
+    "Therapist: How have the last few days been since we spoke?",
+    "Client: Honestly up and down. I made it to two meetings but skipped Thursday because of work.",
+    "Therapist: What was going on for you on Thursday?",
+    "Client: My sister called about the holidays and I felt that old pull, so I called my sponsor instead.",
+]
+
+
+def synthetic_transcript(tokens: int) -> str:
+    """Alternating speaker turns totalling roughly ``tokens`` (4 chars per token)."""
+    lines, size, i = [], 0, 0
+    while size < tokens * 4:
+        line = TURNS[i % len(TURNS)]
+        lines.append(line)
+        size += len(line) + 1
+        i += 1
+    return "\n".join(lines)
+
+
+def timed_note(app, transcript: str, threshold: int) -> float:
+    app.SOAP_MAP_REDUCE_TOKENS = threshold
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        app.generate_soap_note(transcript)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--tokens", type=int, nargs="+", default=[10000, 30000, 60000, 120000])
+    parser.add_argument("--prefill-tokens-per-second", type=float, default=10000)
+    parser.add_argument("--tokens-per-second", type=float, default=60)
+    parser.add_argument("--concurrency", type=int, default=None, help="segments summarized in parallel")
+    args = parser.parse_args()
+
+    with MockServer(handler=AnthropicHandler, path="", latency=0.3, tokens_per_second=args.tokens_per_second,
+                    latency_per_input_token=1 / args.prefill_tokens_per_second) as server:
+        os.environ["ANTHROPIC_BASE_URL"] = server.url
+        os.environ.setdefault("ANTHROPIC_API_KEY", "benchmark")
+
+        import app
+
+        if args.concurrency:
+            app.SOAP_MAP_CONCURRENCY = args.concurrency
+        print(f"mock model: 0.3 s + prefill at {args.prefill_tokens_per_second:.0f} tok/s, "
+              f"decode at {args.tokens_per_second:.0f} tok/s; {app.SOAP_SEGMENT_TOKENS} tokens per segment, "
+              f"{app.SOAP_MAP_CONCURRENCY} in parallel\n")
+        print(f"{'transcript':>12}  {'segments':>8}  {'single-shot':>11}  {'map-reduce':>10}")
+        for tokens in args.tokens:
+            # Different text per run so the mock's prompt cache never helps
+            transcript = f"Session {tokens}\n" + synthetic_transcript(tokens)
+            single = timed_note(app, transcript, threshold=10 ** 9)
+            transcript = f"Session {tokens} again\n" + synthetic_transcript(tokens)
+            mapped = timed_note(app, transcript, threshold=0)
+            segments = len(app.segment_transcript(transcript))
+            print(f"{tokens:>12,}  {segments:>8}  {single:>10.2f}s  {mapped:>9.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+A burst of SOAP notes against a rate-limited Messages API: direct SDK calls
+(its own retries only) vs the shared rate limiter in app.py.
+
+The stand-in enforces a requests- and input-tokens-per-minute quota and
+answers over-quota requests with 429 + Retry-After, like the real API. The
+limiter starts from the app's configured limits and learns the quota from
+the response headers.
+
+    python benchmarks/bench_rate_limiter.py --notes 90 --rpm 60
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_map_reduce import synthetic_transcript  # noqa: E402
+from mock_servers import AnthropicHandler, MockServer, Quota  # noqa: E402
+
+
+def burst(fn, notes: int, concurrency: int) -> tuple[int, float]:
+    """Run ``fn(i)`` for every note at once; return (failures, seconds)."""
+    def attempt(i):
+        try:
+            fn(i)
+            return True
+        except Exception:
+            return False
+
+    start = time.perf_counter()
+    # One redirect around the pool: per-thread redirects restore out of order
+    with contextlib.redirect_stdout(io.StringIO()), ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(attempt, range(notes)))
+    return results.count(False), time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--notes", type=int, default=90)
+    parser.add_argument("--concurrency", type=int, default=32, help="clinicians generating at once")
+    parser.add_argument("--rpm", type=float, default=60, help="provider requests per minute")
+    parser.add_argument("--itpm", type=float, default=200000, help="provider input tokens per minute")
+    parser.add_argument("--transcript-tokens", type=int, default=2000)
+    args = parser.parse_args()
+
+    quota = Quota(args.rpm, args.itpm)
+    with MockServer(handler=AnthropicHandler, path="", latency=0.3, tokens_per_second=400, quota=quota) as server:
+        os.environ["ANTHROPIC_BASE_URL"] = server.url
+        os.environ.setdefault("ANTHROPIC_API_KEY", "benchmark")
+
+        import anthropic
+        import app
+
+        transcript = synthetic_transcript(args.transcript_tokens)
+
+        # A plain client, so the limiter does not see the direct run's 429s
+        client = anthropic.Anthropic()
+
+        def direct(i):
+            request = app.build_soap_request(f"Session {i}\n{transcript}")
+            client.messages.create(**request)
+
+        def limited(i):
+            app.generate_soap_note(f"Session {i} again\n{transcript}", use_cache=False)
+
+        print(f"{args.notes} notes from {args.concurrency} threads; quota {args.rpm:.0f} RPM, "
+              f"{args.itpm:,.0f} input TPM\n")
+        print(f"{'':<14}  {'429s':>5}  {'failed':>6}  {'seconds':>7}  {'notes/min':>9}")
+        for label, fn in (("direct", direct), ("rate limiter", limited)):
+            # Start each run with a full provider allowance
+            quota.__init__(args.rpm, args.itpm)
+            failures, seconds = burst(fn, args.notes, args.concurrency)
+            done = args.notes - failures
+            print(f"{label:<14}  {quota.rejected:>5}  {failures:>6}  {seconds:>7.1f}  {done / seconds * 60:>9.1f}")
+        # The quota admits one minute's allowance at once, then refills steadily
+        per_note = quota.input_tokens / max(1, quota.accepted)
+        ideal = max(0.0, args.notes - args.rpm) * 60 / args.rpm
+        if args.itpm:
+            ideal = max(ideal, (args.notes * per_note - args.itpm) * 60 / args.itpm)
+        print(f"\nfastest the quota allows: ~{ideal:.0f} s plus one response time "
+              f"({per_note:,.0f} input tokens per note)")
+
+if __name__ == "__main__":
+    main()
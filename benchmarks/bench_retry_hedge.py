@@ -0,0 +1,83 @@
+"""
+Failure rate and tail latency of short-clip transcription against a flaky
+Deepgram stand-in: no retries vs jittered retries vs retries plus hedging.
+
+The stand-in answers some requests with 503, drops some connections and
+stalls some responses (seeded, so every configuration sees the same mix).
+
+    python benchmarks/bench_retry_hedge.py --requests 300 --error-rate 0.03 --drop-rate 0.02 --slow-rate 0.05
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_servers import Faults, MockServer, synthetic_session_wav  # noqa: E402
+
+
+def run(app, clip: bytes, requests: int, concurrency: int) -> tuple[int, list[float]]:
+    """Transcribe ``clip`` ``requests`` times; return (failures, latencies of successes)."""
+    def one(_):
+        start = time.perf_counter()
+        try:
+            app.transcribe_audio_sync(clip, "audio/wav")
+        except RuntimeError:
+            return None
+        return time.perf_counter() - start
+
+    with contextlib.redirect_stdout(io.StringIO()), ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(one, range(requests)))
+    latencies = [r for r in results if r is not None]
+    return len(results) - len(latencies), latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--clip-seconds", type=float, default=20)
+    parser.add_argument("--error-rate", type=float, default=0.03)
+    parser.add_argument("--drop-rate", type=float, default=0.02)
+    parser.add_argument("--slow-rate", type=float, default=0.05)
+    parser.add_argument("--slow-seconds", type=float, default=3.0)
+    args = parser.parse_args()
+
+    # Keep the rate limiter out of the measurement
+    os.environ["DEEPGRAM_RPM"] = "1000000"
+    clip = synthetic_session_wav(args.clip_seconds)
+    with MockServer(latency=0.2, latency_per_audio_second=0.01) as server:
+        os.environ["DEEPGRAM_API_URL"] = server.url
+        os.environ.setdefault("DEEPGRAM_API_KEY", "benchmark")
+
+        import app
+
+        # Learn the healthy short-clip p95 that hedging fires at
+        run(app, clip, 2 * app.HEDGE_MIN_SAMPLES, args.concurrency)
+        threshold = app.get_latency_window("deepgram_short_clip").percentile(95, app.HEDGE_AFTER_SECONDS)
+
+        print(f"{args.requests} x {args.clip_seconds:.0f} s clips ({len(clip) // 1024} KB), {args.concurrency} at a time; "
+              f"faults: {args.error_rate:.0%} 503, {args.drop_rate:.0%} dropped, "
+              f"{args.slow_rate:.0%} +{args.slow_seconds:.0f} s; hedge after p95 = {threshold:.2f} s\n")
+        print(f"{'':<18}  {'failed':>6}  {'p50':>7}  {'p95':>7}  {'p99':>7}  {'requests sent':>13}")
+        for label, retries, hedge in (("no retries", 0, False), ("retries", 3, False), ("retries + hedging", 3, True)):
+            app.DEEPGRAM_MAX_RETRIES, app.DEEPGRAM_HEDGE = retries, hedge
+            server._server.faults = Faults(
+                args.error_rate, args.drop_rate, args.slow_rate, args.slow_seconds, seed=1
+            )
+            sent = server.requests
+            failures, latencies = run(app, clip, args.requests, args.concurrency)
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+            print(f"{label:<18}  {failures / args.requests:>6.1%}  {p50:>6.2f}s  {p95:>6.2f}s  {p99:>6.2f}s  "
+                  f"{(server.requests - sent) / args.requests:>12.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Cost of updating a note after a small transcript correction: full
+regeneration vs rewriting only the affected sections.
+
+Runs against a local stand-in for the Messages API that models prefill time
+per uncached input token and a fixed decode rate, and reports usage as the
+real API would (output tokens = length of the returned tool input, cache
+keyed on tools and tool choice). The note is generated from the original
+transcript first, as in the app; neither update is pre-warmed.
+
+    python benchmarks/bench_section_regen.py --tokens 8000
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_map_reduce import synthetic_transcript  # noqa: E402
+from mock_servers import SAMPLE_NOTE, AnthropicHandler, MockServer  # noqa: E402
+
+TOKEN_COUNTERS = ["input_tokens", "output_tokens", "cache_read_input_tokens", "cache_creation_input_tokens"]
+
+
+def measured(app, fn, *args):
+    """Run ``fn`` and return (seconds, token usage recorded while it ran)."""
+    before = app.metrics_snapshot()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        fn(*args)
+    elapsed = time.perf_counter() - start
+    after = app.metrics_snapshot()
+    usage = {name: after.get(f"anthropic_{name}_total", 0) - before.get(f"anthropic_{name}_total", 0)
+             for name in TOKEN_COUNTERS}
+    return elapsed, usage
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--tokens", type=int, default=8000, help="transcript length")
+    parser.add_argument("--prefill-tokens-per-second", type=float, default=10000)
+    parser.add_argument("--tokens-per-second", type=float, default=60)
+    args = parser.parse_args()
+
+    with MockServer(handler=AnthropicHandler, path="", latency=0.3, tokens_per_second=args.tokens_per_second,
+                    latency_per_input_token=1 / args.prefill_tokens_per_second) as server:
+        os.environ["ANTHROPIC_BASE_URL"] = server.url
+        os.environ.setdefault("ANTHROPIC_API_KEY", "benchmark")
+
+        import app
+
+        transcript = synthetic_transcript(args.tokens)
+        with contextlib.redirect_stdout(io.StringIO()):
+            note = app.generate_soap_note(transcript, "", False)
+        # A correction touching the sponsor plan, which only the mock note's plan mentions
+        edited = transcript + "\nClient: I will contact my sponsor before family visits, not after."
+        sections = app.affected_sections(transcript, edited, app.SOAPNote(**SAMPLE_NOTE))
+        print(f"{args.tokens:,}-token transcript, one sentence added; affected sections: {', '.join(sections)}\n")
+
+        part_time, part = measured(app, app.regenerate_sections, edited, "", note, sections, transcript)
+        full_time, full = measured(app, app.generate_soap_note, edited, "", False)
+
+        print(f"{'':<22}{'time':>8}{'input':>9}{'cache read':>12}{'cache write':>13}{'total in':>10}{'output':>9}")
+        for label, elapsed, usage in [("full regeneration", full_time, full), ("affected sections", part_time, part)]:
+            usage["total"] = sum(usage[name] for name in TOKEN_COUNTERS if name != "output_tokens")
+            print(f"{label:<22}{elapsed:>7.2f}s{usage['input_tokens']:>9}{usage['cache_read_input_tokens']:>12}"
+                  f"{usage['cache_creation_input_tokens']:>13}{usage['total']:>10}{usage['output_tokens']:>9}")
+        print(f"\ninput tokens saved: {full['total'] - part['total']:,} ({1 - part['total'] / full['total']:.0%}), "
+              f"output tokens saved: {full['output_tokens'] - part['output_tokens']:,} "
+              f"({1 - part['output_tokens'] / full['output_tokens']:.0%}), time: {part_time / full_time:.0%} of full")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Server memory per idle session: runs app.py under a real headless Streamlit
+server and leaves finished sessions open, as forgotten browser tabs would.
+
+Each scripted browser uploads its own recording (through the same upload
+endpoint the frontend uses), transcribes it against the local Deepgram
+stand-in, generates the note and then stays connected without interacting.
+The server's resident memory is read before and after, so the growth per
+session is what one idle tab costs the server.
+
+    python benchmarks/bench_session_memory.py --sessions 8 --clip-seconds 60
+    python benchmarks/bench_session_memory.py --app /tmp/app_before.py   # compare another version
+"""
+
+import argparse
+import asyncio
+import contextlib
+import gc
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_ui_reruns import APP_PATH, Browser, streamlit_server  # noqa: E402
+from mock_servers import AnthropicHandler, MockServer, synthetic_session_wav  # noqa: E402
+
+
+def rss_mb(pid: int) -> float:
+    """Current resident memory of a process in MB."""
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+async def wait_for(browser: Browser, element: str, timeout: float = 120) -> None:
+    """Rerun like the progress fragment until ``element`` is on the page."""
+    deadline = time.monotonic() + timeout
+    while element not in browser.elements:
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"no {element} after {timeout:.0f} s")
+        await asyncio.sleep(0.5)
+        await browser.rerun()
+
+
+async def open_session(stack: contextlib.AsyncExitStack, port: int, clip: bytes) -> None:
+    """One clinician's session, left open once the note is displayed."""
+    import websockets
+
+    websocket = await stack.enter_async_context(websockets.connect(
+        f"ws://127.0.0.1:{port}/_stcore/stream", subprotocols=["streamlit"], max_size=None,
+    ))
+    browser = Browser(websocket, port)
+    await browser.rerun()
+    await browser.set("Choose input method:", string_value="📁 Upload Audio File")
+    await browser.upload("Upload an audio recording of the therapy session", "session.wav", clip, "audio/wav")
+    await browser.set("🎯 Transcribe Audio", trigger_value=True)
+    await wait_for(browser, "text_area")
+    await browser.set("🧠 Generate SOAP Note", trigger_value=True)
+    await wait_for(browser, "download_button")
+
+
+async def drive(port: int, pid: int, clips: list) -> tuple:
+    async with contextlib.AsyncExitStack() as stack:
+        # The first session loads the models, clients and caches every later one shares
+        await open_session(stack, port, clips[0])
+        await asyncio.sleep(1)
+        baseline = rss_mb(pid)
+        for clip in clips[1:]:
+            await open_session(stack, port, clip)
+        # Let finished jobs and script runs settle before measuring the idle tabs
+        await asyncio.sleep(2)
+        return baseline, rss_mb(pid)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--app", default=APP_PATH, help="app script to serve")
+    parser.add_argument("--sessions", type=int, default=8, help="idle sessions to open")
+    parser.add_argument("--clip-seconds", type=float, default=60)
+    parser.add_argument("--sample-rate", type=int, default=44100)
+    parser.add_argument("--channels", type=int, default=2)
+    args = parser.parse_args()
+
+    # Distinct audio per session so the transcription cache never answers
+    clips = [synthetic_session_wav(args.clip_seconds, args.sample_rate, args.channels, seed=i)
+             for i in range(args.sessions + 1)]
+    gc.collect()
+    deepgram = MockServer(latency=0.3)
+    anthropic = MockServer(handler=AnthropicHandler, path="", latency=0.2, tokens_per_second=2000)
+    with deepgram, anthropic:
+        env = dict(os.environ, DEEPGRAM_API_URL=deepgram.url, DEEPGRAM_API_KEY="benchmark",
+                   ANTHROPIC_BASE_URL=anthropic.url, ANTHROPIC_API_KEY="benchmark")
+        with streamlit_server(args.app, env) as (port, server):
+            baseline, idle = asyncio.run(drive(port, server.pid, clips))
+
+    print(f"{os.path.relpath(args.app)}: {args.sessions} idle sessions, "
+          f"{args.clip_seconds:.0f} s recordings ({len(clips[0]) // 1024} KB each), note displayed\n")
+    print(f"server RSS after warm-up   {baseline:>8.1f} MB")
+    print(f"with idle sessions         {idle:>8.1f} MB")
+    print(f"per idle session           {(idle - baseline) / args.sessions * 1024:>8.0f} KB")
+
+
+if __name__ == "__main__":
+    main()
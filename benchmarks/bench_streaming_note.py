@@ -0,0 +1,65 @@
+"""
+Perceived latency of SOAP generation: time until the first SOAP section can be
+rendered from the token stream vs waiting for the complete response.
+
+Runs against a local stand-in for the Messages API that emits tokens at a
+fixed rate after a fixed time to first token.
+
+    python benchmarks/bench_streaming_note.py --notes 5 --tokens-per-second 60
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_servers import AnthropicHandler, MockServer  # noqa: E402
+
+TRANSCRIPT = "Therapist: How was your week? Client: Better. I went to three meetings and called my sponsor."
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--notes", type=int, default=5)
+    parser.add_argument("--first-token", type=float, default=0.5, help="seconds before the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=60)
+    args = parser.parse_args()
+
+    with MockServer(handler=AnthropicHandler, path="", latency=args.first_token,
+                    tokens_per_second=args.tokens_per_second) as server:
+        os.environ["ANTHROPIC_BASE_URL"] = server.url
+        os.environ.setdefault("ANTHROPIC_API_KEY", "benchmark")
+
+        import app
+
+        client = app.get_anthropic_client()
+        sections = {key for key, _ in app.SOAP_SECTIONS}
+        first_section, complete = [], []
+        for _ in range(args.notes):
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                for key, _ in app.stream_soap_note(TRANSCRIPT, ""):
+                    if key in sections and len(first_section) < len(complete) + 1:
+                        first_section.append(time.perf_counter() - start)
+            complete.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        request = app.build_soap_request(TRANSCRIPT, "")
+        with contextlib.redirect_stdout(io.StringIO()):
+            app.note_data_from_message(client.messages.create(**request))
+        blocking = time.perf_counter() - start
+
+        print(f"{args.notes} notes, {args.first_token:.1f} s to first token, {args.tokens_per_second:.0f} tokens/s\n")
+        print(f"blocking messages.create    {blocking:6.2f} s until anything is shown")
+        print(f"streamed, first section     {statistics.fmean(first_section):6.2f} s")
+        print(f"streamed, complete note     {statistics.fmean(complete):6.2f} s")
+        print(f"\nperceived latency reduced by {1 - statistics.fmean(first_section) / blocking:.0%}")
+
+
+if __name__ == "__main__":
+    main()
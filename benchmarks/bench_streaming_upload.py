@@ -0,0 +1,83 @@
+"""
+Peak client memory of transcribe_audio_sync for growing files: reading the
+upload into bytes first vs passing the open file so it is streamed.
+
+Each measurement runs in a fresh subprocess and reports its peak RSS; the
+local Deepgram stand-in runs in the parent process.
+
+    python benchmarks/bench_streaming_upload.py --sizes-mb 25 50 100 200
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from mock_servers import MockServer  # noqa: E402
+
+
+def child(mode: str, path: str):
+    import app
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        with open(path, "rb") as f:
+            if mode == "bytes":
+                app.transcribe_audio_sync(f.read(), "audio/mp4")
+            else:
+                app.transcribe_audio_sync(f, "audio/mp4")
+    print(peak_rss_mb())
+
+
+def peak_rss_mb() -> float:
+    """Peak resident memory of this process in MB.
+    VmHWM is reset on exec, unlike ru_maxrss which a child inherits from the
+    parent it was forked from.
+    """
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(mode: str, path: str, url: str) -> float:
+    env = dict(os.environ, DEEPGRAM_API_URL=url, DEEPGRAM_API_KEY="benchmark")
+    output = subprocess.run(
+        [sys.executable, __file__, "--child", mode, path],
+        env=env, capture_output=True, text=True, check=True,
+    ).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes-mb", type=int, nargs="+", default=[25, 50, 100, 200])
+    parser.add_argument("--child", nargs=2, metavar=("MODE", "PATH"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(*args.child)
+        return
+
+    print(f"{'file':>8}   {'read() to bytes':>16}   {'streamed file':>14}")
+    with MockServer() as server, tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes_mb:
+            path = os.path.join(tmp, f"{size}.m4a")
+            with open(path, "wb") as f:
+                for _ in range(size):
+                    f.write(os.urandom(1024 * 1024))
+            in_memory = measure("bytes", path, server.url)
+            streamed = measure("stream", path, server.url)
+            print(f"{size:>5} MB   {in_memory:>11.0f} MB RSS   {streamed:>9.0f} MB RSS")
+            os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+"""
+Server CPU per UI interaction: runs app.py under a real headless Streamlit
+server and drives it over the browser websocket protocol.
+
+A scripted browser loads a transcript, generates the note (against the local
+Messages API stand-in) and then repeats single interactions on the finished
+page, measuring the server process's CPU time for each rerun. Widgets inside
+an ``st.fragment`` rerun only their fragment, as in the browser.
+
+    python benchmarks/bench_ui_reruns.py --repeats 20
+    python benchmarks/bench_ui_reruns.py --app /tmp/app_before.py   # compare another version
+"""
+
+import argparse
+import asyncio
+import contextlib
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_map_reduce import synthetic_transcript  # noqa: E402
+from mock_servers import AnthropicHandler, MockServer  # noqa: E402
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+INPUT_MODES = ["🎙️ Record Audio", "📁 Upload Audio File"]
+
+
+def cpu_seconds(pid: int) -> float:
+    """User + system CPU time of a process so far."""
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@contextlib.contextmanager
+def streamlit_server(app: str, env: dict):
+    """Serve ``app`` headlessly; yields ``(port, process)`` once it is healthy."""
+    port = free_port()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "streamlit", "run", os.path.abspath(app),
+         "--server.headless", "true", "--server.port", str(port), "--server.address", "127.0.0.1",
+         "--server.enableXsrfProtection", "false", "--browser.gatherUsageStats", "false"],
+        env=env, cwd=os.path.dirname(os.path.abspath(app)),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        for _ in range(100):
+            try:
+                urllib.request.urlopen(f"http://127.0.0.1:{port}/_stcore/health")
+                break
+            except OSError:
+                time.sleep(0.2)
+        yield port, server
+    finally:
+        server.terminate()
+        server.wait()
+
+
+class Browser:
+    """Just enough of the Streamlit frontend: tracks widgets and their values
+    from the element deltas and sends reruns with the current widget states.
+    """
+
+    def __init__(self, websocket, port: int = 0):
+        from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+
+        self.websocket = websocket
+        self.port = port
+        self.ForwardMsg = ForwardMsg
+        self.session_id = None
+        self.widgets = {}  # label -> (element type, widget id, fragment id)
+        self.states = {}  # widget id -> WidgetState
+        self.elements = set()  # element types rendered by the last full run
+
+    async def rerun(self, fragment_id: str = "") -> None:
+        """Send one rerun and read messages until the script (or fragment) finishes."""
+        from streamlit.proto.BackMsg_pb2 import BackMsg
+        from streamlit.proto.ClientState_pb2 import ClientState
+        from streamlit.proto.WidgetStates_pb2 import WidgetStates
+
+        state = ClientState(widget_states=WidgetStates(widgets=list(self.states.values())), fragment_id=fragment_id)
+        await self.websocket.send(BackMsg(rerun_script=state).SerializeToString())
+        # Button clicks are one-shot triggers
+        self.states = {k: v for k, v in self.states.items() if not v.HasField("trigger_value")}
+        if not fragment_id:
+            self.elements = set()
+        while True:
+            msg = self.ForwardMsg()
+            msg.ParseFromString(await self.websocket.recv())
+            if msg.HasField("new_session"):
+                self.session_id = msg.new_session.initialize.session_id
+            elif msg.HasField("delta") and msg.delta.HasField("new_element"):
+                element = msg.delta.new_element
+                kind = element.WhichOneof("type")
+                self.elements.add(kind)
+                widget = getattr(element, kind)
+                if hasattr(widget, "id") and hasattr(widget, "label") and widget.id:
+                    self.widgets[widget.label] = (kind, widget.id, msg.delta.fragment_id)
+            elif msg.HasField("script_finished") and msg.script_finished != msg.FINISHED_EARLY_FOR_RERUN:
+                return
+
+    async def set(self, label: str, **value) -> None:
+        """Change a widget (``string_value=...``, ``trigger_value=True``...) and rerun its scope."""
+        from streamlit.proto.WidgetStates_pb2 import WidgetState
+
+        _, widget_id, fragment_id = self.widgets[label]
+        self.states[widget_id] = WidgetState(id=widget_id, **value)
+        await self.rerun(fragment_id)
+
+    async def upload(self, label: str, name: str, data: bytes, mime: str) -> None:
+        """Upload a file into a file uploader, the way the frontend does."""
+        import httpx
+        from streamlit.proto.BackMsg_pb2 import BackMsg
+        from streamlit.proto.Common_pb2 import FileURLsRequest, FileUploaderState, UploadedFileInfo
+
+        request = FileURLsRequest(request_id=name, file_names=[name], session_id=self.session_id)
+        await self.websocket.send(BackMsg(file_urls_request=request).SerializeToString())
+        while True:
+            msg = self.ForwardMsg()
+            msg.ParseFromString(await self.websocket.recv())
+            if msg.HasField("file_urls_response"):
+                urls = msg.file_urls_response.file_urls[0]
+                break
+        response = await asyncio.to_thread(
+            httpx.put, f"http://127.0.0.1:{self.port}{urls.upload_url}", files={"file": (name, data, mime)},
+        )
+        response.raise_for_status()
+        info = UploadedFileInfo(file_id=urls.file_id, name=name, size=len(data), file_urls=urls)
+        await self.set(label, file_uploader_state_value=FileUploaderState(uploaded_file_info=[info]))
+
+
+async def drive(port: int, pid: int, repeats: int, transcript: str) -> dict:
+    import websockets
+
+    async with websockets.connect(f"ws://127.0.0.1:{port}/_stcore/stream", subprotocols=["streamlit"],
+                                  max_size=None) as websocket:
+        browser = Browser(websocket)
+        await browser.rerun()
+        await browser.set("Choose input method:", string_value="📝 Enter Transcript Directly")
+        await browser.set("Paste or type session transcript:", string_value=transcript)
+        await browser.set("✅ Use This Transcript", trigger_value=True)
+        await browser.set("🧠 Generate SOAP Note", trigger_value=True)
+        deadline = time.monotonic() + 60
+        while "download_button" not in browser.elements:
+            if time.monotonic() > deadline:
+                raise TimeoutError("the note never rendered")
+            await asyncio.sleep(0.5)
+            await browser.rerun()
+
+        interactions = {
+            "edit transcript": lambda i: browser.set("Edit transcript if needed:", string_value=f"{transcript} {i}"),
+            "edit client name": lambda i: browser.set("Client Name", string_value=f"Client {i}"),
+            "switch input method": lambda i: browser.set("Choose input method:", string_value=INPUT_MODES[i % 2]),
+        }
+        results = {}
+        for name, interact in interactions.items():
+            cpu, wall = [], []
+            for i in range(repeats):
+                before, start = cpu_seconds(pid), time.perf_counter()
+                await interact(i)
+                wall.append(time.perf_counter() - start)
+                cpu.append(cpu_seconds(pid) - before)
+            results[name] = (statistics.fmean(cpu), statistics.median(wall))
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--app", default=APP_PATH, help="app script to serve")
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--transcript-tokens", type=int, default=6000)
+    args = parser.parse_args()
+
+    with MockServer(handler=AnthropicHandler, path="", latency=0.2, tokens_per_second=2000) as anthropic:
+        env = dict(os.environ, ANTHROPIC_BASE_URL=anthropic.url, ANTHROPIC_API_KEY="benchmark",
+                   DEEPGRAM_API_KEY="benchmark")
+        with streamlit_server(args.app, env) as (port, server):
+            results = asyncio.run(drive(port, server.pid, args.repeats, synthetic_transcript(args.transcript_tokens)))
+
+    print(f"{os.path.relpath(args.app)}: {args.repeats} repeats per interaction, "
+          f"{args.transcript_tokens}-token transcript, note displayed\n")
+    print(f"{'interaction':<20}  {'server CPU':>10}  {'round trip':>10}")
+    for name, (cpu, wall) in results.items():
+        print(f"{name:<20}  {cpu * 1000:>8.1f}ms  {wall * 1000:>8.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
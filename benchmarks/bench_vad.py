@@ -0,0 +1,47 @@
+"""
+Throughput of the silence-trimming pass in audio-seconds per CPU-second.
+
+Uses synthetic speech-like audio (noise bursts separated by pauses) at the
+16 kHz mono format produced by preprocess_audio, and at a raw 48 kHz stereo
+recording format for comparison.
+
+    python benchmarks/bench_vad.py --minutes 60
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_servers import synthetic_session_wav  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--minutes", type=float, default=60)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    import app
+
+    seconds = args.minutes * 60
+    print(f"{args.minutes:g} min synthetic session\n")
+    for rate, channels in ((16000, 1), (48000, 2)):
+        audio = synthetic_session_wav(seconds, rate=rate, channels=channels)
+        best = float("inf")
+        for _ in range(args.repeat):
+            start = time.process_time()
+            with contextlib.redirect_stdout(io.StringIO()):
+                trimmed, _, stats = app.trim_silence(audio)
+            best = min(best, time.process_time() - start)
+        print(f"{rate // 1000:>2} kHz x{channels}  {seconds / best:9.0f} audio-s per CPU-s   "
+              f"removed {stats['silence_removed_seconds'] / seconds:.0%} "
+              f"({len(audio) / 1e6:.0f} MB -> {len(trimmed) / 1e6:.0f} MB)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Word timings of a long session: per-word dicts (as decoded from Deepgram's
+JSON) vs the columnar WordTable kept in transcription results.
+
+Reports memory retained by each, and the time for random time-window and
+speaker queries and for rendering the speaker-labelled transcript.
+
+    python benchmarks/bench_word_table.py --words 15000 --queries 2000
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_servers import deepgram_response  # noqa: E402
+
+
+def retained_kb(build):
+    """KB still allocated by ``build()``'s result, and the result."""
+    tracemalloc.start()
+    result = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size / 1024, result
+
+
+def timed(fn, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+def labelled_from_dicts(words: list) -> str:
+    """Speaker turns from per-word dicts, the way a dict-based pipeline groups them."""
+    turns = []
+    for word in words:
+        if turns and turns[-1][0] == word["speaker"]:
+            turns[-1][1].append(word["punctuated_word"])
+        else:
+            turns.append((word["speaker"], [word["punctuated_word"]]))
+    return "\n\n".join(f"Speaker {speaker + 1}: {' '.join(text)}" for speaker, text in turns)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--words", type=int, default=15000, help="~15k words is a 90-minute session")
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--window-seconds", type=float, default=60)
+    args = parser.parse_args()
+
+    with contextlib.redirect_stderr(io.StringIO()):
+        import app
+
+    # The stand-in emits two words a second, alternating speakers every ten seconds
+    body = json.dumps(deepgram_response(duration=args.words / 2))
+    dict_kb, words = retained_kb(lambda: json.loads(body)["results"]["channels"][0]["alternatives"][0]["words"])
+    table_kb, table = retained_kb(lambda: app.WordTable.from_words(words))
+    duration = words[-1]["end"]
+
+    rng = random.Random(0)
+    windows = [(start, start + args.window_seconds, rng.choice([0, 1]))
+               for start in (rng.uniform(0, duration) for _ in range(args.queries))]
+    for start, end, speaker in windows[:50]:
+        expected = [i for i, w in enumerate(words) if w["end"] > start and w["start"] < end and w["speaker"] == speaker]
+        assert table.select(start, end, speaker).tolist() == expected
+    assert table.labelled_transcript() == labelled_from_dicts(words)
+
+    def dict_queries():
+        for start, end, speaker in windows:
+            [w for w in words if w["end"] > start and w["start"] < end and w["speaker"] == speaker]
+
+    def table_queries():
+        for start, end, speaker in windows:
+            table.words(start, end, speaker)
+
+    print(f"{len(words)} words ({duration / 60:.0f} min), {args.queries} queries of "
+          f"{args.window_seconds:.0f} s windows for one speaker\n")
+    print(f"{'':<24}  {'per-word dicts':>14}  {'WordTable':>10}")
+    print(f"{'memory retained':<24}  {dict_kb:>11.0f} KB  {table_kb:>7.0f} KB")
+    print(f"{'query (per window)':<24}  {timed(dict_queries, 1) / args.queries * 1e6:>11.0f} us  "
+          f"{timed(table_queries, 1) / args.queries * 1e6:>7.0f} us")
+    print(f"{'labelled transcript':<24}  {timed(lambda: labelled_from_dicts(words), 5) * 1000:>11.1f} ms  "
+          f"{timed(table.labelled_transcript, 5) * 1000:>7.1f} ms")
+    print(f"{'build from dicts':<24}  {'':>14}  {timed(lambda: app.WordTable.from_words(words), 5) * 1000:>7.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""
+Load test: N virtual clinicians driving app.py under a real headless
+Streamlit server against the local API stand-ins, to find how many
+concurrent users one server process carries.
+
+Each virtual user is a browser session speaking the Streamlit websocket
+protocol (see bench_ui_reruns.Browser), so reruns from different users are
+scheduled by the server itself, as they are in production: concurrent
+script threads sharing the GIL, the app's cached clients and its job engine.
+
+A user uploads a recording (through the frontend's upload endpoint),
+transcribes it, generates the note and waits for the exports, polling
+running jobs the way the browser does. Finished sessions stay connected, as
+browser tabs would. Every user count gets a fresh server and reports:
+
+- throughput in completed sessions per minute, and whether it still scales
+- p50/p95 time per session and per interaction (one rerun round trip)
+- queueing delay for a free job-engine worker, from the app's /metrics
+  (which also counts the warm-up session's jobs)
+- the server's CPU use (100% is one core: the GIL's ceiling for rendering)
+- server memory growth per session still held open
+
+    python benchmarks/load_test.py --users 1 4 16 32 --sessions 2
+"""
+
+import argparse
+import asyncio
+import contextlib
+import os
+import re
+import sys
+import time
+import urllib.request
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_session_memory import rss_mb  # noqa: E402
+from bench_ui_reruns import APP_PATH, Browser, cpu_seconds, free_port, streamlit_server  # noqa: E402
+from mock_servers import AnthropicHandler, MockServer, synthetic_session_wav  # noqa: E402
+
+
+def scrape(port: int) -> dict:
+    """``{stage: (count, sum)}`` of the app's stage histograms from /metrics."""
+    text = urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics").read().decode()
+    stages = {}
+    for name, stage, value in re.findall(r'stage_duration_seconds_(count|sum)\{stage="(\w+)"\} (\S+)', text):
+        count, total = stages.get(stage, (0, 0.0))
+        stages[stage] = (float(value), total) if name == "count" else (count, float(value))
+    return stages
+
+
+class VirtualClinician:
+    """One browser session walking through the four-step workflow."""
+
+    def __init__(self, browser: Browser, poll_seconds: float, timeout: float):
+        self.browser = browser
+        self.poll_seconds = poll_seconds
+        self.timeout = timeout
+        self.round_trips = []
+
+    async def run(self, interaction) -> None:
+        """One interaction: send it and wait until the server has finished the rerun."""
+        start = time.perf_counter()
+        await interaction
+        self.round_trips.append(time.perf_counter() - start)
+        if "exception" in self.browser.elements:
+            raise RuntimeError("the script raised an exception")
+
+    async def wait_for(self, element: str) -> None:
+        """Rerun every ``poll_seconds`` (like the progress fragment) until ``element`` is on the page."""
+        deadline = time.monotonic() + self.timeout
+        while element not in self.browser.elements:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"no {element} after {self.timeout:.0f} s")
+            await asyncio.sleep(self.poll_seconds)
+            await self.run(self.browser.rerun())
+
+    async def session(self, clip: bytes) -> float:
+        browser = self.browser
+        start = time.perf_counter()
+        await self.run(browser.rerun())
+        await self.run(browser.set("Choose input method:", string_value="📁 Upload Audio File"))
+        await self.run(browser.upload("Upload an audio recording of the therapy session", "session.wav", clip,
+                                      "audio/wav"))
+        await self.run(browser.set("🎯 Transcribe Audio", trigger_value=True))
+        await self.wait_for("text_area")
+        await self.run(browser.set("🧠 Generate SOAP Note", trigger_value=True))
+        await self.wait_for("download_button")
+        return time.perf_counter() - start
+
+
+async def drive(port: int, pid: int, users: int, sessions: int, clips: list, poll_seconds: float) -> dict:
+    """Run ``users`` clinicians for ``sessions`` sessions each, every session in
+    its own connection, after one warm-up session (``clips[0]``).
+    """
+    import websockets
+
+    clinicians, durations, failed = [], [], 0
+
+    async with contextlib.AsyncExitStack() as stack:
+        async def connect() -> VirtualClinician:
+            # Every session stays open, as browser tabs would, to measure its memory
+            websocket = await stack.enter_async_context(websockets.connect(
+                f"ws://127.0.0.1:{port}/_stcore/stream", subprotocols=["streamlit"], max_size=None,
+            ))
+            return VirtualClinician(Browser(websocket, port), poll_seconds, timeout=300)
+
+        async def user(index: int) -> None:
+            nonlocal failed
+            for n in range(sessions):
+                try:
+                    clinician = await connect()
+                    clinicians.append(clinician)
+                    durations.append(await clinician.session(clips[1 + index * sessions + n]))
+                except Exception as e:
+                    failed += 1
+                    print(f"user {index}: {e!r}", file=sys.stderr)
+
+        # The first session loads the models, clients and caches every later one shares
+        await (await connect()).session(clips[0])
+        await asyncio.sleep(1)
+        baseline, cpu_before = rss_mb(pid), cpu_seconds(pid)
+        start = time.perf_counter()
+        await asyncio.gather(*(user(i) for i in range(users)))
+        elapsed = time.perf_counter() - start
+        cpu = cpu_seconds(pid) - cpu_before
+        # Let finished jobs and script runs settle before measuring the open sessions
+        await asyncio.sleep(2)
+        return {
+            "elapsed": elapsed,
+            "durations": durations,
+            "failed": failed,
+            "round_trips": [r for c in clinicians for r in c.round_trips],
+            "cpu": cpu / elapsed,
+            "memory_per_session_mb": (rss_mb(pid) - baseline) / max(1, len(clinicians)),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--app", default=APP_PATH, help="app script to serve")
+    parser.add_argument("--users", type=int, nargs="+", default=[1, 4, 16, 32])
+    parser.add_argument("--sessions", type=int, default=2, help="sessions per user")
+    parser.add_argument("--clip-seconds", type=float, default=60)
+    parser.add_argument("--poll-seconds", type=float, default=0.5)
+    parser.add_argument("--deepgram-latency", type=float, default=0.5)
+    parser.add_argument("--llm-latency", type=float, default=0.5)
+    parser.add_argument("--tokens-per-second", type=float, default=150)
+    args = parser.parse_args()
+
+    deepgram = MockServer(latency=args.deepgram_latency, latency_per_audio_second=0.005)
+    anthropic = MockServer(handler=AnthropicHandler, path="", latency=args.llm_latency,
+                           tokens_per_second=args.tokens_per_second)
+    with deepgram, anthropic:
+        print(f"{args.sessions} sessions per user, {args.clip_seconds:.0f} s recordings; "
+              f"Deepgram {args.deepgram_latency} s, LLM {args.llm_latency} s + {args.tokens_per_second:g} tok/s\n")
+        print(f"{'users':>5}  {'sessions/min':>12}  {'failed':>6}  {'session p50':>11}  {'p95':>7}  "
+              f"{'rerun p50':>9}  {'p95':>7}  {'job queue':>9}  {'server CPU':>10}  {'MB/session':>10}")
+        previous, saturated = 0.0, None
+        for i, users in enumerate(args.users):
+            # Distinct audio per session so the transcription cache never answers
+            clips = [synthetic_session_wav(args.clip_seconds, seed=1000 * i + n)
+                     for n in range(1 + users * args.sessions)]
+            metrics_port = free_port()
+            env = dict(
+                os.environ,
+                DEEPGRAM_API_URL=deepgram.url, DEEPGRAM_API_KEY="benchmark",
+                ANTHROPIC_BASE_URL=anthropic.url, ANTHROPIC_API_KEY="benchmark",
+                DEEPGRAM_RPM="1000000", ANTHROPIC_RPM="1000000", ANTHROPIC_ITPM="1000000000",
+                METRICS_PORT=str(metrics_port),
+            )
+            with streamlit_server(args.app, env) as (port, server):
+                result = asyncio.run(drive(port, server.pid, users, args.sessions, clips, args.poll_seconds))
+                queue_count, queue_sum = scrape(metrics_port).get("job_queue", (0, 0.0))
+
+            rate = len(result["durations"]) / result["elapsed"] * 60
+            s50, s95 = np.percentile(result["durations"] or [0], [50, 95])
+            r50, r95 = np.percentile(result["round_trips"] or [0], [50, 95])
+            queue_delay = queue_sum / queue_count if queue_count else 0.0
+            print(f"{users:>5}  {rate:>12.1f}  {result['failed']:>6}  {s50:>10.1f}s  {s95:>6.1f}s  "
+                  f"{r50 * 1000:>7.0f}ms  {r95 * 1000:>5.0f}ms  {queue_delay:>8.2f}s  {result['cpu']:>9.0%}  "
+                  f"{result['memory_per_session_mb']:>10.1f}")
+            # Saturated once more users add less than half their proportional throughput
+            if saturated is None and previous and rate < previous * (1 + 0.5 * (users / args.users[i - 1] - 1)):
+                saturated = args.users[i - 1]
+            previous = rate
+        if saturated:
+            print(f"\nthroughput stops scaling beyond ~{saturated} concurrent users")
+        else:
+            print(f"\nstill scaling at {args.users[-1]} concurrent users")
+
+
+if __name__ == "__main__":
+    main()
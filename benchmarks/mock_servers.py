@@ -0,0 +1,464 @@
+"""
+Local stand-in servers for the external APIs used by app.py.
+
+The benchmarks in this directory run against these instead of the real
+Deepgram endpoint, so they work offline and without API keys.
+"""
+
+import io
+import json
+import os
+import random
+import re
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+import wave
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+SAMPLE_TRANSCRIPT = (
+    "Client reports feeling more stable this week and attended three meetings. "
+    "She described cravings after an argument with her sister but used her coping plan."
+)
+
+
+def make_self_signed_cert(directory: str) -> tuple[str, str]:
+    """Create a throwaway localhost certificate with the openssl CLI."""
+    certfile = os.path.join(directory, "cert.pem")
+    keyfile = os.path.join(directory, "key.pem")
+    subprocess.run(
+        [
+            "openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes",
+            "-keyout", keyfile, "-out", certfile, "-days", "1",
+            "-subj", "/CN=localhost",
+            "-addext", "subjectAltName=DNS:localhost,IP:127.0.0.1",
+        ],
+        check=True,
+        capture_output=True,
+    )
+    return certfile, keyfile
+
+
+def synthetic_session_wav(seconds: float, rate: int = 16000, channels: int = 1, seed: int = 0) -> bytes:
+    """Speech-like test audio: noise bursts of 1-8 s separated by 0.3-3 s pauses."""
+    rng = np.random.default_rng(seed)
+    total = int(seconds * rate)
+    signal = np.zeros(total, dtype=np.float32)
+    position = 0
+    while position < total:
+        burst = int(rng.uniform(1.0, 8.0) * rate)
+        envelope = 0.3 * (1 + np.sin(np.linspace(0, burst / rate * 2 * np.pi * 4, burst))) / 2
+        signal[position:position + burst] = (rng.standard_normal(burst) * envelope)[: total - position]
+        position += burst + int(rng.uniform(0.3, 3.0) * rate)
+    signal += rng.standard_normal(total).astype(np.float32) * 0.002
+    pcm = (np.clip(signal, -1, 1) * 32767).astype(np.int16)
+    pcm = np.repeat(pcm[:, None], channels, axis=1)
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(channels)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(pcm.tobytes())
+    return buffer.getvalue()
+
+
+def wav_duration(body: bytes) -> float:
+    """Duration of a WAV request body in seconds, or 0.0 for other formats."""
+    try:
+        with wave.open(io.BytesIO(body), "rb") as wav:
+            return wav.getnframes() / wav.getframerate()
+    except (wave.Error, EOFError):
+        return 0.0
+
+
+def deepgram_response(transcript: str = SAMPLE_TRANSCRIPT, confidence: float = 0.97, duration: float = 0.0) -> dict:
+    """Build a minimal Deepgram ``/v1/listen`` response body.
+
+    When ``duration`` is known, one word is emitted every half second with the
+    speaker alternating every ten seconds, roughly like a diarized session.
+    """
+    alternative = {"transcript": transcript, "confidence": confidence}
+    if duration:
+        words = [
+            {"word": "word", "punctuated_word": "word", "start": t / 2, "end": t / 2 + 0.4,
+             "confidence": confidence, "speaker": int(t / 20) % 2}
+            for t in range(int(duration * 2))
+        ]
+        alternative["words"] = words
+        alternative["transcript"] = " ".join(w["punctuated_word"] for w in words)
+    return {
+        "metadata": {"request_id": "mock", "duration": duration},
+        "results": {"channels": [{"alternatives": [alternative]}]},
+    }
+
+
+# Rate-limit headers of an account without a quota. The app's limiter adopts
+# whatever limits responses report, so without these a stand-in with no Quota
+# would leave it on its conservative defaults and the benchmarks would
+# measure the client throttling itself.
+UNLIMITED_RATE_HEADERS = {
+    "anthropic-ratelimit-requests-limit": "1000000",
+    "anthropic-ratelimit-requests-remaining": "1000000",
+    "anthropic-ratelimit-input-tokens-limit": "1000000000",
+    "anthropic-ratelimit-input-tokens-remaining": "1000000000",
+}
+
+
+class Quota:
+    """Provider-side rate limit: ``rpm`` requests and ``itpm`` input tokens per
+    minute, refilled continuously. ``take`` answers like the Messages API,
+    with ``anthropic-ratelimit-*`` headers and a Retry-After on a 429.
+    """
+
+    def __init__(self, rpm: float, itpm: float | None = None):
+        self.limits = {"requests": rpm, "input-tokens": itpm}
+        self.levels = dict(self.limits)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.accepted = 0
+        self.rejected = 0
+        self.input_tokens = 0
+
+    def take(self, tokens: int) -> tuple[bool, dict]:
+        wanted = {"requests": 1, "input-tokens": tokens}
+        with self.lock:
+            now = time.monotonic()
+            for name, limit in self.limits.items():
+                if limit:
+                    self.levels[name] = min(limit, self.levels[name] + (now - self.updated) * limit / 60)
+            self.updated = now
+            short = [
+                (wanted[name] - self.levels[name]) * 60 / limit
+                for name, limit in self.limits.items()
+                if limit and self.levels[name] < min(wanted[name], limit)
+            ]
+            if not short:
+                for name, limit in self.limits.items():
+                    if limit:
+                        self.levels[name] -= wanted[name]
+                self.accepted += 1
+                self.input_tokens += tokens
+            else:
+                self.rejected += 1
+            headers = {}
+            for name, limit in self.limits.items():
+                if limit:
+                    headers[f"anthropic-ratelimit-{name}-limit"] = str(int(limit))
+                    headers[f"anthropic-ratelimit-{name}-remaining"] = str(max(0, int(self.levels[name])))
+            if short:
+                headers["retry-after"] = str(max(1, round(max(short))))
+            return not short, headers
+
+
+class Faults:
+    """Injected failures: a share of requests get a 503 (``error_rate``), have
+    their connection dropped without a response (``drop_rate``) or take
+    ``slow_seconds`` longer (``slow_rate``). Seeded, so runs are comparable.
+    """
+
+    def __init__(self, error_rate: float = 0.0, drop_rate: float = 0.0, slow_rate: float = 0.0,
+                 slow_seconds: float = 0.0, seed: int = 0):
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.slow_rate = slow_rate
+        self.slow_seconds = slow_seconds
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def draw(self) -> str | None:
+        """``"error"``, ``"drop"``, ``"slow"`` or None for the next request."""
+        with self.lock:
+            roll = self.random.random()
+        for fault, rate in (("error", self.error_rate), ("drop", self.drop_rate), ("slow", self.slow_rate)):
+            if roll < rate:
+                return fault
+            roll -= rate
+        return None
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self) -> bytes:
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            parts = []
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                parts.append(self.rfile.read(size))
+                self.rfile.readline()
+            return b"".join(parts)
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length) if length else b""
+
+    def send_json(self, status: int, payload: dict, headers: dict | None = None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class DeepgramHandler(_Handler):
+    def do_POST(self):
+        body = self.read_body()
+        self.server.bytes_received += len(body)
+        self.server.requests += 1
+        if self.server.quota is not None:
+            allowed, headers = self.server.quota.take(0)
+            if not allowed:
+                self.send_json(429, {"err_code": "TOO_MANY_REQUESTS"}, {"retry-after": headers["retry-after"]})
+                return
+        fault = self.server.faults.draw() if self.server.faults is not None else None
+        if fault == "drop":
+            self.close_connection = True
+            return
+        if fault == "error":
+            self.send_json(503, {"err_code": "SERVICE_UNAVAILABLE"})
+            return
+        duration = wav_duration(body)
+        delay = self.server.latency + self.server.latency_per_audio_second * duration
+        if fault == "slow":
+            delay += self.server.faults.slow_seconds
+        if delay:
+            time.sleep(delay)
+        self.send_json(200, deepgram_response(duration=duration))
+
+
+SAMPLE_NOTE = {
+    "client_name": "J.D.",
+    "session_date": "2024-01-15",
+    "session_length": "50 minutes",
+    "subjective": "Client reports feeling more stable this week and attended three meetings.",
+    "objective": "Client was alert, engaged and maintained good eye contact throughout the session.",
+    "assessment": "Client is making steady progress toward sobriety goals; cravings remain a risk factor.",
+    "plan": "Continue weekly sessions, practice coping plan, contact sponsor before family visits.",
+    "clinical_tone": "Hopeful, engaged",
+}
+
+
+def anthropic_message(text: str, usage: dict | None = None, tool: str | None = None) -> dict:
+    """Build a minimal Messages API response carrying one text block, or a
+    call to ``tool`` whose input is ``text`` parsed as JSON.
+    """
+    if tool:
+        content = [{"type": "tool_use", "id": "toolu_mock", "name": tool, "input": json.loads(text)}]
+    else:
+        content = [{"type": "text", "text": text}]
+    return {
+        "id": "msg_mock",
+        "type": "message",
+        "role": "assistant",
+        "model": "mock",
+        "content": content,
+        "stop_reason": "tool_use" if tool else "end_turn",
+        "stop_sequence": None,
+        "usage": usage or {"input_tokens": 1200, "output_tokens": 300},
+    }
+
+
+def estimate_usage(request: dict, cached_prefixes: set) -> dict:
+    """Rough token usage (4 chars per token), emulating prompt caching.
+
+    Everything up to the last ``cache_control`` block is the cacheable
+    prefix; it is a cache write the first time it is seen and a read after.
+    As in the API, the tool definitions and ``tool_choice`` are part of the
+    cache key, so changing either misses the cache.
+    """
+    blocks = [{"text": json.dumps(request["tools"])}] if request.get("tools") else []
+    if isinstance(request.get("system"), str):
+        blocks.append({"text": request["system"]})
+    else:
+        blocks.extend(request.get("system") or [])
+    for message in request.get("messages", []):
+        content = message["content"]
+        blocks.extend([{"text": content}] if isinstance(content, str) else content)
+    texts = [b.get("text", json.dumps(b)) for b in blocks]
+    marked = [i for i, b in enumerate(blocks) if b.get("cache_control")]
+    split = marked[-1] + 1 if marked else 0
+    prefix, rest = "".join(texts[:split]), "".join(texts[split:])
+    usage = {"input_tokens": len(rest) // 4 + 1, "output_tokens": 300,
+             "cache_read_input_tokens": 0, "cache_creation_input_tokens": 0}
+    if prefix:
+        cache_key = json.dumps(request.get("tool_choice"), sort_keys=True) + prefix
+        key = "cache_read_input_tokens" if cache_key in cached_prefixes else "cache_creation_input_tokens"
+        usage[key] = len(prefix) // 4
+        cached_prefixes.add(cache_key)
+    return usage
+
+
+def requested_fields(request: dict, note: dict) -> dict:
+    """The subset of ``note`` named by a "Rewrite only these fields: ..." instruction, else all of it."""
+    for message in request.get("messages", []):
+        content = message["content"]
+        for block in [{"text": content}] if isinstance(content, str) else content:
+            match = re.search(r"Rewrite only these fields: ([a-z_, ]+)\.", block.get("text", ""))
+            if match:
+                return {field: note[field] for field in match.group(1).split(", ") if field in note}
+    return note
+
+
+class AnthropicHandler(_Handler):
+    """Messages API stand-in. The time to first token is ``server.latency``
+    plus ``server.latency_per_input_token`` for every uncached input token;
+    responses then emit ``server.tokens_per_second`` 4-char tokens.
+    ``server.faults`` and ``server.quota`` inject errors and 429s.
+    """
+
+    def do_POST(self):
+        body = self.read_body()
+        self.server.bytes_received += len(body)
+        self.server.requests += 1
+        request = json.loads(body or b"{}")
+        if not hasattr(self.server, "cached_prefixes"):
+            self.server.cached_prefixes = set()
+        usage = estimate_usage(request, self.server.cached_prefixes)
+        uncached = usage["input_tokens"] + usage["cache_creation_input_tokens"]
+        delay = self.server.latency + getattr(self.server, "latency_per_input_token", 0) * uncached
+        fault = self.server.faults.draw() if self.server.faults is not None else None
+        if fault == "drop":
+            self.close_connection = True
+            return
+        if fault == "error":
+            error = {"type": "api_error", "message": "Internal server error"}
+            self.send_json(500, {"type": "error", "error": error})
+            return
+        if fault == "slow":
+            delay += self.server.faults.slow_seconds
+        headers = UNLIMITED_RATE_HEADERS
+        if self.server.quota is not None:
+            allowed, headers = self.server.quota.take(uncached)
+            if not allowed:
+                error = {"type": "rate_limit_error", "message": "Number of requests has exceeded your rate limit"}
+                self.send_json(429, {"type": "error", "error": error}, headers)
+                return
+        if delay:
+            time.sleep(delay)
+        tool = (request.get("tool_choice") or {}).get("name")
+        text = json.dumps(requested_fields(request, SAMPLE_NOTE))
+        usage["output_tokens"] = len(text) // 4 + 1
+        if request.get("stream"):
+            self.send_stream(text, usage, tool, headers)
+        else:
+            tokens_per_second = getattr(self.server, "tokens_per_second", 0)
+            if tokens_per_second:
+                time.sleep(len(text) / 4 / tokens_per_second)
+            self.send_json(200, anthropic_message(text, usage, tool), headers)
+
+    def send_stream(self, text: str, usage: dict, tool: str | None = None, headers: dict | None = None):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        # Without a decode rate there is nothing to pace, so the events go out in one write
+        tokens_per_second = getattr(self.server, "tokens_per_second", 0)
+        self._pending = None if tokens_per_second else []
+        message = anthropic_message("", dict(usage, output_tokens=1))
+        message["content"] = []
+        message["stop_reason"] = None
+        self.send_event("message_start", {"type": "message_start", "message": message})
+        if tool:
+            block = {"type": "tool_use", "id": "toolu_mock", "name": tool, "input": {}}
+        else:
+            block = {"type": "text", "text": ""}
+        self.send_event("content_block_start", {"type": "content_block_start", "index": 0, "content_block": block})
+        for i in range(0, len(text), 4):
+            if tokens_per_second:
+                time.sleep(1 / tokens_per_second)
+            if tool:
+                delta = {"type": "input_json_delta", "partial_json": text[i:i + 4]}
+            else:
+                delta = {"type": "text_delta", "text": text[i:i + 4]}
+            self.send_event("content_block_delta", {"type": "content_block_delta", "index": 0, "delta": delta})
+        self.send_event("content_block_stop", {"type": "content_block_stop", "index": 0})
+        self.send_event("message_delta", {"type": "message_delta",
+                                           "delta": {"stop_reason": "tool_use" if tool else "end_turn",
+                                                     "stop_sequence": None},
+                                           "usage": {"output_tokens": usage["output_tokens"]}})
+        self.send_event("message_stop", {"type": "message_stop"})
+        self.wfile.write(b"".join(self._pending or []) + b"0\r\n\r\n")
+
+    def send_event(self, event: str, data: dict):
+        payload = f"event: {event}\ndata: {json.dumps(data)}\n\n".encode()
+        chunk = f"{len(payload):x}\r\n".encode() + payload + b"\r\n"
+        if self._pending is not None:
+            self._pending.append(chunk)
+        else:
+            self.wfile.write(chunk)
+
+
+class MockServer:
+    """Run a handler class on a background thread, optionally over TLS.
+
+    Use as a context manager; ``url`` is valid once entered.
+    """
+
+    def __init__(self, handler=DeepgramHandler, latency: float = 0.0, tls: bool = False, path: str = "/v1/listen",
+                 latency_per_audio_second: float = 0.0, tokens_per_second: float = 0.0,
+                 latency_per_input_token: float = 0.0, quota: Quota | None = None, faults: Faults | None = None):
+        self.handler = handler
+        self.quota = quota
+        self.faults = faults
+        self.tokens_per_second = tokens_per_second
+        self.latency_per_input_token = latency_per_input_token
+        self.latency = latency
+        self.latency_per_audio_second = latency_per_audio_second
+        self.tls = tls
+        self.path = path
+        self.certfile = None
+        self._tmpdir = None
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        scheme = "https" if self.tls else "http"
+        host = "localhost" if self.tls else "127.0.0.1"
+        return f"{scheme}://{host}:{self._server.server_address[1]}{self.path}"
+
+    @property
+    def requests(self) -> int:
+        return self._server.requests
+
+    def __enter__(self):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler)
+        server.daemon_threads = True
+        server.latency = self.latency
+        server.latency_per_audio_second = self.latency_per_audio_second
+        server.tokens_per_second = self.tokens_per_second
+        server.latency_per_input_token = self.latency_per_input_token
+        server.quota = self.quota
+        server.faults = self.faults
+        server.requests = 0
+        server.bytes_received = 0
+        if self.tls:
+            self._tmpdir = tempfile.TemporaryDirectory()
+            self.certfile, keyfile = make_self_signed_cert(self._tmpdir.name)
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(self.certfile, keyfile)
+            server.socket = context.wrap_socket(server.socket, server_side=True)
+        self._server = server
+        self._thread = threading.Thread(target=server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._tmpdir is not None:
+            self._tmpdir.cleanup()
@@ -0,0 +1,33 @@
+import contextlib
+import io
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def app():
+    """The app module, imported outside a Streamlit server."""
+    with contextlib.redirect_stderr(io.StringIO()):
+        import app
+    return app
+
+
+@pytest.fixture
+def rerun_app(app):
+    """A function that executes app.py again as a new module, the way
+    Streamlit re-executes the script on every rerun. Cached resources are
+    shared with ``app``.
+    """
+    import importlib.util
+
+    def rerun():
+        spec = importlib.util.spec_from_file_location(app.__name__, app.__file__)
+        module = importlib.util.module_from_spec(spec)
+        with contextlib.redirect_stderr(io.StringIO()):
+            spec.loader.exec_module(module)
+        return module
+    return rerun
@@ -0,0 +1,48 @@
+import io
+import os
+
+import pytest
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet
+
+
+def test_large_artifact_is_streamed_to_disk(app, tmp_path):
+    store = app.ArtifactStore(1024, str(tmp_path), 3600, stream_bytes=1024)
+    data = os.urandom(3 * 1024 * 1024 + 5)
+    handle = store.put("a", memoryview(data))
+    assert store.stats()["memory_bytes"] == 0
+    assert store.get(handle) == data
+    assert b"".join(store.chunks(handle)) == data
+    # The same recording again, from a file, is stored once
+    assert store.put("b", io.BytesIO(data)) == handle
+    assert len(os.listdir(store.directory)) == 1
+    store.release_owner("a")
+    store.release_owner("b")
+    assert os.listdir(store.directory) == []
+    with pytest.raises(KeyError):
+        store.get(handle)
+
+
+def test_chunked_cipher_detects_truncation(app, tmp_path):
+    cipher = app.ChunkedCipher(os.urandom(32), chunk_bytes=1024)
+    path = str(tmp_path / "audio.bin")
+    data = os.urandom(4096)
+    assert cipher.write(path, iter([data[:1000], data[1000:]]))[1] == len(data)
+    assert cipher.read(path) == data
+    # Drop the last record: what is left ends on a record not sealed as the last
+    with open(path, "r+b") as f:
+        f.truncate(3 * cipher.record_bytes)
+    with pytest.raises(InvalidTag):
+        cipher.read(path)
+
+
+def test_job_audio_round_trip(app, tmp_path):
+    store = app.JobStore(str(tmp_path / "jobs.db"), Fernet.generate_key().decode())
+    data = os.urandom(2 * 1024 * 1024 + 1)
+    job_id = store.create("owner", "transcribe", {}, audio=io.BytesIO(data))
+    upload = store._db().execute("SELECT payload FROM stages WHERE job_id = ?", (job_id,)).fetchone()
+    upload = store._decrypt(upload["payload"])
+    assert upload["bytes"] == len(data)
+    assert store.load_audio(upload["blob"]) == data
+    store.purge(older_than=-1)
+    assert store.load_audio(upload["blob"]) is None
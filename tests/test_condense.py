@@ -0,0 +1,50 @@
+def condense(app, *lines):
+    return app.condense_transcript("\n".join(lines))
+
+
+def test_backchannel_between_the_other_speakers_turns_is_dropped(app):
+    result = condense(app, "Therapist: Last week we talked about your sleep,", "Client: Mm-hmm.",
+                      "Therapist: and how it has been since.")
+
+    assert result.text == "Therapist: Last week we talked about your sleep, and how it has been since."
+    assert result.backchannels_removed == 1
+
+
+def test_multi_word_backchannel_is_dropped_as_a_phrase(app):
+    result = condense(app, "Therapist: Try the breathing exercise.", "Client: Okay, got it.",
+                      "Therapist: Every night before bed.")
+
+    assert result.text == "Therapist: Try the breathing exercise. Every night before bed."
+    assert result.backchannels_removed == 1
+
+
+def test_words_of_a_phrase_on_their_own_are_kept(app):
+    result = condense(app, "Therapist: You said the letter,", "Client: I got it.", "Therapist: came on Monday.")
+
+    assert "Client: I got it." in result.text
+    assert result.backchannels_removed == 0
+
+
+def test_questions_are_never_dropped(app):
+    result = condense(app, "Therapist: The bruise on your arm,", "Client: See it?", "Therapist: yes, that one.")
+    assert "Client: See it?" in result.text
+
+    result = condense(app, "Therapist: We can move the session.", "Client: Okay?", "Therapist: To Thursday.")
+    assert "Client: Okay?" in result.text
+
+
+def test_answers_to_a_question_anywhere_in_the_turn_are_kept(app):
+    result = condense(app, "Therapist: Did you drink this weekend? I know it was your birthday.", "Client: Yeah.",
+                      "Therapist: Okay, tell me about that.")
+
+    assert "Client: Yeah." in result.text
+    assert result.backchannels_removed == 0
+    assert result.turns_merged == 0
+
+
+def test_answers_to_an_unpunctuated_turn_are_kept(app):
+    result = condense(app, "Therapist: So you stopped taking the medication", "Client: Right.",
+                      "Therapist: When was that?")
+
+    assert "Client: Right." in result.text
+    assert result.backchannels_removed == 0
@@ -0,0 +1,21 @@
+import os
+import time
+
+from cryptography.fernet import Fernet
+
+
+def test_disk_cache_evicts_least_recently_used_over_budget(app, tmp_path):
+    cache = app.EncryptedDiskCache(str(tmp_path), Fernet.generate_key().decode(), 3600, max_bytes=10_000)
+    value = os.urandom(1500)  # about 2 KB encrypted
+    for n in range(4):
+        cache.set(f"k{n}", value)
+        # Distinct mtimes, oldest first
+        os.utime(cache._path(f"k{n}"), (time.time() - 100 + n, time.time() - 100 + n))
+    assert cache.get("k0") == value  # now the most recently used
+    cache.set("k4", value)
+    cache.set("k5", value)
+    assert cache.size <= 10_000
+    assert sum(entry.stat().st_size for entry in os.scandir(tmp_path)) == cache.size
+    assert cache.get("k1") is None
+    assert cache.get("k0") == value
+    assert cache.get("k5") == value
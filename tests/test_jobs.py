@@ -0,0 +1,44 @@
+import time
+
+
+def wait_done(engine, job_id, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not engine.get(job_id).done:
+        assert time.monotonic() < deadline, "job did not finish"
+        time.sleep(0.01)
+    return engine.get(job_id)
+
+
+def test_jobs_submitted_from_a_later_rerun_report_progress(app, rerun_app):
+    engine = app.get_job_engine()
+    later = rerun_app()
+    assert later.get_job_engine() is engine
+
+    def work():
+        later.report_progress(0.5, "Halfway")
+        later.report_partial("subjective", "text")
+        time.sleep(0.2)
+
+    job_id = engine.submit("owner", "generate", work)
+    time.sleep(0.1)
+    job = engine.get(job_id)
+    assert (job.progress, job.message, job.partial) == (0.5, "Halfway", {"subjective": "text"})
+    assert wait_done(engine, job_id).status == "done"
+
+
+def test_failures_without_a_message_are_recorded_as_failed(app, tmp_path):
+    from cryptography.fernet import Fernet
+
+    engine = app.get_job_engine()
+
+    def work():
+        raise TimeoutError()
+
+    job = wait_done(engine, engine.submit("owner", "generate", work))
+    assert (job.status, job.error) == ("failed", "TimeoutError")
+
+    store = app.JobStore(str(tmp_path / "jobs.db"), Fernet.generate_key().decode())
+    job_id = store.create("owner", "generate", {})
+    assert store.lease("worker")["id"] == job_id
+    store.finish(job_id, "worker", "failed", "")
+    assert store.load_job(job_id).status == "failed"
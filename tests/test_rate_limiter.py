@@ -0,0 +1,15 @@
+def test_rate_limited_from_a_later_rerun_is_queued_again(app, rerun_app):
+    limiter = app.get_rate_limiter("deepgram")
+    later = rerun_app()
+    assert later.get_rate_limiter("deepgram") is limiter
+    attempts = []
+
+    def call():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise later.RateLimited(retry_after=0)
+        return "ok"
+
+    assert limiter.call(call) == "ok"
+    assert len(attempts) == 2
+    assert limiter.in_flight == 0
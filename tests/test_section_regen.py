@@ -0,0 +1,20 @@
+def test_excerpt_holds_the_edit_with_its_context(app):
+    old = "\n".join(f"Client: Line {n}." for n in range(20))
+    new = old.replace("Line 10.", "Line ten, corrected.").replace("Client: Line 18.\n", "")
+    excerpt = app.transcript_excerpt(old, new, context=1)
+    assert excerpt.split("\n") == [
+        "[...]", "Client: Line 9.", "Client: Line ten, corrected.", "Client: Line 11.",
+        "[...]", "Client: Line 17.", "Client: Line 19.",
+        "", "REMOVED BY THE EDIT:", "Client: Line 10.", "Client: Line 18.",
+    ]
+    assert app.transcript_excerpt(old, old) is None
+
+
+def test_section_request_sends_the_excerpt_instead_of_the_transcript(app):
+    note = app.SOAPNote(client_name="A", session_date="today", session_length="50 min", subjective="S",
+                        objective="O", assessment="A", plan="Call the sponsor after family visits")
+    request = app.build_section_request("full transcript", "", note, ["plan"], excerpt="the edit")
+    source, instruction = request["messages"][0]["content"]
+    assert source["text"] == "TRANSCRIPT EDITS:\nthe edit"
+    assert "full transcript" not in instruction["text"]
+    assert "plan: Call the sponsor after family visits" in instruction["text"]
@@ -0,0 +1,13 @@
+import time
+
+
+def test_session_links_must_be_signed_and_unexpired(app):
+    session_id = "0123456789abcdef0123456789abcdef"
+    token = app.sign_session_link(session_id, time.time() + 60)
+    assert app.verify_session_link(token) == session_id
+    # The bare session id, as URLs carried it before, no longer opens the session
+    assert app.verify_session_link(session_id) is None
+    assert app.verify_session_link(token.replace(session_id, "f" * 32)) is None
+    assert app.verify_session_link(token[:-1] + ("0" if token[-1] != "0" else "1")) is None
+    assert app.verify_session_link(app.sign_session_link(session_id, time.time() - 1)) is None
+    assert app.verify_session_link("") is None
@@ -0,0 +1,31 @@
+import struct
+
+import numpy as np
+
+FLOAT = bytes.fromhex("0300000000001000800000aa00389b71")
+PCM = bytes.fromhex("0100000000001000800000aa00389b71")
+
+
+def extensible_wav(samples: np.ndarray, sub_format: bytes, framerate: int = 48000) -> bytes:
+    """Stereo WAVE_FORMAT_EXTENSIBLE file of 32-bit ``samples``."""
+    data = samples.tobytes()
+    fmt = struct.pack("<HHIIHHHHI16s", 0xFFFE, 2, framerate, framerate * 8, 8, 32, 22, 32, 3, sub_format)
+    return (b"RIFF" + struct.pack("<I", 4 + 8 + len(fmt) + 8 + len(data)) + b"WAVE"
+            + b"fmt " + struct.pack("<I", len(fmt)) + fmt + b"data" + struct.pack("<I", len(data)) + data)
+
+
+def test_float_extensible_wav_is_sent_unchanged(app):
+    audio = extensible_wav(np.full((4800, 2), 0.25, dtype="<f4"), FLOAT)
+    assert app.read_wav_pcm(audio) is None
+    assert app.preprocess_audio(audio) == (None, None)
+
+
+def test_pcm_extensible_wav_is_parsed(app):
+    audio = extensible_wav(np.full((4800, 2), 1 << 29, dtype="<i4"), PCM)
+    params, frames = app.read_wav_pcm(audio)
+    assert (params.nchannels, params.sampwidth, params.framerate, params.nframes) == (2, 4, 48000, 4800)
+    processed, stats = app.preprocess_audio(audio)
+    params, frames = app.read_wav_pcm(processed)
+    assert (params.nchannels, params.sampwidth, params.framerate) == (1, 2, 16000)
+    middle = np.frombuffer(frames, dtype="<i2")[100:-100]
+    assert np.allclose(middle, 0.25 * 32767, atol=64)
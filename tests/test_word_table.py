@@ -0,0 +1,30 @@
+import json
+
+
+def deepgram_words(*words):
+    return [
+        {"word": word.strip("$.,").lower(), "punctuated_word": word, "start": i * 0.5, "end": i * 0.5 + 0.4,
+         "speaker": i // 2 % 2, "confidence": 0.9}
+        for i, word in enumerate(words)
+    ]
+
+
+def test_columns_round_trip_keeps_words_with_spaces(app):
+    words = deepgram_words("It", "cost", "$5 000", "last", "month.")
+    table = app.WordTable.from_words(words)
+
+    restored = app.WordTable.from_columns(json.loads(json.dumps(table.to_columns())))
+
+    assert [restored.word_text(i) for i in range(len(restored))] == ["It", "cost", "$5 000", "last", "month."]
+    assert restored[3].text == "last"
+    assert restored.speaker.tolist() == table.speaker.tolist()
+    assert restored.labelled_transcript() == table.labelled_transcript()
+
+
+def test_columns_without_offsets_still_load(app):
+    columns = app.WordTable.from_words(deepgram_words("Hello", "there.")).to_columns()
+    del columns["offsets"]
+
+    restored = app.WordTable.from_columns(columns)
+
+    assert [restored.word_text(i) for i in range(len(restored))] == ["Hello", "there."]
@@ -0,0 +1,44 @@
+"""
+Moonlight AI Note Builder - job worker
+Leases durable jobs from the shared job store and runs them, so
+transcription and note generation scale beyond the Streamlit process and
+carry on while it restarts.
+
+    MOONLIGHT_JOB_DB=/var/lib/moonlight/jobs.db CACHE_ENCRYPTION_KEY=... python worker.py --workers 8
+
+Run any number of workers against the same database. A worker that dies
+stops renewing its leases; once they expire (MOONLIGHT_JOB_LEASE_SECONDS)
+another worker resumes those jobs from their last completed stage.
+"""
+
+import argparse
+import sys
+import time
+
+import app
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--workers", type=int, default=app.JOB_MAX_CONCURRENCY, help="jobs run at once")
+    parser.add_argument("--metrics-port", type=int, default=app.METRICS_PORT, help="serve /metrics on this port")
+    args = parser.parse_args(argv)
+
+    store = app.get_job_store()
+    if store is None:
+        print("worker.py needs MOONLIGHT_JOB_DB and CACHE_ENCRYPTION_KEY to be set", file=sys.stderr)
+        return 2
+    engine = app.JobEngine(args.workers, store=store)
+    if args.metrics_port:
+        app.start_metrics_server(args.metrics_port)
+    print(f"worker {engine.worker_id} leasing jobs from {store.path}", file=sys.stderr)
+    try:
+        while True:
+            time.sleep(60)
+            store.purge()
+    except KeyboardInterrupt:
+        return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())